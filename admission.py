@@ -0,0 +1,297 @@
+"""Admission control in front of Gemini.
+
+Two layers, both answering fast instead of letting work pile up:
+
+- RateLimiter: a token bucket per client (requests per minute plus a
+  burst), checked when a request arrives; over the limit means 429.
+- ConcurrencyGate: at most ``limit`` Gemini calls in flight per worker,
+  with a bounded queue in front. A full queue or a wait longer than
+  ``timeout`` raise Overloaded, which the routes turn into 503 with
+  Retry-After.
+
+The gate is shared by request threads and the event loop of the ASGI app:
+slot() blocks a thread, aslot() suspends a coroutine, and both queue in
+the same line. Nobody waits past their request's deadline.
+"""
+import asyncio
+import contextlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import deadline
+from deadline import DeadlineExceeded
+
+
+class Overloaded(Exception):
+    """Refused by admission control; retry after ``retry_after`` seconds
+
+    ``reason`` is "queue_full" or "queue_timeout". Running out of the
+    request's deadline while queued raises DeadlineExceeded instead.
+    """
+
+    MESSAGES = {
+        "queue_full": "Too many requests are waiting for the AI",
+        "queue_timeout": "Timed out waiting for the AI",
+    }
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{self.MESSAGES.get(reason, reason)}, please retry in {retry_after} s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket per client key, ``rate`` requests per minute with ``burst`` in reserve
+
+    A cost above ``burst`` (a large batch) could never be saved up for: it
+    goes ahead once the bucket is full and leaves it in debt, so the client
+    pays it off before its next request.
+    """
+
+    def __init__(self, rate=30.0, burst=10, max_clients=10000):
+        self.rate = rate / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        # key -> [tokens, last refill]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"allowed": 0, "limited": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rate=float(os.environ.get("RATE_LIMIT_PER_MINUTE", 30)),
+            burst=int(os.environ.get("RATE_LIMIT_BURST", 10)),
+        )
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def check(self, key, cost=1):
+        """0 if ``key`` may go ahead (and pay ``cost``), else seconds until it may"""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            needed = min(cost, self.burst)
+            if bucket[0] >= needed:
+                bucket[0] -= cost
+                self.counters["allowed"] += 1
+                return 0
+            self.counters["limited"] += 1
+            return max(1, math.ceil((needed - bucket[0]) / self.rate))
+
+    def stats(self):
+        return {**self.counters, "clients": len(self._buckets),
+                "per_minute": self.rate * 60, "burst": self.burst}
+
+
+class _AsyncWaiter:
+    __slots__ = ("loop", "future")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def grant(self, gate):
+        self.loop.call_soon_threadsafe(self._granted, gate)
+
+    def _granted(self, gate):
+        if self.future.done():
+            gate.release()  # its coroutine is gone: pass the slot on
+        else:
+            self.future.set_result(None)
+
+
+class _ThreadWaiter:
+    __slots__ = ("event",)
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def grant(self, gate):
+        self.event.set()
+
+
+class ConcurrencyGate:
+    """At most ``limit`` holders; up to ``max_queue`` more wait, first come first served"""
+
+    def __init__(self, limit=16, max_queue=64, timeout=30.0, on_wait=None, on_depth=None, on_reject=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        # on_wait(name, seconds), on_depth(active, waiting) and
+        # on_reject(name, reason), e.g. for metrics
+        self.on_wait = on_wait
+        self.on_depth = on_depth
+        self.on_reject = on_reject
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._hold = 1.0  # moving average of slot hold time, for Retry-After
+        self.counters = {"admitted": 0, "queued": 0, "queue_full": 0, "timeouts": 0}
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        return cls(
+            limit=int(os.environ.get("GEMINI_CONCURRENCY", 16)),
+            max_queue=int(os.environ.get("GEMINI_QUEUE", 64)),
+            timeout=float(os.environ.get("GEMINI_QUEUE_TIMEOUT", 30)),
+            **kwargs,
+        )
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def _retry_after(self):
+        # Time for the queue ahead to drain, at the recent pace
+        return max(1, math.ceil(self._hold * (len(self._waiters) + 1) / max(1, self.limit)))
+
+    def _enter(self, name, make_waiter):
+        """Take a slot now (returns None) or join the queue (returns the waiter)"""
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                self.counters["admitted"] += 1
+                waiter = None
+            elif len(self._waiters) >= self.max_queue:
+                self.counters["queue_full"] += 1
+                raise self._rejected(name, "queue_full")
+            else:
+                waiter = make_waiter()
+                self._waiters.append(waiter)
+                self.counters["queued"] += 1
+            self._depth()
+        return waiter
+
+    def _depth(self):
+        # Called with the lock held, so updates arrive in order
+        if self.on_depth:
+            self.on_depth(self.active, len(self._waiters))
+
+    def _abandon(self, waiter):
+        """Leave the queue; False if a slot was already handed to ``waiter``"""
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return False
+            self._depth()
+            return True
+
+    def _timed_out(self, name):
+        with self._lock:
+            self.counters["timeouts"] += 1
+            if deadline.expired():
+                if self.on_reject:
+                    self.on_reject(name, "deadline")
+                return DeadlineExceeded()
+            return self._rejected(name, "queue_timeout")
+
+    def _rejected(self, name, reason):
+        if self.on_reject:
+            self.on_reject(name, reason)
+        return Overloaded(reason, self._retry_after())
+
+    def try_acquire(self):
+        """Take a free slot without queueing for it; False if there is none"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.active >= self.limit or self._waiters:
+                return False
+            self.active += 1
+            self.counters["admitted"] += 1
+            self._depth()
+            return True
+
+    def release(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._waiters:
+                # The slot passes straight to the next in line
+                self._waiters.popleft().grant(self)
+                self.counters["admitted"] += 1
+            else:
+                self.active -= 1
+            self._depth()
+
+    def _admitted(self, name, queued_at):
+        started = time.monotonic()
+        if self.on_wait:
+            self.on_wait(name, started - queued_at)
+        return started
+
+    def _released(self, started):
+        held = time.monotonic() - started
+        self._hold = 0.8 * self._hold + 0.2 * held
+        self.release()
+
+    @contextlib.contextmanager
+    def slot(self, name="gemini"):
+        """Hold one slot for the block; raises Overloaded instead of waiting too long"""
+        if not self.enabled:
+            yield
+            return
+        queued_at = time.monotonic()
+        wait = deadline.clamp(self.timeout)
+        waiter = self._enter(name, _ThreadWaiter)
+        if waiter is not None and not waiter.event.wait(wait) and self._abandon(waiter):
+            raise self._timed_out(name)
+        started = self._admitted(name, queued_at)
+        try:
+            yield
+        finally:
+            self._released(started)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, name="gemini"):
+        """slot() for coroutines: waits without blocking the event loop"""
+        if not self.enabled:
+            yield
+            return
+        queued_at = time.monotonic()
+        wait = deadline.clamp(self.timeout)
+        waiter = self._enter(name, lambda: _AsyncWaiter(asyncio.get_running_loop()))
+        if waiter is not None:
+            try:
+                # wait() leaves the future alone on timeout, so a grant can't get lost
+                await asyncio.wait({waiter.future}, timeout=wait)
+            except asyncio.CancelledError:
+                if not self._abandon(waiter):
+                    waiter.future.add_done_callback(lambda _: self.release())
+                raise
+            if not waiter.future.done():
+                if self._abandon(waiter):
+                    raise self._timed_out(name)
+                await waiter.future  # granted just now
+        started = self._admitted(name, queued_at)
+        try:
+            yield
+        finally:
+            self._released(started)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "timeout": self.timeout,
+        }
@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context, url_for
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
 import sys
@@ -12,52 +13,280 @@ import urllib.parse
 import re
 import platform
 import tempfile
-from geopy.geocoders import Nominatim
+import hmac
+import hashlib
+import secrets
+import multiprocessing
+import contextvars
+import concurrent.futures
+import threading
 import base64
 import io
-import markdown
+import logging
 import traceback
-from PIL import Image
 from dotenv import load_dotenv
-
-# Conditional imports for server compatibility
-try:
-    import speech_recognition as sr
-    SPEECH_RECOGNITION_AVAILABLE = True
-except ImportError:
-    SPEECH_RECOGNITION_AVAILABLE = False
-    print("⚠️ speech_recognition not available on server")
-
-try:
-    import pyttsx3
-    TTS_AVAILABLE = True
-except ImportError:
-    pyttsx3 = None
-    TTS_AVAILABLE = False
-    print("⚠️ pyttsx3 not available on server")
-
-try:
-    import psutil
-    PSUTIL_AVAILABLE = True
-except ImportError:
-    psutil = None
-    PSUTIL_AVAILABLE = False
-    print("⚠️ psutil not available on server")
+import deadline
+from admission import ConcurrencyGate, Overloaded, RateLimiter
+from assets import Asset, StaticAssets
+from deadline import DeadlineExceeded
+from cpu_pool import CpuPool
+from cpu_tasks import format_image_analysis_with_info, render_markdown
+from debug_capture import DebugCapture
+from gazetteer import Gazetteer
+from generation import GenerationProfiles
+from image_cache import ImageAnalysisCache
+from image_ingest import ImageRejected, UploadTooLarge, prepare_image, spool_upload
+from intent_router import IntentRouter
+from markdown_renderer import MarkdownRenderer
+from metrics import SIZE_BUCKETS, TOKEN_BUCKETS, Registry, timed
+from news_feed import NewsFeed
+from response_cache import ResponseCache
+from singleflight import FileSingleFlight, SingleFlight
+from sessions import SessionStore, estimate_tokens
+from ttl_cache import TTLCache
+from streaming_body import PLACEHOLDER, StreamingJSONBody, base64_length
+from upstream import Hedger, UpstreamClient
 
 # Load environment variables
 load_dotenv()
+
+# Warnings and diagnostics from the app and its modules, at LOG_LEVEL and up
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """jsonify() with its serialization time recorded as the "json" span"""
+
+    def dumps(self, obj, **kwargs):
+        with span("json"):
+            return super().dumps(obj, **kwargs)
+
+
+app.json = TimedJSONProvider(app)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def start_request_deadline():
+    g.deadline_token = deadline.start(deadline.requested(request.headers))
+
+
+@app.teardown_request
+def end_request_deadline(exc):
+    token = g.pop("deadline_token", None)
+    if token is None:
+        return
+    try:
+        deadline.finish(token)
+    except ValueError:
+        pass  # a streamed body finished in another context; that one ends with it
+
+
+@app.before_request
+def limit_client_rate():
+    if request.url_rule is None or request.url_rule.rule not in RATE_LIMITED_ROUTES:
+        return None
+    retry_after = RATE_LIMITER.check(client_key(request.headers, request.remote_addr))
+    return too_many_requests(retry_after) if retry_after else None
+
+
+def too_many_requests(retry_after):
+    ADMISSION_REJECTIONS.inc(reason="rate_limited")
+    response = jsonify({"error": "Too many requests, please slow down.", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@app.errorhandler(Overloaded)
+def gemini_overloaded(e):
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({"error": str(e)}), 504
+
+
+def client_key(headers, remote_addr):
+    """Whose rate limit a request counts against"""
+    return (CLIENT_IP_HEADER and headers.get(CLIENT_IP_HEADER)) or remote_addr or "unknown"
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    # The rule, not the path, so /weather/<city> stays one series
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    # Streamed bodies are still being produced: this is the time to headers
+    HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_REQUEST_BYTES.observe(request.content_length or 0, endpoint=endpoint)
+    if not response.is_streamed:
+        HTTP_RESPONSE_BYTES.observe(response.calculate_content_length() or 0, endpoint=endpoint)
+    return response
+
+
+# =========== STATIC ASSETS ===========
+# Fingerprinted, precompressed copies of static/ (see assets.py): their URLs
+# change with their content, so browsers may keep them for good
+IMMUTABLE = "public, max-age=31536000, immutable"
+# The page itself is revalidated, which its ETag turns into a bodiless 304
+INDEX_CACHE_CONTROL = os.environ.get("INDEX_CACHE_CONTROL", "no-cache")
+# Seconds before trying again to load assets that failed to load
+STATIC_ASSETS_RETRY = float(os.environ.get("STATIC_ASSETS_RETRY", 30))
+_static_assets = None
+_static_assets_retry_at = 0.0
+_static_assets_lock = threading.Lock()
+_index_page = None
+
+
+def static_assets():
+    """The fingerprinted assets (built from static/ on first use if needed),
+    or None while they can't be loaded; a failure is retried after
+    STATIC_ASSETS_RETRY seconds"""
+    global _static_assets, _static_assets_retry_at
+    if _static_assets is None and time.monotonic() >= _static_assets_retry_at:
+        with _static_assets_lock:
+            if _static_assets is None and time.monotonic() >= _static_assets_retry_at:
+                try:
+                    _static_assets = StaticAssets.from_env()
+                except Exception as e:
+                    log.warning("Static assets not available, serving static/ as is: %s", e)
+                    _static_assets_retry_at = time.monotonic() + STATIC_ASSETS_RETRY
+    return _static_assets
+
+
+def asset_url(filename):
+    """URL of a static file for templates: its fingerprinted copy, or the plain
+    /static/ file when there is none"""
+    assets = static_assets()
+    path = assets and assets.path(filename)
+    if path:
+        return url_for("serve_asset", path=path)
+    return url_for("static", filename=filename)
+
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+
+def send_variant(asset, cache_control):
+    """(encoding, response): ``asset`` in the best encoding the client accepts,
+    or a 304 if If-None-Match already names that variant"""
+    encoding, variant = asset.pick(lambda name: request.accept_encodings[name])
+    if request.if_none_match.contains_weak(variant.etag):
+        response = Response(status=304)
+    else:
+        response = Response(variant.body, content_type=asset.content_type)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(variant.etag)
+    response.headers["Cache-Control"] = cache_control
+    if len(asset.variants) > 1:
+        response.vary.add("Accept-Encoding")
+    return encoding, response
+
+
+def index_page():
+    """index.html rendered once per worker (on every request in debug mode,
+    so template edits show up), and again once the assets it links to load"""
+    global _index_page
+    assets = static_assets()
+    if _index_page is None or app.debug or (assets and not _index_page[1]):
+        page = Asset.from_bytes("index.html", render_template("index.html").encode("utf-8"))
+        _index_page = (page, assets is not None)
+    return _index_page[0]
+
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return send_variant(index_page(), INDEX_CACHE_CONTROL)[1]
+
+
+@app.route('/assets/<path:path>')
+def serve_asset(path):
+    assets = static_assets()
+    asset, current = assets.lookup(path) if assets else (None, False)
+    if asset is None:
+        return jsonify({"error": "Not found"}), 404
+    # An outdated hash, from a page served before a deploy: the current file,
+    # but not to be kept under that URL
+    encoding, response = send_variant(asset, IMMUTABLE if current else "no-cache")
+    assets.record(encoding, response.status_code == 304)
+    return response
+
+
 @app.route('/health')
 def health_check():
     return jsonify({
         "status": "healthy", 
         "message": "Flask app is running",
-        "routes": ["/", "/ask", "/voice", "/weather/<city>", "/quick-action/<action>"]
+        "routes": ["/", "/ask", "/ask/batch", "/ask/image", "/ask/stream", "/metrics", "/sessions", "/voice", "/weather/<city>", "/quick-action/<action>"]
+    })
+@app.route('/upstream/stats')
+def upstream_stats():
+    """Connection pool and circuit breaker state per upstream host, plus Gemini
+    hedging and the generation profiles in use"""
+    return jsonify({**UPSTREAM.stats(), "gemini_hedging": GEMINI_HEDGER.stats(),
+                    "generation_profiles": GENERATION.stats()})
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit/miss counters of the response, weather, news, image and Markdown caches,
+    and of the static assets"""
+    return jsonify({
+        "ask": ASK_CACHE.stats(),
+        "weather": WEATHER_CACHE.stats(),
+        "news": NEWS_FEED.stats(),
+        "image": IMAGE_CACHE.stats(),
+        "markdown": RENDERER.stats(),
+        "sessions": SESSIONS.stats(),
+        "ask_flight": ASK_FLIGHT.stats(),
+        "static": static_assets() and static_assets().stats(),
     })
+@app.route('/admission/stats')
+def admission_stats():
+    """Gemini concurrency gate and per-client rate limiter"""
+    return jsonify({"gemini": GEMINI_GATE.stats(), "clients": RATE_LIMITER.stats()})
+@app.route('/cpu/stats')
+def cpu_stats():
+    """Inline vs. process-pool runs of the CPU-bound stages"""
+    return jsonify(CPU_POOL.stats())
+@app.route('/debug/captures', methods=['GET', 'DELETE'])
+def debug_captures():
+    """Recent sampled Gemini exchanges; needs the X-Debug-Token header"""
+    token = request.headers.get("X-Debug-Token", "")
+    if not DEBUG_CAPTURE_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(token, DEBUG_CAPTURE_TOKEN):
+        return jsonify({"error": "Forbidden"}), 403
+    if request.method == "DELETE":
+        DEBUG_CAPTURE.clear()
+        return jsonify(DEBUG_CAPTURE.stats())
+    return jsonify({
+        "stats": DEBUG_CAPTURE.stats(),
+        "captures": DEBUG_CAPTURE.recent(
+            limit=request.args.get("limit", type=int),
+            kind=request.args.get("kind"),
+        ),
+    })
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of this worker's counters and histograms"""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
 @app.route('/test')
 def test():
     return "Test page - Flask is working!"    
@@ -67,37 +296,194 @@ def test():
 # =========== API CONFIGURATION FROM ENVIRONMENT ===========
 # These will be loaded from .env file locally, or from Fly.io secrets in production
 API_KEY = os.environ.get("API_KEY")
-MODEL = "gemini-2.5-flash"
+# Default model; generation profiles (generation.py) may pick others per request
+MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
 
 if not API_KEY:
     # Fallback for development only (you can remove this after testing)
     API_KEY = "YOUR_API_KEY_HERE"  # Replace with actual if needed for local dev
     print("⚠️ WARNING: API_KEY not found in environment. Using fallback.")
 
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL}:generateContent?key={API_KEY}"
+# Base URL can be pointed at a local stub (see benchmarks/stubs.py)
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+
+def gemini_url(model=MODEL, stream=False):
+    if stream:
+        return f"{GEMINI_API_BASE}/models/{model}:streamGenerateContent?alt=sse&key={API_KEY}"
+    return f"{GEMINI_API_BASE}/models/{model}:generateContent?key={API_KEY}"
+
+
+CACHE_API_URL = f"{GEMINI_API_BASE}/cachedContents"
 
 # --------- NEWS & WEATHER API KEYS ----------
 NEWS_API_KEY = os.environ.get("NEWS_API_KEY", "")
 WEATHER_API_KEY = os.environ.get("WEATHER_API_KEY", "")
+# Like GEMINI_API_BASE, overridable to point at the stubs in benchmarks/stubs.py
+WEATHER_API_BASE = os.environ.get("WEATHER_API_BASE", "https://api.openweathermap.org/data/2.5").rstrip("/")
+NEWS_API_BASE = os.environ.get("NEWS_API_BASE", "https://newsapi.org/v2").rstrip("/")
+
+# Model, generationConfig and prompt budget per kind of request (chat, code,
+# writing, image, summary); tunable through GENERATION_PROFILES and
+# GENERATION_<PROFILE>_<FIELD>, see generation.py
+GENERATION = GenerationProfiles.from_env(MODEL)
+
+# Shared keep-alive client for every upstream call (pools, retries, circuit breakers)
+UPSTREAM = UpstreamClient.from_env()
+
+# Rendered ask_ai replies; set ASK_CACHE_DB to share hits between workers
+ASK_CACHE = ResponseCache.from_env()
+# Truncated or blocked replies are not worth replaying
+CACHEABLE_FINISH_REASONS = ("STOP", "OK")
+# Identical ask_ai calls in flight at the same time share one Gemini request:
+# across threads always, across the workers on this machine when
+# ASK_COALESCE_DIR names a directory for the lock and result files
+ASK_COALESCE_DIR = os.environ.get("ASK_COALESCE_DIR", "")
+ASK_FLIGHT = SingleFlight(across=FileSingleFlight(ASK_COALESCE_DIR) if ASK_COALESCE_DIR else None)
+
+# Admission control: each client gets RATE_LIMIT_PER_MINUTE requests to the
+# AI routes (RATE_LIMIT_BURST at once; a batch pays for each of its items),
+# answered 429 beyond that; at most
+# GEMINI_CONCURRENCY Gemini calls run at a time per worker, GEMINI_QUEUE more
+# wait up to GEMINI_QUEUE_TIMEOUT seconds, and the rest get 503 right away
+RATE_LIMITER = RateLimiter.from_env()
+RATE_LIMITED_ROUTES = {"/ask", "/ask/image", "/ask/stream", "/voice"}
+# Set by Fly's proxy; clear it when not behind one, or clients could pick their own key
+CLIENT_IP_HEADER = os.environ.get("RATE_LIMIT_CLIENT_HEADER", "Fly-Client-IP")
+GEMINI_GATE = ConcurrencyGate.from_env(
+    on_wait=lambda mode, seconds: GEMINI_QUEUE_SECONDS.observe(seconds, mode=mode),
+    on_depth=lambda active, waiting: observe_gate_depth(active, waiting),
+    on_reject=lambda mode, reason: ADMISSION_REJECTIONS.inc(reason=reason),
+)
+# Raised through the AI helpers so the route answers 503 / 504 itself
+REFUSALS = (Overloaded, DeadlineExceeded)
+
+# Every request has REQUEST_DEADLINE seconds (see deadline.py) for routing,
+# queueing, retries and upstream calls. With GEMINI_HEDGE_PERCENTILE set
+# (e.g. 95), a text reply slower than that share of recent ones gets a
+# second, identical generateContent call if a concurrency slot is free,
+# for at most GEMINI_HEDGE_MAX_RATIO of calls; the first answer wins
+GEMINI_HEDGER = Hedger.from_env(
+    "GEMINI",
+    workers=max(GEMINI_GATE.limit, 8),
+    on_hedge=lambda outcome: GEMINI_HEDGES.inc(outcome=outcome),
+)
+
+# Weather changes slowly: reuse reports for WEATHER_CACHE_TTL seconds and fall
+# back to ones up to WEATHER_STALE_TTL seconds older when the API fails
+WEATHER_CACHE = TTLCache(
+    ttl=float(os.environ.get("WEATHER_CACHE_TTL", 600)),
+    stale_ttl=float(os.environ.get("WEATHER_STALE_TTL", 6 * 3600)),
+)
+
+# Headlines are served from memory and refreshed every NEWS_REFRESH_INTERVAL
+# seconds by a background thread; requests never wait on NewsAPI once warm
+NEWS_FEED = NewsFeed(
+    lambda params: fetch_news_html(params),
+    refresh_interval=float(os.environ.get("NEWS_REFRESH_INTERVAL", 600)),
+)
+NEWS_DEFAULT_PARAMS = {"country": "us", "pageSize": 5}
+
+# Uploaded images are downsized to IMAGE_MAX_EDGE px on the long side and
+# re-encoded to fit IMAGE_MAX_BYTES before they are sent to Gemini
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", 1536))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 1024 * 1024))
+# Largest file /ask/image accepts (the browser enforces the same 10 MB)
+IMAGE_UPLOAD_MAX_BYTES = int(os.environ.get("IMAGE_UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+# Room for the multipart boundaries and the command field around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+# /ask/batch: at most BATCH_MAX_ITEMS per request, BATCH_PARALLELISM of them
+# in flight per batch (clients may ask for fewer) and BATCH_WORKERS in total
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", 4))
+BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BATCH_WORKERS", 16)), thread_name_prefix="batch"
+)
+
+# Conversations for requests that send a session_id: recent turns verbatim,
+# older ones summarized to stay under SESSION_TOKEN_BUDGET, and long settled
+# prefixes kept upstream as Gemini context caches (SESSION_DB to share them)
+SESSIONS = SessionStore.from_env(
+    summarize=lambda summary, turns: summarize_session(summary, turns),
+    create_cache=lambda body: create_context_cache(body),
+    delete_cache=lambda name: delete_context_cache(name),
+)
+
+# Finished image analyses by image content + prompt, up to IMAGE_CACHE_BYTES
+IMAGE_CACHE = ImageAnalysisCache.from_env()
+
+# Markdown rendering, analysis formatting and image resizing run in
+# CPU_POOL_WORKERS separate processes (default 0 = all inline; the processes
+# start on the first task) once their input reaches these sizes; smaller work
+# isn't worth the trip
+CPU_POOL = CpuPool.from_env(
+    on_run=lambda task, where, seconds, queued: observe_cpu_task(task, where, seconds, queued),
+    on_depth=lambda depth: CPU_POOL_PENDING.set(depth),
+)
+MARKDOWN_OFFLOAD_CHARS = int(os.environ.get("MARKDOWN_OFFLOAD_CHARS", 4000))
+ANALYSIS_OFFLOAD_CHARS = int(os.environ.get("ANALYSIS_OFFLOAD_CHARS", 32000))
+IMAGE_OFFLOAD_BYTES = int(os.environ.get("IMAGE_OFFLOAD_BYTES", 256 * 1024))
+
+# Raw Gemini exchanges are kept in memory only when sampled: set
+# DEBUG_CAPTURE_RATE (0-1) to enable and DEBUG_CAPTURE_TOKEN to read them
+DEBUG_CAPTURE = DebugCapture.from_env()
+DEBUG_CAPTURE_TOKEN = os.environ.get("DEBUG_CAPTURE_TOKEN", "")
+
+# =========== METRICS ===========
+# Exported on /metrics. Spans: route, gemini_text, gemini_stream,
+# gemini_vision, image_preprocess, weather, news, markdown, json
+METRICS = Registry(prefix="ibnsina_")
+SPAN_SECONDS = METRICS.histogram("span_seconds", "Time spent in each stage of a request", ["span"])
+HTTP_SECONDS = METRICS.histogram("http_request_duration_seconds", "Time to response headers", ["endpoint", "method"])
+HTTP_REQUESTS = METRICS.counter("http_requests_total", "Responses by status", ["endpoint", "method", "status"])
+HTTP_REQUEST_BYTES = METRICS.histogram("http_request_bytes", "Request body size", ["endpoint"], SIZE_BUCKETS)
+HTTP_RESPONSE_BYTES = METRICS.histogram("http_response_bytes", "Response body size (unstreamed)", ["endpoint"], SIZE_BUCKETS)
+UPSTREAM_BYTES = METRICS.histogram("upstream_bytes", "Upstream body sizes", ["upstream", "direction"], SIZE_BUCKETS)
+GEMINI_FINISH_REASONS = METRICS.counter("gemini_finish_reasons_total", "Gemini finishReason values", ["reason", "mode"])
+GEMINI_TOKENS = METRICS.counter("gemini_tokens_total", "Tokens from Gemini usageMetadata (cached: read from a context cache)", ["kind"])
+IMAGE_PREPROCESS = METRICS.counter("image_preprocess_total", "Uploaded images by preprocessing outcome", ["outcome"])
+IMAGE_UPLOAD_BYTES = METRICS.histogram("image_upload_bytes", "Image size as received and as sent to Gemini, in base64 bytes", ["stage", "transport"], SIZE_BUCKETS)
+IMAGE_BYTES_SAVED = METRICS.counter("image_upload_bytes_saved_total", "Received image bytes not forwarded to Gemini", ["transport"])
+CPU_TASK_SECONDS = METRICS.histogram("cpu_task_seconds", "CPU-bound task execution time", ["task", "where"])
+CPU_QUEUE_SECONDS = METRICS.histogram("cpu_pool_queue_seconds", "Wait for a CPU pool worker", ["task"])
+CPU_POOL_PENDING = METRICS.gauge("cpu_pool_pending", "Tasks submitted to the CPU pool and not yet finished")
+GEMINI_QUEUE_SECONDS = METRICS.histogram("gemini_queue_seconds", "Wait for a Gemini concurrency slot", ["mode"])
+GEMINI_IN_FLIGHT = METRICS.gauge("gemini_in_flight", "Gemini calls holding a concurrency slot")
+GEMINI_QUEUE_DEPTH = METRICS.gauge("gemini_queue_depth", "Calls waiting for a Gemini concurrency slot")
+ADMISSION_REJECTIONS = METRICS.counter("admission_rejections_total", "Requests refused by admission control", ["reason"])
+GEMINI_HEDGES = METRICS.counter("gemini_hedges_total", "Backup generateContent calls: sent, then won or lost", ["outcome"])
+GEMINI_PROMPT_TOKENS = METRICS.histogram("gemini_prompt_tokens_estimated", "Prompt size estimated before sending, by generation profile", ["profile"], TOKEN_BUCKETS)
+GEMINI_PROMPTS_TRIMMED = METRICS.counter("gemini_prompts_trimmed_total", "Prompts cut down to their profile's max_prompt_tokens", ["profile"])
+
+
+def span(name):
+    return timed(SPAN_SECONDS, span=name)
+
+
+def observe_upstream(name, response, streamed=False):
+    """Record the body sizes of one upstream exchange (requests or httpx response)"""
+    # From the header: streamed request bodies can't be measured after sending
+    sent = int(response.request.headers.get("Content-Length") or 0)
+    UPSTREAM_BYTES.observe(sent, upstream=name, direction="sent")
+    if not streamed:
+        UPSTREAM_BYTES.observe(len(response.content), upstream=name, direction="received")
+
+
+def observe_gate_depth(active, waiting):
+    GEMINI_IN_FLIGHT.set(active)
+    GEMINI_QUEUE_DEPTH.set(waiting)
+
+
+def observe_cpu_task(task, where, seconds, queued):
+    CPU_TASK_SECONDS.observe(seconds, task=task, where=where)
+    if where == "pool":
+        CPU_QUEUE_SECONDS.observe(queued, task=task)
 
 # =========== REST OF YOUR CODE REMAINS THE SAME ===========
-# City coordinates mapping
-CITY_COORDINATES = {
-    "dhaka": (23.8103, 90.4125),
-    "london": (51.5074, -0.1278),
-    "new york": (40.7128, -74.0060),
-    "tokyo": (35.6762, 139.6503),
-    "paris": (48.8566, 2.3522),
-    "delhi": (28.7041, 77.1025),
-    "mumbai": (19.0760, 72.8777),
-    "sydney": (-33.8688, 151.2093),
-    "dubai": (25.2048, 55.2708),
-    "singapore": (1.3521, 103.8198),
-    "naogaon": (24.8, 88.9),
-    "rajshahi": (24.3745, 88.6042),
-    "chittagong": (22.3569, 91.7832),
-    "khulna": (22.8456, 89.5403),
-}
+# Place names for weather queries come from the gazetteer (gazetteer.py,
+# data/gazetteer.tsv); reports default to Naogaon
+DEFAULT_WEATHER_LOCATION = (24.8, 88.9, "Naogaon")
 
 # APP PATHS (these won't work on Fly.io - consider removing or modifying)
 APP_PATHS = {
@@ -109,26 +495,34 @@ APP_PATHS = {
     "spotify": r"C:\Users\ibnsi\AppData\Roaming\Spotify\Spotify.exe",
 }
 
-# TTS Engine initialization (will only work locally)
-# TTS Engine - conditional initialization
-engine = None
-if TTS_AVAILABLE:
-    try:
-        engine = pyttsx3.init()
-        engine.setProperty("rate", 170)
-        if len(engine.getProperty('voices')) > 1:
-            engine.setProperty('voice', engine.getProperty('voices')[1].id)
-    except Exception as e:
-        engine = None
-        print(f"⚠️ Failed to initialize TTS: {e}")
-else:
-    print("⚠️ TTS not available (pyttsx3 not installed)")
+# TTS engine (only works locally): created on first use, not at startup
+_speech_engine = None
+
+
+def speech_engine():
+    """The pyttsx3 engine, or None where TTS is unavailable"""
+    global _speech_engine
+    if _speech_engine is None:
+        try:
+            import pyttsx3
+            engine = pyttsx3.init()
+            engine.setProperty("rate", 170)
+            if len(engine.getProperty('voices')) > 1:
+                engine.setProperty('voice', engine.getProperty('voices')[1].id)
+        except Exception as e:  # ImportError on the server
+            engine = False
+            log.warning("TTS not available: %s", e)
+        _speech_engine = engine
+    return _speech_engine or None
 @app.route('/ask', methods=['POST'])
 def ask():
     data = request.json
     command = data.get('command', '').strip()
     image_base64 = data.get('image', None)
     image_type = data.get('image_type', 'image/jpeg')
+    error = image_fields_error(image_base64, image_type)
+    if error:
+        return jsonify({"error": error, "type": "image"}), 400
     
     # Debug logging
     print(f"\n{'='*50}")
@@ -144,7 +538,8 @@ def ask():
         try:
             print("Processing image analysis...")
             # Use Gemini 2.5 Flash for image analysis
-            result = analyze_image_with_gemini(command, image_base64, image_type)
+            with IMAGE_CACHE.scoped(client_key(request.headers, request.remote_addr)):
+                result = analyze_image_with_gemini(command, image_base64, image_type)
             
             if result['success']:
                 print(f"Image analysis successful, response length: {len(result['response'])}")
@@ -161,6 +556,8 @@ def ask():
                     "type": "image"
                 })
                 
+        except REFUSALS:
+            raise
         except Exception as e:
             print(f"Image analysis error: {str(e)}")
             import traceback
@@ -178,17 +575,303 @@ def ask():
             "type": "text"
         })
     
+    session_id, error = requested_session(data)
+    if error:
+        return jsonify({"error": error, "type": "text"}), 400
+
     print(f"Processing text command: {command}")
-    response = perform_task_web(command)
+    with SESSIONS.active(session_id), ASK_CACHE.bypassing(wants_fresh_response(data)):
+        response = perform_task_web(command)
     
     print(f"Response generated, length: {len(response)}")
     print(f"First 200 chars: {response[:200]}...")
     print(f"{'='*50}\n")
     
-    return jsonify({
+    reply = {
         "response": response,
         "type": "text"
+    }
+    if session_id:
+        reply["session_id"] = session_id
+    return jsonify(reply)
+@app.route('/ask/image', methods=['POST'])
+def ask_image():
+    """Image analysis from a multipart upload (fields: image, command) or a raw
+    image body (Content-Type: image/*, ?command=...), without base64 or JSON"""
+    length = request.content_length
+    if length is not None and length > IMAGE_UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD:
+        # Refuse before reading a byte of the body
+        return jsonify({"error": "Image is too large.", "type": "image"}), 413
+
+    if request.mimetype == "multipart/form-data":
+        if length is None:
+            return jsonify({"error": "Content-Length required.", "type": "image"}), 411
+        # Werkzeug spools file parts to a temp file as it parses
+        upload = request.files.get("image")
+        if upload is None:
+            return jsonify({"error": "No image provided.", "type": "image"}), 400
+        command = request.form.get("command", "").strip()
+        image_type = upload.mimetype or "image/jpeg"
+        image = upload.stream
+        transport = "multipart"
+    elif request.mimetype.startswith("image/"):
+        command = request.args.get("command", "").strip()
+        image_type = request.mimetype
+        try:
+            image = spool_upload(request.stream, IMAGE_UPLOAD_MAX_BYTES)
+        except UploadTooLarge:
+            return jsonify({"error": "Image is too large.", "type": "image"}), 413
+        transport = "raw"
+    else:
+        return jsonify({"error": "Send multipart/form-data or an image/* body.", "type": "image"}), 415
+
+    try:
+        if image.seek(0, io.SEEK_END) == 0:
+            return jsonify({"error": "No image provided.", "type": "image"}), 400
+        image.seek(0)
+        with IMAGE_CACHE.scoped(client_key(request.headers, request.remote_addr)):
+            result = analyze_image_with_gemini(command, image, image_type, transport)
+    finally:
+        image.close()
+
+    return jsonify({
+        "response": result['response'],
+        "analysis": result['analysis'] if result['success'] else "",
+        "type": "image"
     })
+def wants_fresh_response(data):
+    """Per-request cache bypass: {"no_cache": true} or Cache-Control: no-cache"""
+    return bool(data.get('no_cache')) or 'no-cache' in request.headers.get('Cache-Control', '')
+
+
+def requested_session(data):
+    """(session_id or None, error message or None) from a request body"""
+    session_id = data.get('session_id') or None
+    if session_id is not None and not SESSIONS.valid_id(session_id):
+        return None, "session_id must be 8-64 letters, digits, '-' or '_'."
+    return session_id, None
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    """Text commands as Server-Sent Events: HTML fragments as Gemini produces them"""
+    data = request.json or {}
+    command = data.get('command', '').strip()
+    if not command:
+        return jsonify({
+            "error": "No command provided. Please type something.",
+            "type": "text"
+        })
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    session_id, error = requested_session(data)
+    if error:
+        return jsonify({"error": error, "type": "text"}), 400
+    fresh = wants_fresh_response(data)
+
+    def generate():
+        # Open the stream right away so the client sees the first byte immediately
+        yield sse("start", {"type": "text"})
+        request_for = ai_prompt_for(command)
+        if request_for is None:
+            # Local intents (time, jokes, weather...) answer in one piece
+            yield sse("chunk", {"html": perform_task_web(command)})
+            yield sse("done", {"finish_reason": "OK"})
+            return
+        prompt, profile = request_for
+
+        # Replies in a conversation depend on it, so they skip ASK_CACHE; a
+        # session's first question doesn't
+        cache_key = ask_cache_key(prompt, profile) if shareable(session_id) else None
+        with ASK_CACHE.bypassing(fresh):
+            cached = ASK_CACHE.get(cache_key, with_reply=True) if cache_key else None
+        if cached is not None and (cached[1] or not session_id):
+            record_turn(session_id, prompt, cached[1])
+            yield sse("chunk", {"html": cached[0]})
+            yield sse("done", {"finish_reason": "STOP", "cached": True})
+            return
+
+        finish_flight = ASK_FLIGHT.begin(cache_key) if cache_key else None
+        if cache_key and finish_flight is None:
+            # The same reply is already being generated: wait for it, send it whole
+            yield from shared_stream_reply(prompt, session_id, profile, sse)
+            return
+
+        fragments = []
+        shared = None
+        try:
+            for event, value in stream_ai(prompt, session_id, profile):
+                if event == "chunk":
+                    fragments.append(value)
+                    yield sse("chunk", {"html": value})
+                elif event == "reply":
+                    shared = ("\n".join(fragments), value)
+                elif event == "done":
+                    if cache_key and value in CACHEABLE_FINISH_REASONS:
+                        ASK_CACHE.set(cache_key, *shared)
+                    yield sse("done", {"finish_reason": value})
+                elif event == "overloaded":
+                    # Too late for a 503: the stream is already open
+                    yield sse("error", {"error": str(value), "retry_after": value.retry_after})
+                else:
+                    yield sse("error", {"error": value})
+        finally:
+            # Also when the client went away: waiting requests then try themselves
+            if finish_flight:
+                finish_flight(shared)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def shared_stream_reply(prompt, session_id, profile, sse):
+    """SSE events for a stream that joins an identical call in flight (ASK_FLIGHT)"""
+    try:
+        payload, cache_key = ai_request(prompt, session_id, profile)
+        html, reply = ASK_FLIGHT.do(flight_key(payload, cache_key),
+                                    lambda: generate_reply(prompt, payload, cache_key, profile))
+    except Overloaded as e:
+        yield sse("error", {"error": str(e), "retry_after": e.retry_after})
+        return
+    except Exception as e:
+        yield sse("error", {"error": f"Error: {e}"})
+        return
+    if reply is None:
+        yield sse("error", {"error": html})
+        return
+    record_turn(session_id, prompt, reply)
+    yield sse("chunk", {"html": html})
+    yield sse("done", {"finish_reason": "STOP", "coalesced": True})
+
+
+def image_fields_error(image, image_type):
+    """Why an /ask body's image fields can't be used, or None: the image is
+    base64 text and its type a MIME type string"""
+    if image is None:
+        return None
+    if not isinstance(image, str):
+        return "image must be a base64 string."
+    if not isinstance(image_type, str):
+        return "image_type must be a string such as image/png."
+    return None
+
+
+def parse_batch(data):
+    """(items, parallelism, error) from an /ask/batch body; error is (message, status) or None"""
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, 0, ("Send {\"items\": [{\"command\": ...}, ...]}.", 400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, 0, (f"At most {BATCH_MAX_ITEMS} items per batch.", 413)
+    if not all(isinstance(item, dict) for item in items):
+        return None, 0, ("Every item must be an object.", 400)
+    for index, item in enumerate(items):
+        error = image_fields_error(item.get("image"), item.get("image_type", "image/jpeg"))
+        if error:
+            return None, 0, (f"Item {index}: {error}", 400)
+    try:
+        parallelism = int(data.get("parallelism") or BATCH_PARALLELISM)
+    except (TypeError, ValueError):
+        parallelism = BATCH_PARALLELISM
+    return items, max(1, min(parallelism, BATCH_PARALLELISM)), None
+
+
+def batch_item_result(index, item, result=None, error=None):
+    """One /ask/batch result: the /ask response fields plus index and ok"""
+    kind = "image" if item.get("image") else "text"
+    if error is not None:
+        log.warning("Batch item %d failed: %s", index, error)
+        result = {"index": index, "ok": False, "error": str(error)[:200], "type": kind}
+        if isinstance(error, Overloaded):
+            result["retry_after"] = error.retry_after
+        return result
+    if kind == "image":
+        return {
+            "index": index,
+            "ok": result["success"],
+            "response": result["response"],
+            "analysis": result["analysis"] if result["success"] else "",
+            "type": kind,
+        }
+    return {"index": index, "ok": True, "response": result, "type": kind}
+
+
+def answer_batch_item(index, item):
+    """One batch item through the same code as /ask; failures stay in the item"""
+    command = (item.get("command") or "").strip()
+    try:
+        if item.get("image"):
+            result = analyze_image_with_gemini(command, item["image"], item.get("image_type", "image/jpeg"))
+        elif command:
+            result = perform_task_web(command)
+        else:
+            return batch_item_result(index, item, error="No command provided.")
+    except Exception as e:
+        return batch_item_result(index, item, error=e)
+    return batch_item_result(index, item, result)
+
+
+def run_batch(items, parallelism):
+    """Yield item results as they finish, with at most ``parallelism`` running"""
+    # Each item gets a copy of this context, so ASK_CACHE.bypassing() and
+    # IMAGE_CACHE.scoped() reach it
+    context = contextvars.copy_context()
+    queued = iter(enumerate(items))
+    running = set()
+    try:
+        while True:
+            for index, item in queued:
+                running.add(BATCH_EXECUTOR.submit(context.copy().run, answer_batch_item, index, item))
+                if len(running) >= parallelism:
+                    break
+            if not running:
+                return
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # The client went away mid-stream: don't start what is still queued
+        for future in running:
+            future.cancel()
+
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_batch():
+    """Several /ask items in one request, answered concurrently
+
+    Body: {"items": [{"command", "image", "image_type"}, ...], "parallelism",
+    "stream", "no_cache"}. Results come back in item order, or with
+    "stream": true as NDJSON lines in completion order, each with its index.
+    """
+    data = request.get_json(silent=True) or {}
+    items, parallelism, error = parse_batch(data)
+    if error:
+        return jsonify({"error": error[0], "type": "batch"}), error[1]
+    # Not in RATE_LIMITED_ROUTES: every item is a Gemini call, and pays like one
+    retry_after = RATE_LIMITER.check(client_key(request.headers, request.remote_addr), cost=len(items))
+    if retry_after:
+        return too_many_requests(retry_after)
+    fresh = wants_fresh_response(data)
+    scope = client_key(request.headers, request.remote_addr)
+    log.info("Batch of %d items, %d at a time", len(items), parallelism)
+
+    if data.get("stream"):
+        def generate():
+            with ASK_CACHE.bypassing(fresh), IMAGE_CACHE.scoped(scope):
+                for result in run_batch(items, parallelism):
+                    yield json.dumps(result) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    results = [None] * len(items)
+    with ASK_CACHE.bypassing(fresh), IMAGE_CACHE.scoped(scope):
+        for result in run_batch(items, parallelism):
+            results[result["index"]] = result
+    return jsonify({"results": results, "type": "batch"})
 @app.route('/voice', methods=['POST'])
 def voice_command():
     """Simple voice command endpoint - now uses the same as text"""
@@ -197,9 +880,13 @@ def voice_command():
         return jsonify({"error": "No speech text provided"})
     
     text = data.get('text', '').strip()
+    session_id, error = requested_session(data)
+    if error:
+        return jsonify({"error": error}), 400
     
     # Process the command (same as text command)
-    response = perform_task_web(text)
+    with SESSIONS.active(session_id), ASK_CACHE.bypassing(wants_fresh_response(data)):
+        response = perform_task_web(text)
     
     return jsonify({
         "text": text,
@@ -207,6 +894,26 @@ def voice_command():
         "type": "voice"
     })
 
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """A new session id to send as session_id with /ask, /ask/stream and /voice"""
+    return jsonify({"session_id": secrets.token_urlsafe(16)})
+@app.route('/sessions/<session_id>', methods=['GET', 'DELETE'])
+def session_detail(session_id):
+    """A session's summary and kept turns, or forget it (DELETE)"""
+    if request.method == 'DELETE':
+        return jsonify({"deleted": SESSIONS.delete(session_id)})
+    session = SESSIONS.get(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    return jsonify({
+        "session_id": session_id,
+        "summary": session["summary"],
+        "turns": [{"role": turn["role"], "text": turn["text"]} for turn in session["turns"]],
+        "tokens": sum(turn["tokens"] for turn in session["turns"]),
+        "cached": session["cache"] is not None,
+    })
+
 @app.route('/weather/<city>', methods=['GET'])
 def weather_by_city(city):
     """Get weather for specific city"""
@@ -215,8 +922,15 @@ def weather_by_city(city):
 
 @app.route('/quick-action/<action>', methods=['POST'])
 def quick_action(action):
+    options = request.get_json(silent=True)
+    if not isinstance(options, dict):
+        options = {}
     actions = {
-        'news': get_top_news,
+        'news': lambda: get_top_news(
+            country=options.get('country', 'us'),
+            category=options.get('category'),
+            page_size=options.get('page_size', 5),
+        ),
         'weather': lambda: get_weather_by_city("naogaon")["message"],
         'time': get_current_time,
         'joke': tell_joke,
@@ -230,8 +944,173 @@ def quick_action(action):
 
 # =========== AI FUNCTIONS ===========
 # =========== AI FUNCTIONS ===========
-def ask_ai(prompt: str):
-    """Use Gemini for responses (Markdown → HTML)"""
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+MARKDOWN_EXTENSIONS = ["fenced_code", "codehilite", "tables", "nl2br"]
+# Per-thread Markdown instances plus the HTML of the last MARKDOWN_CACHE_SIZE renders
+RENDERER = MarkdownRenderer(MARKDOWN_EXTENSIONS, cache_size=int(os.environ.get("MARKDOWN_CACHE_SIZE", 512)))
+
+
+def build_ai_payload(prompt: str, session_parts=None, profile="chat"):
+    """Request body shared by generateContent and streamGenerateContent
+
+    ``session_parts`` (from SESSIONS.request_parts) replaces the contents
+    with the conversation so far; ``profile`` names the GENERATION profile
+    whose generationConfig is used.
+    """
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": GENERATION[profile].generation_config(),
+        "safetySettings": SAFETY_SETTINGS,
+    }
+    if session_parts:
+        payload.update(session_parts)
+    return payload
+
+
+def shareable(session_id):
+    """True if a reply in ``session_id`` (None: no session) may come from,
+    and go to, ASK_CACHE: no session, or one without history yet"""
+    return not (session_id and SESSIONS.has_history(session_id))
+
+
+def ask_cache_key(prompt: str, profile="chat"):
+    """ASK_CACHE key of a stateless prompt: the prompt as sent, the model and generationConfig"""
+    settings = GENERATION[profile]
+    return ASK_CACHE.key(settings.fit(prompt)[0], {"model": settings.model, **settings.generation_config()})
+
+
+def ai_request(prompt: str, session_id=None, profile="chat"):
+    """(payload, ASK_CACHE key) for a prompt; in a session with history
+    (``session_id`` or the active one) the key is None, since the answer
+    depends on the conversation
+
+    A session's first question is sent as if there were no session, so it
+    is answered from ASK_CACHE and coalesced like any other. The prompt is
+    cut to the profile's max_prompt_tokens, and so is the history sent with it.
+    """
+    settings = GENERATION[profile]
+    fitted, trimmed = settings.fit(prompt)
+    if trimmed:
+        GEMINI_PROMPTS_TRIMMED.inc(profile=profile)
+    session_id = session_id or SESSIONS.current
+    if not shareable(session_id):
+        # Context caches belong to MODEL; other models get the turns themselves
+        parts = SESSIONS.request_parts(session_id, fitted, token_budget=settings.max_prompt_tokens,
+                                       use_cache=settings.model == MODEL)
+        payload, cache_key = build_ai_payload(fitted, parts, profile), None
+    else:
+        payload, cache_key = build_ai_payload(fitted, profile=profile), ask_cache_key(prompt, profile)
+    GEMINI_PROMPT_TOKENS.observe(payload_tokens(payload), profile=profile)
+    return payload, cache_key
+
+
+def payload_tokens(payload):
+    """Estimated prompt tokens of a payload (a cachedContent it names not included)"""
+    texts = [part.get("text", "") for content in payload["contents"] for part in content["parts"]]
+    texts += [part.get("text", "") for part in payload.get("systemInstruction", {}).get("parts", [])]
+    return sum(estimate_tokens(text) for text in texts)
+
+
+def record_turn(session_id, prompt, reply, usage=None):
+    """Add a question and the Markdown reply to ``session_id``, if any"""
+    if session_id and prompt and reply:
+        SESSIONS.record(session_id, prompt, reply, usage)
+
+
+def session_cache_gone(response, payload, session_id=None):
+    """True if Gemini refused the session's context cache (expired or evicted);
+    the session stops using it, so rebuilding the payload sends the turns instead"""
+    name = payload.get("cachedContent")
+    if not name or response.status_code not in (400, 403, 404):
+        return False
+    log.warning("Context cache %s unavailable (%d), resending history", name, response.status_code)
+    SESSIONS.cache_missing(session_id or SESSIONS.current, name)
+    return True
+
+
+def record_usage(usage):
+    """Count the tokens of one Gemini response"""
+    GEMINI_TOKENS.inc(usage.get("promptTokenCount", 0), kind="prompt")
+    GEMINI_TOKENS.inc(usage.get("cachedContentTokenCount", 0), kind="cached")
+    GEMINI_TOKENS.inc(usage.get("candidatesTokenCount", 0), kind="output")
+
+
+def gemini_text(data):
+    parts = (data.get("candidates") or [{}])[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+SUMMARY_PROMPT = """Update the summary of a conversation between a user and an AI assistant.
+Keep names, numbers, decisions, code identifiers, preferences and open
+questions; drop pleasantries. Write plain prose under 250 words, no preamble.
+
+Summary so far:
+{summary}
+
+New turns:
+{transcript}"""
+
+
+def summarize_session(summary, turns):
+    """Fold ``turns`` into ``summary`` (runs on the session store's background thread)"""
+    transcript = "\n\n".join(
+        f"{'User' if turn['role'] == 'user' else 'Assistant'}: {turn['text']}" for turn in turns
+    )
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", transcript=transcript)
+    settings = GENERATION["summary"]
+    with GEMINI_GATE.slot("summary"):
+        r = UPSTREAM.post(gemini_url(settings.model), headers={"Content-Type": "application/json"},
+                          json=build_ai_payload(settings.fit(prompt)[0], profile="summary"), timeout=120)
+    if r.status_code != 200:
+        raise RuntimeError(f"API Error {r.status_code}")
+    data = r.json()
+    record_usage(data.get("usageMetadata", {}))
+    return gemini_text(data)
+
+
+def create_context_cache(body):
+    """Create a Gemini cachedContents resource; returns its name ("cachedContents/...")"""
+    r = UPSTREAM.post(f"{CACHE_API_URL}?key={API_KEY}", headers={"Content-Type": "application/json"},
+                      json={"model": f"models/{MODEL}", **body}, timeout=60)
+    if r.status_code != 200:
+        raise RuntimeError(f"API Error {r.status_code}: {r.text[:200]}")
+    return r.json().get("name")
+
+
+def delete_context_cache(name):
+    r = UPSTREAM.request("DELETE", f"{GEMINI_API_BASE}/{name}?key={API_KEY}", timeout=30)
+    if r.status_code not in (200, 404):
+        raise RuntimeError(f"API Error {r.status_code}")
+
+
+def offload_markdown(text):
+    """Long texts in a pool worker; the rest on RENDERER's own instances"""
+    return CPU_POOL.run("markdown", render_markdown, text, MARKDOWN_EXTENSIONS,
+                        size=len(text), threshold=MARKDOWN_OFFLOAD_CHARS,
+                        inline=lambda text, _extensions: RENDERER.convert(text))
+
+
+def render_reply(reply: str) -> str:
+    """Balance code fences and convert Markdown → HTML"""
+    # Auto-close unfinished code blocks
+    reply = fix_code_blocks(reply)
+
+    try:
+        with span("markdown"):
+            return RENDERER.render(reply.strip(), convert=offload_markdown)
+    except Exception:
+        # fallback: plain text
+        return f"<pre>{reply}</pre>"
+
+
+def ask_ai(prompt: str, profile="chat"):
+    """Use Gemini for responses (Markdown → HTML), with a GENERATION profile"""
 
     try:
         print("\n" + "="*60)
@@ -240,85 +1119,105 @@ def ask_ai(prompt: str):
         print("Preview:", prompt[:200])
         print("="*60)
 
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.7,
-                
-                "topP": 0.95,
-                "topK": 40
-            },
-            "safetySettings": [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ],
-        }
+        payload, cache_key = ai_request(prompt, profile=profile)
+        if not cache_key:
+            return ASK_FLIGHT.do(flight_key(payload, cache_key),
+                                 lambda: generate_reply(prompt, payload, cache_key, profile))[0]
 
-        r = requests.post(
-            API_URL,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=180
-        )
+        # A reply anyone may share; the caller's session (first turn) records it
+        cached = ASK_CACHE.get(cache_key, with_reply=True)
+        if cached is not None and (cached[1] or not SESSIONS.current):
+            log.debug("Response cache hit")
+            html, reply = cached
+        else:
+            html, reply = ASK_FLIGHT.do(flight_key(payload, cache_key),
+                                        lambda: generate_reply(prompt, payload, cache_key, profile))
+        record_turn(SESSIONS.current, prompt, reply)
+        return html
 
-        print("API status:", r.status_code)
+    except REFUSALS:
+        raise  # answered with 503 / 504 by the route
+    except Exception as e:
+        print("Exception:", e)
+        traceback.print_exc()
+        return f"Error: {e}"
 
-        if r.status_code != 200:
-            print("Error body:", r.text[:500])
-            return f"API Error {r.status_code}"
 
-        data = r.json()
+def flight_key(payload, cache_key):
+    """What makes two ask_ai calls identical: the ASK_CACHE key (normalized
+    prompt + generationConfig) or, in a session, the session and full payload"""
+    if cache_key:
+        return cache_key
+    material = json.dumps([SESSIONS.current, payload], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
 
-        # Save raw json
-        with open("raw_gemini_response.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
 
-        # Extract content safely
-        candidates = data.get("candidates", [])
-        if not candidates:
-            return "⚠️ Empty response."
+def generate_reply(prompt, payload, cache_key, profile="chat"):
+    """One generateContent call: (html, Markdown reply or None on failure),
+    shared by coalesced callers"""
+    model = GENERATION[profile].model
+    # Queue time goes to gemini_queue_seconds, not to the gemini_text span
+    with GEMINI_GATE.slot("text"), span("gemini_text"):
+        r = post_generate(payload, model)
+        if r.status_code != 200 and session_cache_gone(r, payload):
+            payload, cache_key = ai_request(prompt, profile=profile)
+            r = post_generate(payload, model)
+    observe_upstream("gemini_text", r)
 
-        content = candidates[0].get("content", {})
-        parts = content.get("parts", [])
-        if not parts:
-            return "⚠️ No content generated."
+    print("API status:", r.status_code)
 
-        reply = parts[0].get("text", "") or ""
+    if r.status_code != 200:
+        print("Error body:", r.text[:500])
+        return f"API Error {r.status_code}", None
 
-        finish = candidates[0].get("finishReason", "OK")
-        print("Finish reason:", finish)
-        print("Reply length:", len(reply))
+    return handle_ai_response(r.json(), cache_key, prompt)
 
-        # Save raw text
-        with open("raw_reply.txt", "w", encoding="utf-8") as f:
-            f.write(reply)
 
-        # Auto-close unfinished code blocks
-        reply = fix_code_blocks(reply)
+def post_generate(payload, model=MODEL):
+    """generateContent, hedged by GEMINI_HEDGER; timeouts shrink to the request's deadline"""
+    url = gemini_url(model)
+    return GEMINI_HEDGER.call(
+        lambda: UPSTREAM.post(url, headers={"Content-Type": "application/json"}, json=payload, timeout=180),
+        admit=GEMINI_GATE.try_acquire,
+        release=GEMINI_GATE.release,
+    )
 
-        # Convert Markdown → HTML
-        try:
-            html = markdown.markdown(
-                reply.strip(),
-                extensions=[
-                    "fenced_code",
-                    "codehilite",
-                    "tables",
-                    "nl2br",
-                ]
-            )
-        except Exception:
-            # fallback: plain text
-            html = f"<pre>{reply}</pre>"
 
-        return html
+def handle_ai_response(data, cache_key, prompt=None):
+    """Extract, render and cache the reply of a generateContent response:
+    (html, Markdown reply or None)
 
-    except Exception as e:
-        print("Exception:", e)
-        traceback.print_exc()
-        return f"Error: {e}"
+    Only a session's own (uncached) question is recorded here; a reply
+    that can be shared is recorded by each caller, in its own session.
+    """
+    DEBUG_CAPTURE.capture("generate", prompt=prompt, response=data)
+
+    # Extract content safely
+    candidates = data.get("candidates", [])
+    if not candidates:
+        return "⚠️ Empty response.", None
+
+    content = candidates[0].get("content", {})
+    parts = content.get("parts", [])
+    if not parts:
+        return "⚠️ No content generated.", None
+
+    reply = parts[0].get("text", "") or ""
+
+    finish = candidates[0].get("finishReason", "OK")
+    GEMINI_FINISH_REASONS.inc(reason=finish, mode="text")
+    usage = data.get("usageMetadata", {})
+    record_usage(usage)
+    print("Finish reason:", finish)
+    print("Reply length:", len(reply))
+
+    if not cache_key:
+        record_turn(SESSIONS.current, prompt, reply, usage)
+
+    html = render_reply(reply)
+    if cache_key and finish in CACHEABLE_FINISH_REASONS:
+        ASK_CACHE.set(cache_key, html, reply)
+    return html, reply
 def fix_code_blocks(text: str) -> str:
     # count code blocks
     blocks = text.count("```")
@@ -326,47 +1225,145 @@ def fix_code_blocks(text: str) -> str:
         text += "\n```"
     return text
 
-def analyze_image_with_gemini(prompt, image_base64, image_type="image/jpeg"):
-    """Analyze image using Gemini 2.5 Flash - SUPPORTS MULTIPLE FORMATS"""
-    
-    # Validate and normalize image type
-    supported_formats = {
-        'image/jpeg': 'JPEG',
-        'image/jpg': 'JPEG',
-        'image/png': 'PNG',
-        'image/gif': 'GIF',
-        'image/webp': 'WEBP',
-        'image/bmp': 'BMP'
-    }
-    
-    # Normalize image type
-    if image_type in supported_formats:
-        mime_type = image_type
-    else:
-        # Default to JPEG if unknown
-        mime_type = 'image/jpeg'
-        print(f"Warning: Unknown image type '{image_type}', defaulting to JPEG")
-    
-    headers = {"Content-Type": "application/json"}
-    
-    # Prepare content for Gemini
+
+class MarkdownStreamBuffer:
+    """Collect streamed Markdown and release it as rendered HTML, block by block.
+
+    Text is only released up to the last blank line that sits outside a
+    fenced code block, so every fragment is balanced on its own and a code
+    block is never split across fragments. Whatever is left is rendered by
+    flush() with the usual fix_code_blocks balancing.
+    """
+
+    def __init__(self, render=None):
+        self.pending = ""
+        self.render = render or render_reply
+
+    def _boundary(self):
+        pos = self.pending.rfind("\n\n")
+        while pos != -1:
+            if self.pending.count("```", 0, pos) % 2 == 0:
+                return pos + 2
+            pos = self.pending.rfind("\n\n", 0, pos)
+        return 0
+
+    def feed(self, text):
+        self.pending += text
+        cut = self._boundary()
+        if not cut:
+            return ""
+        block, self.pending = self.pending[:cut], self.pending[cut:]
+        return self.render(block) if block.strip() else ""
+
+    def flush(self):
+        block, self.pending = self.pending, ""
+        return self.render(block) if block.strip() else ""
+
+
+def stream_ai(prompt: str, session_id=None, profile="chat"):
+    """Stream a Gemini reply as ("chunk", html) events, then ("reply", the
+    whole Markdown text) and ("done", finish_reason)
+
+    Failures end it with ("error", message), or ("overloaded", Overloaded)
+    when admission control refused the call.
+    """
+    # Passed in rather than read per step: a generator may resume in another context
+    session_id = session_id or SESSIONS.current
+    buffer = MarkdownStreamBuffer()
+    finish = "OK"
+    texts = []
+    usage = {}
+    try:
+        payload = ai_request(prompt, session_id, profile)[0]
+        url = gemini_url(GENERATION[profile].model, stream=True)
+        # The connection stays busy until the last chunk, and so does the slot
+        with GEMINI_GATE.slot("stream"):
+            started = time.perf_counter()
+            r = UPSTREAM.post(url, headers={"Content-Type": "application/json"},
+                              json=payload, stream=True, timeout=180)
+            if r.status_code != 200 and session_cache_gone(r, payload, session_id):
+                r.close()
+                r = UPSTREAM.post(url, headers={"Content-Type": "application/json"},
+                                  json=ai_request(prompt, session_id, profile)[0], stream=True, timeout=180)
+            with r:
+                observe_upstream("gemini_stream", r, streamed=True)
+                if r.status_code != 200:
+                    log.warning("Stream error body: %s", r.text[:500])
+                    yield "error", f"API Error {r.status_code}"
+                    return
+
+                r.encoding = "utf-8"
+                for line in r.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[5:])
+                    usage = event.get("usageMetadata", usage)
+                    candidates = event.get("candidates", [])
+                    if not candidates:
+                        continue
+                    finish = candidates[0].get("finishReason", finish)
+                    parts = candidates[0].get("content", {}).get("parts", [])
+                    text = "".join(part.get("text", "") for part in parts)
+                    texts.append(text)
+                    html = buffer.feed(text)
+                    if html:
+                        yield "chunk", html
+
+        html = buffer.flush()
+        if html:
+            yield "chunk", html
+        DEBUG_CAPTURE.capture("stream", prompt=prompt, reply="".join(texts), finish_reason=finish)
+        # Includes the time the client took to read each chunk
+        SPAN_SECONDS.observe(time.perf_counter() - started, span="gemini_stream")
+        UPSTREAM_BYTES.observe(sum(len(t.encode("utf-8")) for t in texts), upstream="gemini_stream", direction="received")
+        GEMINI_FINISH_REASONS.inc(reason=finish, mode="stream")
+        record_usage(usage)
+        if session_id and texts:
+            SESSIONS.record(session_id, prompt, "".join(texts), usage)
+        yield "reply", "".join(texts)
+        yield "done", finish
+
+    except Overloaded as e:
+        yield "overloaded", e
+    except Exception as e:
+        log.exception("Stream failed")
+        yield "error", f"Error: {e}"
+
+SUPPORTED_IMAGE_FORMATS = {
+    'image/jpeg': 'JPEG',
+    'image/jpg': 'JPEG',
+    'image/png': 'PNG',
+    'image/gif': 'GIF',
+    'image/webp': 'WEBP',
+    'image/bmp': 'BMP'
+}
+
+
+def normalize_image_type(image_type):
+    """Validate and normalize image type"""
+    if image_type in SUPPORTED_IMAGE_FORMATS:
+        return image_type
+    # Default to JPEG if unknown
+    print(f"Warning: Unknown image type '{image_type}', defaulting to JPEG")
+    return 'image/jpeg'
+
+
+def build_image_payload(prompt, mime_type):
+    """Prepare content for Gemini (the image data is streamed in by build_image_body)"""
+    settings = GENERATION["image"]
+    prompt = settings.fit(prompt)[0] if prompt else prompt
     content = {
         "contents": [{
             "parts": [
                 {
                     "inline_data": {
                         "mime_type": mime_type,  # Use correct MIME type
-                        "data": image_base64
+                        "data": PLACEHOLDER
                     }
                 }
             ]
         }],
-        "generationConfig": {
-            "temperature": 0.4,
-            "maxOutputTokens": 4000,
-            "topP": 0.95,
-            "topK": 40
-        }
+        "generationConfig": settings.generation_config()
     }
     
     # Add text prompt
@@ -392,186 +1389,205 @@ Please provide:
 5. Overall interpretation
 6. Technical observations"""
         })
-    
-    try:
-        print(f"Sending image to Gemini - Type: {mime_type}, Size: {len(image_base64)} bytes")
-        
-        response = requests.post(API_URL, headers=headers, json=content, timeout=60)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if 'candidates' in result and result['candidates']:
-                analysis = result["candidates"][0]["content"]["parts"][0]["text"]
-                
-                # Format the analysis with image info
-                formatted_analysis = format_image_analysis_with_info(analysis, mime_type, len(image_base64))
-                
-                # Generate response
-                if prompt:
-                    response_text = f"I've analyzed your image regarding: '{prompt}'"
-                else:
-                    response_text = f"I've analyzed your {mime_type.split('/')[-1].upper()} image."
-                
-                return {
-                    "response": response_text,
-                    "analysis": formatted_analysis,
-                    "success": True
-                }
-        elif response.status_code == 429:
-            return {
-                "response": "I'm getting too many requests right now. Please try again in a moment.",
-                "analysis": "",
-                "success": False
-            }
-        elif response.status_code == 400:
-            # Check for specific Gemini errors
-            error_data = response.json()
-            error_msg = error_data.get('error', {}).get('message', 'Unknown error')
-            print(f"Gemini API error: {error_msg}")
+    return content
+
+
+def build_image_body(prompt, image, mime_type):
+    """Gemini vision request body, base64-encoding ``image`` (bytes, file or base64 str) as it is sent"""
+    return StreamingJSONBody(build_image_payload(prompt, mime_type), image)
+
+
+def handle_image_response(response, prompt, mime_type, image_size):
+    """Turn a Gemini vision response (requests or httpx) into the /ask result dict"""
+    observe_upstream("gemini_vision", response)
+    if response.status_code == 200:
+        result = response.json()
+        if 'candidates' in result and result['candidates']:
+            GEMINI_FINISH_REASONS.inc(reason=result["candidates"][0].get("finishReason", "OK"), mode="vision")
+            analysis = result["candidates"][0]["content"]["parts"][0]["text"]
             
-            if "image" in error_msg.lower() or "format" in error_msg.lower():
-                return {
-                    "response": "The image format might not be supported. Please try with JPG, PNG, or WebP format.",
-                    "analysis": "",
-                    "success": False
-                }
+            # Format the analysis with image info
+            formatted_analysis = CPU_POOL.run(
+                "image_format", format_image_analysis_with_info, analysis, mime_type, image_size,
+                size=len(analysis), threshold=ANALYSIS_OFFLOAD_CHARS,
+            )
+            
+            # Generate response
+            if prompt:
+                response_text = f"I've analyzed your image regarding: '{prompt}'"
+            else:
+                response_text = f"I've analyzed your {mime_type.split('/')[-1].upper()} image."
             
             return {
-                "response": f"API error: {error_msg[:100]}",
-                "analysis": "",
-                "success": False
+                "response": response_text,
+                "analysis": formatted_analysis,
+                "success": True
             }
-        else:
+    elif response.status_code == 429:
+        return {
+            "response": "I'm getting too many requests right now. Please try again in a moment.",
+            "analysis": "",
+            "success": False
+        }
+    elif response.status_code == 400:
+        # Check for specific Gemini errors
+        error_data = response.json()
+        error_msg = error_data.get('error', {}).get('message', 'Unknown error')
+        print(f"Gemini API error: {error_msg}")
+        
+        if "image" in error_msg.lower() or "format" in error_msg.lower():
             return {
-                "response": f"Image analysis service returned error code {response.status_code}",
+                "response": "The image format might not be supported. Please try with JPG, PNG, or WebP format.",
                 "analysis": "",
                 "success": False
             }
-            
-    except requests.exceptions.Timeout:
+        
         return {
-            "response": "Image analysis is taking too long. The image might be too large or complex.",
+            "response": f"API error: {error_msg[:100]}",
             "analysis": "",
             "success": False
         }
-    except Exception as e:
-        print(f"Gemini image analysis error: {str(e)}")
+    else:
         return {
-            "response": f"Sorry, I encountered an error while analyzing the image: {str(e)[:100]}",
+            "response": f"Image analysis service returned error code {response.status_code}",
             "analysis": "",
             "success": False
         }
 
-def format_image_analysis_with_info(text, image_type, image_size):
-    """Format analysis with image information"""
-    if not text:
-        return ""
-    
-    # Clean and format the text
-   
-    
-    # Add image info header
-    file_size_kb = image_size / 1024
-    format_name = image_type.split('/')[-1].upper()
-    
-    info_html = f"""
-    <div class="image-info-card">
-        <div class="image-info-header">
-            <i class="fas fa-file-image"></i>
-            <h4>Image Details</h4>
-        </div>
-        <div class="image-info-details">
-            <div><strong>Format:</strong> {format_name}</div>
-            <div><strong>Size:</strong> {file_size_kb:.1f} KB</div>
-            <div><strong>Type:</strong> {image_type}</div>
-        </div>
-    </div>
+
+def image_analysis_error(e):
+    """Result dict for an image request that never got a Gemini response"""
+    print(f"Gemini image analysis error: {str(e)}")
+    return {
+        "response": f"Sorry, I encountered an error while analyzing the image: {str(e)[:100]}",
+        "analysis": "",
+        "success": False
+    }
+
+
+IMAGE_TIMEOUT_RESULT = {
+    "response": "Image analysis is taking too long. The image might be too large or complex.",
+    "analysis": "",
+    "success": False
+}
+
+
+def start_image_analysis(prompt, image, image_type="image/jpeg", transport="json"):
+    """Cache lookups and preprocessing ahead of a vision call (sync and async paths)
+
+    Returns ``(result, None)`` on a cache hit, otherwise ``(None, pending)``
+    to send with ``pending["body"]`` and hand to finish_image_analysis().
     """
+    received = len(image) if isinstance(image, str) else None
+    if isinstance(image, str):
+        try:
+            image = base64.b64decode(image)
+        except ValueError:
+            pass  # sent on as it is, as before
+
+    # Exact bytes first: a repeat upload skips decoding altogether
+    digest = IMAGE_CACHE.digest(image)
+    cached = IMAGE_CACHE.get(prompt, digest)
+    if cached is None:
+        image, image_type, dhash = preprocess_image(image, image_type, transport, received)
+        cached = IMAGE_CACHE.get_similar(prompt, dhash)
+    if cached is not None:
+        log.debug("Image analysis cache hit")
+        return dict(cached), None
+
+    mime_type = normalize_image_type(image_type)
+    return None, {
+        "body": build_image_body(prompt, image, mime_type),
+        "mime_type": mime_type,
+        "digest": digest,
+        "dhash": dhash,
+    }
+
+
+def finish_image_analysis(response, prompt, pending):
+    """Format a vision response and cache it when it succeeded"""
+    result = handle_image_response(response, prompt, pending["mime_type"], pending["body"].value_length)
+    if result["success"]:
+        IMAGE_CACHE.set(prompt, pending["digest"], pending["dhash"], dict(result))
+    return result
+
+
+def analyze_image_with_gemini(prompt, image, image_type="image/jpeg", transport="json"):
+    """Analyze image using Gemini 2.5 Flash - SUPPORTS MULTIPLE FORMATS"""
+    cached, pending = start_image_analysis(prompt, image, image_type, transport)
+    if cached is not None:
+        return cached
+    body = pending["body"]
     
-    # Format the analysis text
-    lines = text.split('\n')
-    formatted_lines = []
-    in_list = False
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
-            if in_list:
-                formatted_lines.append('</ul>')
-                in_list = False
-            continue
-            
-        # Check for numbered or bullet points
-        if line.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.', '- ', '* ', '• ')):
-            if not in_list:
-                formatted_lines.append('<ul class="analysis-list">')
-                in_list = True
-            
-            # Remove the number/bullet
-            if line.startswith(tuple(str(i) + '.' for i in range(1, 10))):
-                line = line[line.find('.')+1:].strip()
-            else:
-                line = line[2:].strip() if len(line) > 2 else line
-            
-            formatted_lines.append(f'<li>{line}</li>')
-        else:
-            if in_list:
-                formatted_lines.append('</ul>')
-                in_list = False
+    try:
+        print(f"Sending image to Gemini - Type: {pending['mime_type']}, Size: {body.value_length} bytes")
+        
+        with GEMINI_GATE.slot("vision"), span("gemini_vision"):
+            response = UPSTREAM.post(gemini_url(GENERATION["image"].model), headers=body.headers, data=body, timeout=60)
+        return finish_image_analysis(response, prompt, pending)
             
-            # Check if it's a heading
-            if line.endswith(':') and len(line) < 50:
-                formatted_lines.append(f'<h4 class="analysis-heading">{line}</h4>')
-            else:
-                formatted_lines.append(f'<p class="analysis-paragraph">{line}</p>')
-    
-    if in_list:
-        formatted_lines.append('</ul>')
-    
-    return info_html + '<div class="analysis-content">' + ''.join(formatted_lines) + '</div>'
+    except requests.exceptions.Timeout:
+        return dict(IMAGE_TIMEOUT_RESULT)
+    except REFUSALS:
+        raise
+    except Exception as e:
+        return image_analysis_error(e)
 
 import html  # Add at top with other imports
 import re
 
 
-def compress_image_if_needed(image_base64, max_size_mb=10):
-    """Compress image if it's too large"""
+def preprocess_image(image, image_type, transport="json", received=None):
+    """Downsize an image for Gemini; returns (image, mime_type, dhash) for build_image_body
+
+    ``image`` is the uploaded bytes or a seekable binary file (a str is base64
+    that failed to decode). The result is the prepared image bytes, or
+    ``image`` itself (and no dhash) if it could not be decoded. ``received``
+    is the ingress size when it differs from the decoded size (base64 JSON).
+
+    Sizes are recorded as base64, what Gemini is sent, so a raw or multipart
+    upload counts as its base64 length against the prepared image's.
+    """
+    if received is None:
+        if isinstance(image, str):
+            received = len(image)
+        else:
+            received = base64_length(len(image) if isinstance(image, bytes) else image.seek(0, io.SEEK_END))
+
     try:
-        # Decode base64
-        image_data = base64.b64decode(image_base64)
-        
-        # Check size
-        if len(image_data) <= max_size_mb * 1024 * 1024:
-            return image_base64  # No compression needed
-        
-        # Open image and compress
-        img = Image.open(io.BytesIO(image_data))
-        
-        # Convert to RGB if needed
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        
-        # Calculate new dimensions (reduce by 50%)
-        new_width = img.width // 2
-        new_height = img.height // 2
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Save compressed image
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=85, optimize=True)
-        compressed_data = buffer.getvalue()
-        
-        # Return compressed base64
-        return base64.b64encode(compressed_data).decode('utf-8')
-        
-    except Exception as e:
-        print(f"Image compression error: {e}")
-        return image_base64  # Return original if compression fails
+        if isinstance(image, str):
+            raise ImageRejected("Invalid base64 image data")
+        with span("image_preprocess"):
+            # Spooled uploads stay in this process: shipping one would mean reading it whole
+            # (Pillow releases the GIL while decoding, resampling and encoding anyway)
+            in_memory = isinstance(image, bytes)
+            prepared = CPU_POOL.run(
+                "image_prepare", prepare_image, image, IMAGE_MAX_EDGE, IMAGE_MAX_BYTES,
+                size=len(image) if in_memory else 0,
+                threshold=IMAGE_OFFLOAD_BYTES if in_memory else float("inf"),
+            )
+    except (ImageRejected, ValueError) as e:
+        # Let Gemini judge what we could not decode, as before
+        log.warning("Image preprocessing skipped: %s", e)
+        IMAGE_PREPROCESS.inc(outcome="skipped")
+        return image, image_type, None
+
+    sent = base64_length(len(prepared.data))
+    IMAGE_PREPROCESS.inc(outcome="resized" if prepared.changed else "unchanged")
+    IMAGE_UPLOAD_BYTES.observe(received, stage="received", transport=transport)
+    IMAGE_UPLOAD_BYTES.observe(sent, stage="sent", transport=transport)
+    # A re-encoded image can come out larger; a counter never goes down
+    IMAGE_BYTES_SAVED.inc(max(0, received - sent), transport=transport)
+    log.info("Image %dx%d → %dx%d, %d → %d bytes in %.0f ms", *prepared.original_size, *prepared.size,
+             received, sent, prepared.seconds * 1000)
+    return prepared.data, prepared.mime_type, prepared.dhash
 
 def get_image_info(image_base64):
     """Get image information"""
     try:
         image_data = base64.b64decode(image_base64)
+        from PIL import Image
+
         img = Image.open(io.BytesIO(image_data))
         
         return {
@@ -585,109 +1601,188 @@ def get_image_info(image_base64):
     except:
         return None
 
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def gazetteer():
+    """The memory-mapped place index (built from GAZETTEER_SOURCE on first
+    use if needed), or None if it can't be opened"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                try:
+                    _gazetteer = Gazetteer.from_env()
+                except Exception as e:
+                    log.warning("Gazetteer not available: %s", e)
+                    _gazetteer = False
+    return _gazetteer or None
+
+
 def extract_city_from_query(query):
-    """Extract city name from weather query"""
-    query_lower = query.lower()
-    
-    # Check for exact city matches
-    for city in CITY_COORDINATES.keys():
-        if city in query_lower:
-            return city
+    """The place a weather query is about (a gazetteer.Place), or None"""
+    places = gazetteer()
+    if places is None:
+        return None
+    place = places.find(query)
+    if place is not None:
+        return place
     
-    # Common patterns
+    # No exact name: allow a typo in the words around "weather"
     patterns = [
-        r"weather (?:in|of|for) ([a-zA-Z\s]+)",
-        r"([a-zA-Z\s]+) weather",
+        r"weather (?:in|of|for|at) ([^\d?!.,]+)",
+        r"([^\d?!.,]+) weather",
     ]
     
     for pattern in patterns:
-        match = re.search(pattern, query_lower)
+        match = re.search(pattern, query.lower())
         if match:
-            city_name = match.group(1).strip()
-            for city in CITY_COORDINATES.keys():
-                if city in city_name.lower():
-                    return city
+            place = places.closest(match.group(1))
+            if place is not None:
+                return place
     
     return None
 
-def get_weather_by_city(city_name=None):
-    """Get weather for specific city or default"""
+class WeatherUnavailable(Exception):
+    """OpenWeatherMap answered, but not with a usable report"""
+
+
+def weather_url(lat, lon):
+    return f"{WEATHER_API_BASE}/weather?lat={lat}&lon={lon}&appid={WEATHER_API_KEY}&units=metric"
+
+
+def parse_weather(response):
+    """Current conditions from an OpenWeatherMap response (requests or httpx)"""
+    if response.status_code != 200:
+        raise WeatherUnavailable(f"OpenWeatherMap returned {response.status_code}")
+    
+    data = response.json()
+    return {
+        "temperature": data.get("main", {}).get("temp", "N/A"),
+        "feels_like": data.get("main", {}).get("feels_like", "N/A"),
+        "humidity": data.get("main", {}).get("humidity", "N/A"),
+        "description": data.get("weather", [{}])[0].get("description", "").title(),
+        "icon": data.get("weather", [{}])[0].get("icon", "01d"),
+    }
+
+def fetch_weather(lat, lon):
+    """Current conditions at a coordinate, straight from OpenWeatherMap"""
+    with span("weather"):
+        r = UPSTREAM.get(weather_url(lat, lon), timeout=8)
+    observe_upstream("weather", r)
+    return parse_weather(r)
+
+def resolve_weather_location(city=None):
+    """(lat, lon, display name) for a gazetteer.Place or a place name,
+    defaulting to Naogaon when there is none or it isn't known"""
+    if isinstance(city, str):
+        places = gazetteer()
+        city = places.closest(city) if places is not None else None
+    if city is None:
+        return DEFAULT_WEATHER_LOCATION
+    return city.lat, city.lon, city.name
+
+def weather_cache_key(lat, lon):
+    return (round(lat, 2), round(lon, 2))
+
+def format_weather(city_display, current):
+    temp = current["temperature"]
+    feels_like = current["feels_like"]
+    humidity = current["humidity"]
+    description = current["description"]
+    icon = current["icon"]
+    
+    weather_data = {
+        "city": city_display,
+        "temperature": temp,
+        "feels_like": feels_like,
+        "humidity": humidity,
+        "description": description,
+        "icon": icon,
+        "icon_url": f"https://openweathermap.org/img/wn/{icon}@2x.png"
+    }
+    
+    message = f"In {city_display}: {temp}°C, feels like {feels_like}°C. {description}. Humidity: {humidity}%."
+    return {"message": message, "data": weather_data}
+
+def get_weather_by_city(city=None):
+    """Get weather for a place (gazetteer.Place or name) or the default"""
     if not WEATHER_API_KEY:
         return {"message": "Weather service unavailable.", "data": None}
     
-    if city_name and city_name.lower() in CITY_COORDINATES:
-        lat, lon = CITY_COORDINATES[city_name.lower()]
-        city_display = city_name.title()
-    else:
-        # Default to Naogaon
-        lat, lon = 24.8, 88.9
-        city_display = "Naogaon"
-        if city_name:
-            city_display = city_name.title()
-    
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_API_KEY}&units=metric"
+    lat, lon, city_display = resolve_weather_location(city)
     
+    # Cached per coordinate; concurrent misses share one upstream call and
+    # a recent report is served if OpenWeatherMap is failing
     try:
-        r = requests.get(url, timeout=8)
-        if r.status_code == 200:
-            data = r.json()
-            temp = data.get("main", {}).get("temp", "N/A")
-            feels_like = data.get("main", {}).get("feels_like", "N/A")
-            humidity = data.get("main", {}).get("humidity", "N/A")
-            description = data.get("weather", [{}])[0].get("description", "").title()
-            icon = data.get("weather", [{}])[0].get("icon", "01d")
-            
-            weather_data = {
-                "city": city_display,
-                "temperature": temp,
-                "feels_like": feels_like,
-                "humidity": humidity,
-                "description": description,
-                "icon": icon,
-                "icon_url": f"https://openweathermap.org/img/wn/{icon}@2x.png"
-            }
-            
-            message = f"In {city_display}: {temp}°C, feels like {feels_like}°C. {description}. Humidity: {humidity}%."
-            return {"message": message, "data": weather_data}
+        current = WEATHER_CACHE.get_or_load(weather_cache_key(lat, lon), lambda: fetch_weather(lat, lon))
+    except WeatherUnavailable:
         return {"message": "Weather service unavailable.", "data": None}
     except Exception:
         return {"message": "Failed to fetch weather.", "data": None}
+    
+    return format_weather(city_display, current)
+
+NEWS_CATEGORIES = ("business", "entertainment", "general", "health", "science", "sports", "technology")
+
+
+class NewsUnavailable(Exception):
+    """NewsAPI answered with an error status"""
+
+
+def fetch_news_html(params):
+    """Fetch headlines for one parameter set and render them"""
+    url = f"{NEWS_API_BASE}/top-headlines"
+    
+    with span("news"):
+        r = UPSTREAM.get(url, params={**params, "apiKey": NEWS_API_KEY}, timeout=8)
+    observe_upstream("news", r)
+    if r.status_code != 200:
+        raise NewsUnavailable(f"NewsAPI returned {r.status_code}")
+    
+    articles = r.json().get("articles", [])
+    if not articles:
+        return "No top headlines found."
+    
+    news_list = ["<div class='news-container'>"]
+    news_list.append("<h3>📰 Top Headlines</h3>")
+    
+    for i, a in enumerate(articles[:params.get("pageSize", 5)], 1):
+        title = a.get("title", "No title")
+        source = a.get("source", {}).get("name", "Unknown")
+        url = a.get("url", "#")
+        
+        news_list.append(f"""
+        <div class='news-item'>
+            <span class='news-number'>{i}</span>
+            <div class='news-content'>
+                <strong>{title}</strong>
+                <small>Source: {source}</small>
+            </div>
+        </div>
+        """)
+    
+    news_list.append("</div>")
+    return "".join(news_list)
 
-def get_top_news():
-    """Fetch top news"""
+def get_top_news(country="us", category=None, page_size=5):
+    """Fetch top news (served from the in-memory feed, refreshed in the background)"""
     if not NEWS_API_KEY:
         return "News API key not configured"
     
-    url = "https://newsapi.org/v2/top-headlines"
-    params = {"country": "us", "pageSize": 5, "apiKey": NEWS_API_KEY}
+    # Straight from a quick-action body: anything malformed gets the default
+    country = country.lower()[:2] if isinstance(country, str) and country else "us"
+    if not isinstance(category, str) or category not in NEWS_CATEGORIES:
+        category = None
+    try:
+        page_size = max(1, min(int(page_size or 5), 20))
+    except (TypeError, ValueError):
+        page_size = 5
     
     try:
-        r = requests.get(url, params=params, timeout=8)
-        if r.status_code == 200:
-            articles = r.json().get("articles", [])
-            if not articles:
-                return "No top headlines found."
-            
-            news_list = ["<div class='news-container'>"]
-            news_list.append("<h3>📰 Top Headlines</h3>")
-            
-            for i, a in enumerate(articles[:5], 1):
-                title = a.get("title", "No title")
-                source = a.get("source", {}).get("name", "Unknown")
-                url = a.get("url", "#")
-                
-                news_list.append(f"""
-                <div class='news-item'>
-                    <span class='news-number'>{i}</span>
-                    <div class='news-content'>
-                        <strong>{title}</strong>
-                        <small>Source: {source}</small>
-                    </div>
-                </div>
-                """)
-            
-            news_list.append("</div>")
-            return "".join(news_list)
+        return NEWS_FEED.get(country=country, category=category, pageSize=page_size)
+    except NewsUnavailable:
         return "Failed to fetch news."
     except Exception:
         return "News service temporarily unavailable."
@@ -783,97 +1878,95 @@ def open_app_web(name):
 
 # =========== MAIN COMMAND PROCESSOR ===========
 # =========== MAIN COMMAND PROCESSOR ===========
-def perform_task_web(command):
-    """Process user commands with better handling"""
-    if not command:
-        return "Please provide a command."
-    
-    orig = command.strip()
-    cmd = orig.lower()
-    
-    # WEATHER WITH CITY DETECTION
-    if "weather" in cmd:
-        city = extract_city_from_query(cmd)
-        if city:
-            weather_info = get_weather_by_city(city)
-            return weather_info["message"]
-        else:
-            weather_info = get_weather_by_city()
-            return weather_info["message"]
-    
-    # PERSONAL INFO
-    personal_info = {
-        "your name": "I am <strong>Ibnsina</strong>, your intelligent assistant! 🤖",
-        "time": get_current_time(),
-        "date": get_current_date(),
-        "year": get_current_year(),
-        "birth date": "I was born on <strong>31st December 2000</strong> 🎂",
-        "birthday": "I was born on <strong>31st December 2000</strong> 🎂",
-        "where.*live": "I live in <strong>Naogaon, Bangladesh</strong> 🇧🇩",
-        "father.*name": "My father's name is <strong>Shariful Islam Hera</strong> 👨",
-        "mother.*name": "My mother's name is <strong>Wahida Akter Smrity</strong> 👩",
-        "religion": "I believe in <strong>Islam</strong> ☪️",
-        "joke": tell_joke(),
-        "news": get_top_news(),
-    }
-    
-    for pattern, response in personal_info.items():
-        if re.search(pattern, cmd):
-            return response
-    
-    # OPEN COMMANDS
-    if cmd.startswith("open "):
-        app_name = orig[5:].strip()
-        return open_app_web(app_name)
-    
-    # SEARCH COMMANDS
-    if "search for" in cmd:
-        query = cmd.split("search for", 1)[-1].strip()
-        if query:
-            webbrowser.open(f"https://www.google.com/search?q={urllib.parse.quote_plus(query)}")
-            return f"🔍 Searching Google for: <strong>{query}</strong>"
-    
-    if "youtube" in cmd and "search" in cmd:
-        query = cmd.replace("search youtube for", "").replace("youtube search", "").strip()
-        if query:
-            webbrowser.open(f"https://www.youtube.com/results?search_query={urllib.parse.quote_plus(query)}")
-            return f"🎥 Searching YouTube for: <strong>{query}</strong>"
-    
-    # **IMPROVED CODE REQUEST DETECTION**
-    # Only trigger code for specific patterns
-    code_triggers = [
-        r"code for",
-        r"program(?:ming|mer)?\s+for",
-        r"write (?:a )?code",
-        r"create (?:a )?program",
-        r"implement.*(?:function|class|algorithm)",
-        r"how to code",
-        r"python.*program",
-        r"javascript.*script",
-        r"html.*page",
-        r"css.*style",
-        r"algorithm for",
-        r"function to",
-        r"class for",
-        r"script for"
-    ]
-    
-    # **ESSAY/WRITING KEYWORDS (should NOT trigger code)**
-    writing_keywords = [
-        "essay", "paragraph", "story", "letter", "article", "composition",
-        "write about", "describe", "explain", "discuss", "summary",
-        "analysis", "review", "report", "paper", "thesis", "dissertation"
-    ]
-    
-    # Check if it's a writing request
-    is_writing_request = any(keyword in cmd for keyword in writing_keywords)
-    
-    # Check if it's a code request
-    is_code_request = any(re.search(pattern, cmd) for pattern in code_triggers) and not is_writing_request
-    
-    if is_code_request:
-        print(f"Detected code request: {cmd}")
-        prompt = f"""Please provide complete, well-commented code for: {orig}
+# Intents are declared once, in priority order, and compiled into a single
+# regex. Handlers only run for the intent that matched, so e.g. a code request
+# never triggers the news/joke/time lookups.
+ROUTER = IntentRouter(on_scan=lambda seconds: SPAN_SECONDS.observe(seconds, span="route"))
+
+
+def _reply(text):
+    return lambda orig, cmd: text
+
+
+# WEATHER WITH CITY DETECTION
+@ROUTER.intent("weather", r"weather")
+def _weather_intent(orig, cmd):
+    return get_weather_by_city(extract_city_from_query(cmd))["message"]
+
+
+# PERSONAL INFO
+ROUTER.add("name", r"your name", _reply("I am <strong>Ibnsina</strong>, your intelligent assistant! 🤖"))
+ROUTER.add("time", r"time", lambda orig, cmd: get_current_time())
+ROUTER.add("date", r"date", lambda orig, cmd: get_current_date())
+ROUTER.add("year", r"year", lambda orig, cmd: get_current_year())
+ROUTER.add("birthday", [r"birth date", r"birthday"], _reply("I was born on <strong>31st December 2000</strong> 🎂"))
+ROUTER.add("home", r"where.*live", _reply("I live in <strong>Naogaon, Bangladesh</strong> 🇧🇩"))
+ROUTER.add("father", r"father.*name", _reply("My father's name is <strong>Shariful Islam Hera</strong> 👨"))
+ROUTER.add("mother", r"mother.*name", _reply("My mother's name is <strong>Wahida Akter Smrity</strong> 👩"))
+ROUTER.add("religion", r"religion", _reply("I believe in <strong>Islam</strong> ☪️"))
+ROUTER.add("joke", r"joke", lambda orig, cmd: tell_joke())
+@ROUTER.intent("news", r"news")
+def _news_intent(orig, cmd):
+    category = next((c for c in NEWS_CATEGORIES if c in cmd), None)
+    if category is None and re.search(r"\btech\b", cmd):
+        category = "technology"
+    return get_top_news(category=category)
+
+
+# OPEN COMMANDS
+@ROUTER.intent("open", r"open ", anchored=True)
+def _open_intent(orig, cmd):
+    return open_app_web(orig.strip()[5:].strip())
+
+
+# SEARCH COMMANDS
+@ROUTER.intent("search", r"search for")
+def _search_intent(orig, cmd):
+    query = cmd.split("search for", 1)[-1].strip()
+    if query:
+        webbrowser.open(f"https://www.google.com/search?q={urllib.parse.quote_plus(query)}")
+        return f"🔍 Searching Google for: <strong>{query}</strong>"
+    return None
+
+
+@ROUTER.intent("youtube_search", [r"youtube[\s\S]*search", r"search[\s\S]*youtube"])
+def _youtube_search_intent(orig, cmd):
+    query = cmd.replace("search youtube for", "").replace("youtube search", "").strip()
+    if query:
+        webbrowser.open(f"https://www.youtube.com/results?search_query={urllib.parse.quote_plus(query)}")
+        return f"🎥 Searching YouTube for: <strong>{query}</strong>"
+    return None
+
+
+# **IMPROVED CODE REQUEST DETECTION**
+# Only trigger code for specific patterns
+CODE_TRIGGERS = [
+    r"code for",
+    r"program(?:ming|mer)?\s+for",
+    r"write (?:a )?code",
+    r"create (?:a )?program",
+    r"implement.*(?:function|class|algorithm)",
+    r"how to code",
+    r"python.*program",
+    r"javascript.*script",
+    r"html.*page",
+    r"css.*style",
+    r"algorithm for",
+    r"function to",
+    r"class for",
+    r"script for"
+]
+
+# **ESSAY/WRITING KEYWORDS (should NOT trigger code)**
+WRITING_KEYWORDS = [
+    "essay", "paragraph", "story", "letter", "article", "composition",
+    "write about", "describe", "explain", "discuss", "summary",
+    "analysis", "review", "report", "paper", "thesis", "dissertation"
+]
+
+
+def code_prompt(orig):
+    return f"""Please provide complete, well-commented code for: {orig}
 
 IMPORTANT: 
 1. Provide the FULL code without truncation
@@ -883,13 +1976,62 @@ IMPORTANT:
 5. Use appropriate formatting and indentation
 
 Please ensure the response is complete and not truncated."""
-        return ask_ai(prompt)
-    
-    # FALLBACK TO AI for everything else
+
+
+@ROUTER.intent("code", CODE_TRIGGERS, unless=[re.escape(k) for k in WRITING_KEYWORDS])
+def _code_intent(orig, cmd):
+    print(f"Detected code request: {cmd}")
+    return ask_ai(code_prompt(orig), "code")
+
+
+# Long-form writing gets the "writing" profile: more room and more variety
+WRITING_TRIGGERS = [
+    r"essay", r"story", r"poem", r"letter", r"article", r"composition", r"paragraph",
+    r"write about", r"speech", r"thesis", r"dissertation",
+]
+
+
+@ROUTER.intent("writing", WRITING_TRIGGERS)
+def _writing_intent(orig, cmd):
+    return ask_ai(orig, "writing")
+
+
+# FALLBACK TO AI for everything else
+@ROUTER.fallback
+def _ai_fallback(orig, cmd):
     return ask_ai(orig)
+
+
+ROUTER.compile()
+
+
+def ai_prompt_for(command):
+    """(Gemini prompt, GENERATION profile) for a command that routes to the
+    AI, or None for local intents"""
+    orig = command.strip()
+    intent = ROUTER.match(orig.lower())
+    if intent == "code":
+        return code_prompt(orig), "code"
+    if intent == "writing":
+        return orig, "writing"
+    if intent is None:
+        return orig, "chat"
+    return None
+
+
+def perform_task_web(command):
+    """Process user commands with better handling"""
+    if not command:
+        return "Please provide a command."
+    
+    orig = command.strip()
+    return ROUTER.route(orig, orig.lower())
 def speak_response(text):
     """Generate speech from text"""
     try:
+        engine = speech_engine()
+        if engine is None:
+            return
         clean_text = re.sub(r'<[^>]+>', '', text)
         clean_text = re.sub(r'[🤖🎂🇧🇩👨👩☪️🔍🎥😂📰]', '', clean_text)
         
@@ -897,7 +2039,7 @@ def speak_response(text):
             engine.say(clean_text[:300])
             engine.runAndWait()
         
-        Thread(target=speak_thread, daemon=True).start()
+        threading.Thread(target=speak_thread, daemon=True).start()
     except Exception:
         pass
 @app.route('/test-truncation', methods=['GET'])
@@ -917,6 +2059,61 @@ def test_truncation():
         "last_100": test_text[-100:],
         "full_text": test_text
     })
+# =========== WARM-UP ===========
+# A reply with a code block and a table: loads Markdown, its extensions and
+# the Pygments lexer and formatter the first real reply would wait for
+WARMUP_MARKDOWN = "Warm-up\n\n```python\nprint('ready')\n```\n\n| a | b |\n|---|---|\n| 1 | 2 |\n"
+
+
+def warm_pillow():
+    from PIL import Image
+
+    Image.init()  # registers every format plugin; Image.open would do it on the first upload
+
+
+def warm_gemini_connection():
+    # Opens the pooled keep-alive connection (TCP + TLS); listing models is free
+    if API_KEY:
+        UPSTREAM.get(f"{GEMINI_API_BASE}/models?key={API_KEY}&pageSize=1", timeout=5, retries=0)
+
+
+def warm_index_page():
+    with app.test_request_context("/"):
+        index_page()
+
+
+def warm_up():
+    """Do the first-request work ahead of time; gunicorn's post_worker_init hook
+    runs this in a background thread while the worker already takes requests"""
+    steps = {
+        # Imports Markdown and Pygments and fills their shared lexer/formatter
+        # cache; each request thread still builds its own Markdown instance
+        "markdown": lambda: RENDERER.convert(WARMUP_MARKDOWN),
+        "pillow": warm_pillow,
+        "static_assets": static_assets,
+        "index_page": warm_index_page,
+        "gazetteer": gazetteer,
+        "gemini_connection": warm_gemini_connection,
+    }
+    timings = {}
+    for name, step in steps.items():
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            log.warning("Warm-up step %s failed: %s", name, e)
+            continue
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    log.info("Warm-up done (ms): %s", timings)
+    return timings
+
+
+# =========== BACKGROUND WORKERS ===========
+# Started last so every function they call is already defined
+# Not in CPU pool workers, which re-import this module when it is run directly
+if NEWS_API_KEY and os.environ.get("NEWS_PREFETCH", "1") != "0" and multiprocessing.parent_process() is None:
+    NEWS_FEED.start(prefetch=[NEWS_DEFAULT_PARAMS])
+
 if __name__ == '__main__':
     # For production on Fly.io
     port = int(os.environ.get("PORT", 8080))
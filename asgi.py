@@ -0,0 +1,433 @@
+"""ASGI entry point: async handlers for the routes that wait on upstream APIs.
+
+    SERVER_MODE=async gunicorn --config gunicorn.conf.py
+    # or: uvicorn asgi:app --port 8080
+
+/ask, /ask/batch, /voice, /weather/<city> and /quick-action/<action> are coroutines that
+await Gemini and OpenWeatherMap through a pooled httpx client, so a single
+worker can keep hundreds of slow LLM calls in flight while /health and the
+rest stay responsive. Every other route is served by the Flask app, which
+runs in a thread pool behind the ASGI adapter.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import time
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as flask_app
+import deadline
+from admission import Overloaded
+from app import (
+    ADMISSION_REJECTIONS,
+    ASK_CACHE,
+    ASK_FLIGHT,
+    GEMINI_GATE,
+    GENERATION,
+    GEMINI_HEDGER,
+    HTTP_REQUEST_BYTES,
+    HTTP_REQUESTS,
+    HTTP_RESPONSE_BYTES,
+    HTTP_SECONDS,
+    IMAGE_CACHE,
+    IMAGE_TIMEOUT_RESULT,
+    RATE_LIMITED_ROUTES,
+    RATE_LIMITER,
+    REFUSALS,
+    ROUTER,
+    SESSIONS,
+    WEATHER_CACHE,
+    WeatherUnavailable,
+    ai_request,
+    batch_item_result,
+    client_key,
+    code_prompt,
+    extract_city_from_query,
+    finish_image_analysis,
+    flight_key,
+    format_weather,
+    gemini_url,
+    get_current_time,
+    get_top_news,
+    handle_ai_response,
+    image_analysis_error,
+    image_fields_error,
+    observe_upstream,
+    parse_batch,
+    parse_weather,
+    record_turn,
+    requested_session,
+    resolve_weather_location,
+    session_cache_gone,
+    span,
+    start_image_analysis,
+    tell_joke,
+    weather_cache_key,
+    weather_url,
+)
+from deadline import DeadlineExceeded
+from singleflight import AsyncSingleFlight
+from upstream import AsyncUpstreamClient
+
+log = logging.getLogger(__name__)
+
+ASYNC_UPSTREAM = AsyncUpstreamClient.from_env(pool_size=200)
+# Same coalescing as app.ASK_FLIGHT, for coroutines (and the same lock files)
+ASYNC_ASK_FLIGHT = AsyncSingleFlight(across=ASK_FLIGHT.across)
+
+
+# =========== ASYNC UPSTREAM CALLS ===========
+async def ask_ai_async(prompt: str, profile="chat"):
+    """ask_ai() over the async client: same payload, cache and rendering"""
+    try:
+        payload, cache_key = ai_request(prompt, profile=profile)
+        if not cache_key:
+            return (await ASYNC_ASK_FLIGHT.do(
+                flight_key(payload, cache_key), lambda: generate_reply_async(prompt, payload, cache_key, profile)
+            ))[0]
+
+        cached = ASK_CACHE.get(cache_key, with_reply=True)
+        if cached is not None and (cached[1] or not SESSIONS.current):
+            html, reply = cached
+        else:
+            html, reply = await ASYNC_ASK_FLIGHT.do(
+                flight_key(payload, cache_key), lambda: generate_reply_async(prompt, payload, cache_key, profile)
+            )
+        record_turn(SESSIONS.current, prompt, reply)
+        return html
+
+    except REFUSALS:
+        raise
+    except Exception as e:
+        log.exception("ask_ai failed")
+        return f"Error: {e}"
+
+
+async def generate_reply_async(prompt, payload, cache_key, profile="chat"):
+    model = GENERATION[profile].model
+    # One gate for threads and coroutines: Flask routes in this worker share it
+    async with GEMINI_GATE.aslot("text"):
+        with span("gemini_text"):
+            r = await post_generate_async(payload, model)
+            if r.status_code != 200 and session_cache_gone(r, payload):
+                payload, cache_key = ai_request(prompt, profile=profile)
+                r = await post_generate_async(payload, model)
+    observe_upstream("gemini_text", r)
+    if r.status_code != 200:
+        log.warning("Gemini error body: %s", r.text[:500])
+        return f"API Error {r.status_code}", None
+
+    # Rendering may wait on the CPU pool; don't block the event loop meanwhile
+    return await run_in_threadpool(handle_ai_response, r.json(), cache_key, prompt)
+
+
+async def post_generate_async(payload, model=flask_app.MODEL):
+    url = gemini_url(model)
+    return await GEMINI_HEDGER.acall(
+        lambda: ASYNC_UPSTREAM.post(url, headers={"Content-Type": "application/json"},
+                                    json=payload, timeout=180),
+        admit=GEMINI_GATE.try_acquire,
+        release=GEMINI_GATE.release,
+    )
+
+
+async def analyze_image_async(prompt, image_base64, image_type="image/jpeg"):
+    # Hashing, decoding and resizing are CPU work; keep them off the event loop
+    cached, pending = await run_in_threadpool(start_image_analysis, prompt, image_base64, image_type)
+    if cached is not None:
+        return cached
+    body = pending["body"]
+    try:
+        async with GEMINI_GATE.aslot("vision"):
+            with span("gemini_vision"):
+                response = await ASYNC_UPSTREAM.post(
+                    gemini_url(GENERATION["image"].model), headers=body.headers,
+                    content=body.async_content, timeout=60
+                )
+        return await run_in_threadpool(finish_image_analysis, response, prompt, pending)
+    except httpx.TimeoutException:
+        return dict(IMAGE_TIMEOUT_RESULT)
+    except REFUSALS:
+        raise
+    except Exception as e:
+        return image_analysis_error(e)
+
+
+async def get_weather_async(city=None):
+    if not flask_app.WEATHER_API_KEY:
+        return {"message": "Weather service unavailable.", "data": None}
+
+    lat, lon, city_display = resolve_weather_location(city)
+
+    async def fetch():
+        with span("weather"):
+            r = await ASYNC_UPSTREAM.get(weather_url(lat, lon), timeout=8)
+        observe_upstream("weather", r)
+        return parse_weather(r)
+
+    try:
+        current = await WEATHER_CACHE.aget_or_load(weather_cache_key(lat, lon), fetch)
+    except WeatherUnavailable:
+        return {"message": "Weather service unavailable.", "data": None}
+    except Exception:
+        return {"message": "Failed to fetch weather.", "data": None}
+
+    return format_weather(city_display, current)
+
+
+# =========== ASYNC INTENT HANDLERS ===========
+@ROUTER.async_handler("weather")
+async def _weather_intent(orig, cmd):
+    return (await get_weather_async(extract_city_from_query(cmd)))["message"]
+
+
+@ROUTER.async_handler("news")
+async def _news_intent(orig, cmd):
+    # Served from memory once warm; the thread only matters for a cold feed
+    return await run_in_threadpool(flask_app._news_intent, orig, cmd)
+
+
+@ROUTER.async_handler("code")
+async def _code_intent(orig, cmd):
+    return await ask_ai_async(code_prompt(orig), "code")
+
+
+@ROUTER.async_handler("writing")
+async def _writing_intent(orig, cmd):
+    return await ask_ai_async(orig, "writing")
+
+
+@ROUTER.async_handler("fallback")
+async def _ai_fallback(orig, cmd):
+    return await ask_ai_async(orig)
+
+
+async def perform_task_async(command):
+    if not command:
+        return "Please provide a command."
+    orig = command.strip()
+    return (await ROUTER.aresolve(orig, orig.lower()))[1]
+
+
+# =========== ROUTES ===========
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse with its serialization time recorded as the "json" span"""
+
+    def render(self, content):
+        with span("json"):
+            return super().render(content)
+
+
+def admission_response(status, message, retry_after):
+    return TimedJSONResponse({"error": message, "retry_after": retry_after}, status_code=status,
+                             headers={"Retry-After": str(retry_after)})
+
+
+def instrumented(rule):
+    """Record the same request metrics as the Flask after_request hook, and
+    apply the same deadline and admission control as its before_request
+    hooks and error handlers"""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            started = time.perf_counter()
+            retry_after = 0
+            if rule in RATE_LIMITED_ROUTES:
+                host = request.client.host if request.client else None
+                retry_after = RATE_LIMITER.check(client_key(request.headers, host))
+            if retry_after:
+                ADMISSION_REJECTIONS.inc(reason="rate_limited")
+                response = admission_response(429, "Too many requests, please slow down.", retry_after)
+            else:
+                try:
+                    # Tasks the endpoint starts copy the deadline along with the context
+                    with deadline.within(deadline.requested(request.headers)):
+                        response = await endpoint(request)
+                except Overloaded as e:
+                    response = admission_response(503, str(e), e.retry_after)
+                except DeadlineExceeded as e:
+                    response = TimedJSONResponse({"error": str(e)}, status_code=504)
+            HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=rule, method=request.method)
+            HTTP_REQUESTS.inc(endpoint=rule, method=request.method, status=response.status_code)
+            HTTP_REQUEST_BYTES.observe(int(request.headers.get("content-length") or 0), endpoint=rule)
+            if not isinstance(response, StreamingResponse):
+                HTTP_RESPONSE_BYTES.observe(len(response.body), endpoint=rule)
+            return response
+        return wrapper
+    return decorator
+
+
+def wants_fresh_response(request, data):
+    return bool(data.get("no_cache")) or "no-cache" in request.headers.get("Cache-Control", "")
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+@instrumented("/ask")
+async def ask(request):
+    data = await _json_body(request)
+    command = (data.get("command") or "").strip()
+    image_base64 = data.get("image")
+    image_type = data.get("image_type", "image/jpeg")
+    error = image_fields_error(image_base64, image_type)
+    if error:
+        return TimedJSONResponse({"error": error, "type": "image"}, status_code=400)
+
+    if image_base64:
+        host = request.client.host if request.client else None
+        with IMAGE_CACHE.scoped(client_key(request.headers, host)):
+            result = await analyze_image_async(command, image_base64, image_type)
+        return TimedJSONResponse({
+            "response": result["response"],
+            "analysis": result["analysis"] if result["success"] else "",
+            "type": "image",
+        })
+
+    if not command:
+        return TimedJSONResponse({
+            "error": "No command provided. Please type something.",
+            "type": "text",
+        })
+
+    session_id, error = requested_session(data)
+    if error:
+        return TimedJSONResponse({"error": error, "type": "text"}, status_code=400)
+
+    with SESSIONS.active(session_id), ASK_CACHE.bypassing(wants_fresh_response(request, data)):
+        response = await perform_task_async(command)
+    reply = {"response": response, "type": "text"}
+    if session_id:
+        reply["session_id"] = session_id
+    return TimedJSONResponse(reply)
+
+
+async def answer_batch_item_async(index, item, limit):
+    """app.answer_batch_item() over the async paths, holding one of ``limit``'s slots"""
+    command = (item.get("command") or "").strip()
+    async with limit:
+        try:
+            if item.get("image"):
+                result = await analyze_image_async(command, item["image"], item.get("image_type", "image/jpeg"))
+            elif command:
+                result = await perform_task_async(command)
+            else:
+                return batch_item_result(index, item, error="No command provided.")
+        except Exception as e:
+            return batch_item_result(index, item, error=e)
+    return batch_item_result(index, item, result)
+
+
+@instrumented("/ask/batch")
+async def ask_batch(request):
+    data = await _json_body(request)
+    items, parallelism, error = parse_batch(data)
+    if error:
+        return TimedJSONResponse({"error": error[0], "type": "batch"}, status_code=error[1])
+    # Every item pays, as in app.ask_batch
+    host = request.client.host if request.client else None
+    retry_after = RATE_LIMITER.check(client_key(request.headers, host), cost=len(items))
+    if retry_after:
+        ADMISSION_REJECTIONS.inc(reason="rate_limited")
+        return admission_response(429, "Too many requests, please slow down.", retry_after)
+
+    limit = asyncio.Semaphore(parallelism)
+    # Tasks copy the current context, ASK_CACHE.bypassing() and IMAGE_CACHE.scoped() included
+    scope = client_key(request.headers, host)
+    with ASK_CACHE.bypassing(wants_fresh_response(request, data)), IMAGE_CACHE.scoped(scope):
+        tasks = [asyncio.create_task(answer_batch_item_async(i, item, limit)) for i, item in enumerate(items)]
+
+    if data.get("stream"):
+        async def generate():
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield json.dumps(await next_done) + "\n"
+            finally:
+                # The client went away mid-stream
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return TimedJSONResponse({"results": list(await asyncio.gather(*tasks)), "type": "batch"})
+
+
+@instrumented("/voice")
+async def voice(request):
+    data = await _json_body(request)
+    if not data or "text" not in data:
+        return TimedJSONResponse({"error": "No speech text provided"})
+
+    text = (data.get("text") or "").strip()
+    session_id, error = requested_session(data)
+    if error:
+        return TimedJSONResponse({"error": error}, status_code=400)
+    with SESSIONS.active(session_id), ASK_CACHE.bypassing(wants_fresh_response(request, data)):
+        response = await perform_task_async(text)
+    return TimedJSONResponse({"text": text, "response": response, "type": "voice"})
+
+
+@instrumented("/weather/<city>")
+async def weather(request):
+    return TimedJSONResponse(await get_weather_async(request.path_params["city"]))
+
+
+@instrumented("/quick-action/<action>")
+async def quick_action(request):
+    action = request.path_params["action"]
+    options = await _json_body(request)
+    if not isinstance(options, dict):
+        options = {}
+
+    if action == "news":
+        response = await run_in_threadpool(
+            get_top_news,
+            country=options.get("country", "us"),
+            category=options.get("category"),
+            page_size=options.get("page_size", 5),
+        )
+    elif action == "weather":
+        response = (await get_weather_async("naogaon"))["message"]
+    elif action == "time":
+        response = get_current_time()
+    elif action == "joke":
+        response = tell_joke()
+    else:
+        return TimedJSONResponse({"error": "Unknown action"})
+    return TimedJSONResponse({"response": response, "type": "quick_action"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await ASYNC_UPSTREAM.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route("/ask", ask, methods=["POST"]),
+        Route("/ask/batch", ask_batch, methods=["POST"]),
+        Route("/voice", voice, methods=["POST"]),
+        Route("/weather/{city}", weather, methods=["GET"]),
+        Route("/quick-action/{action}", quick_action, methods=["POST"]),
+        # Everything else (index, /ask/stream, stats...) is the Flask app
+        Mount("/", app=WSGIMiddleware(flask_app.app)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,294 @@
+"""Fingerprinted, precompressed static files.
+
+`python assets.py build [static_dir] [out_dir]` copies every file under
+static/ into static/dist/ with a content hash in its name
+(script.js -> script.3f9a0c1b7d2e.js), writes gzip and brotli variants next
+to the text ones (.gz, .br; kept only where they are smaller) and lists
+them all in manifest.json.
+
+StaticAssets reads the manifest and holds every variant in memory (the
+whole site is a few hundred KB). The app serves them under /assets/ with
+a year-long, immutable Cache-Control and a strong ETag: a page links to
+the hashed name, so a changed file gets a new URL and a browser never has
+to ask whether the one it has is still current. A request for an outdated
+hash (a page from before a deploy) gets the current file, but uncached.
+
+Asset.from_bytes() gives the same treatment to content made at runtime,
+such as the rendered index page.
+"""
+import argparse
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:  # gzip variants only
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: builds aren't serialized between processes
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STATIC = os.path.join(HERE, "static")
+DEFAULT_OUT = os.path.join(DEFAULT_STATIC, "dist")
+MANIFEST = "manifest.json"
+
+HASH_LENGTH = 12
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# A variant has to save at least this much to be worth a Vary: Accept-Encoding
+MIN_SAVING = 0.1
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Matches the hash build() puts before the extension
+FINGERPRINT = re.compile(r"\.([0-9a-f]{%d})(?=\.[^./]+$)" % HASH_LENGTH)
+
+Variant = namedtuple("Variant", "body etag")
+
+
+def content_type(name):
+    ctype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return ctype + "; charset=utf-8" if ctype.startswith("text/") or ctype == "application/javascript" else ctype
+
+
+def compress(data, ctype):
+    """{encoding: compressed bytes} for the encodings that make ``data`` smaller"""
+    if not ctype.startswith(COMPRESSIBLE):
+        return {}
+    variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return {encoding: body for encoding, body in variants.items()
+            if len(body) <= len(data) * (1 - MIN_SAVING)}
+
+
+def fingerprinted(name, digest):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest[:HASH_LENGTH]}{ext}"
+
+
+class Asset:
+    """One file (or page) and its encoded variants, each with a strong ETag"""
+
+    def __init__(self, name, path, ctype, digest, variants):
+        self.name = name
+        self.path = path
+        self.content_type = ctype
+        self.digest = digest
+        # Identity first, then ENCODINGS order
+        self.variants = variants
+
+    @classmethod
+    def from_bytes(cls, name, data, ctype=None):
+        ctype = ctype or content_type(name)
+        digest = hashlib.sha256(data).hexdigest()
+        return cls(name, fingerprinted(name, digest), ctype, digest,
+                   _variants(digest, data, compress(data, ctype)))
+
+    def pick(self, accepts):
+        """(encoding or None, Variant) for a client; ``accepts(encoding)`` is
+        the quality it gave the encoding in Accept-Encoding"""
+        for encoding in ENCODINGS:
+            if encoding in self.variants and accepts(encoding):
+                return encoding, self.variants[encoding]
+        return None, self.variants[None]
+
+    @property
+    def size(self):
+        return len(self.variants[None].body)
+
+
+def _variants(digest, data, encoded):
+    variants = {None: Variant(data, digest[:2 * HASH_LENGTH])}
+    for encoding in ENCODINGS:
+        if encoding in encoded:
+            variants[encoding] = Variant(encoded[encoding], f"{digest[:2 * HASH_LENGTH]}-{encoding}")
+    return variants
+
+
+def _sources(static_dir, out_dir):
+    """Paths under static_dir relative to it, leaving out out_dir"""
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != out_dir and not d.startswith("."))
+        for filename in sorted(files):
+            if not filename.startswith("."):
+                yield os.path.relpath(os.path.join(root, filename), static_dir).replace(os.sep, "/")
+
+
+@contextlib.contextmanager
+def _locked(out_dir):
+    """Hold the build lock of ``out_dir`` (a dot-file next to it, so it is
+    never taken for a static file): one process builds or reads at a time"""
+    if fcntl is None:
+        yield
+        return
+    parent, base = os.path.split(out_dir)
+    os.makedirs(parent, exist_ok=True)
+    fd = os.open(os.path.join(parent, f".{base}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def build(static_dir=DEFAULT_STATIC, out_dir=DEFAULT_OUT):
+    """Write the fingerprinted files, their variants and the manifest; return
+    the manifest's files entry"""
+    static_dir, out_dir = os.path.abspath(static_dir), os.path.abspath(out_dir)
+    with _locked(out_dir):
+        return _build(static_dir, out_dir)
+
+
+def _build(static_dir, out_dir):
+    if brotli is None:
+        log.warning("brotli is not installed: building gzip variants only")
+    parent, base = os.path.split(out_dir)
+    # Our own directory, skipped by _sources like any dot-directory
+    tmp_dir = tempfile.mkdtemp(prefix=f".{base}-", dir=parent)
+    try:
+        files = _write(static_dir, out_dir, tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # Swap the whole directory; readers take the lock, so none sees it missing
+    old_dir = None
+    if os.path.exists(out_dir):
+        old_dir = tempfile.mkdtemp(prefix=f".{base}-old-", dir=parent)
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    if old_dir:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return files
+
+
+def _write(static_dir, out_dir, tmp_dir):
+    files = {}
+    for name in _sources(static_dir, out_dir):
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        ctype = content_type(name)
+        digest = hashlib.sha256(data).hexdigest()
+        path = fingerprinted(name, digest)
+        encoded = compress(data, ctype)
+        target = os.path.join(tmp_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(data)
+        for encoding, body in encoded.items():
+            with open(target + ENCODINGS[encoding], "wb") as f:
+                f.write(body)
+        files[name] = {"path": path, "type": ctype, "sha256": digest, "size": len(data),
+                       "encodings": {encoding: len(body) for encoding, body in encoded.items()}}
+    with open(os.path.join(tmp_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, indent=1, sort_keys=True)
+    return files
+
+
+def _stale(static_dir, out_dir):
+    manifest = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(manifest):
+        return True
+    built = os.path.getmtime(manifest)
+    return any(os.path.getmtime(os.path.join(static_dir, name)) > built
+               for name in _sources(static_dir, out_dir))
+
+
+class StaticAssets:
+    def __init__(self, out_dir=DEFAULT_OUT):
+        with open(os.path.join(out_dir, MANIFEST), encoding="utf-8") as f:
+            files = json.load(f)["files"]
+        self._by_name = {}
+        self._by_path = {}
+        for name, entry in files.items():
+            target = os.path.join(out_dir, entry["path"])
+            with open(target, "rb") as f:
+                data = f.read()
+            encoded = {}
+            for encoding in entry["encodings"]:
+                with open(target + ENCODINGS[encoding], "rb") as f:
+                    encoded[encoding] = f.read()
+            asset = Asset(name, entry["path"], entry["type"], entry["sha256"],
+                          _variants(entry["sha256"], data, encoded))
+            self._by_name[name] = self._by_path[entry["path"]] = asset
+        self.counters = {"hits": 0, "not_modified": 0, "outdated": 0, "missing": 0,
+                         **{encoding: 0 for encoding in ENCODINGS}}
+
+    @classmethod
+    def open(cls, static_dir=DEFAULT_STATIC, out_dir=DEFAULT_OUT):
+        """The assets in ``out_dir``, built from ``static_dir`` first if they are
+        missing or older than a source file
+
+        Workers starting together take turns: the first builds, the others
+        find the build done and only read it.
+        """
+        static_dir, out_dir = os.path.abspath(static_dir), os.path.abspath(out_dir)
+        with _locked(out_dir):
+            if os.path.isdir(static_dir) and _stale(static_dir, out_dir):
+                _build(static_dir, out_dir)
+            return cls(out_dir)
+
+    @classmethod
+    def from_env(cls):
+        return cls.open(os.environ.get("STATIC_DIR", DEFAULT_STATIC),
+                        os.environ.get("ASSETS_DIR", DEFAULT_OUT))
+
+    def path(self, name):
+        """The fingerprinted path of static file ``name``, or None"""
+        asset = self._by_name.get(name)
+        return asset.path if asset else None
+
+    def lookup(self, path):
+        """(asset, current) for a requested path: current is False when the
+        hash in it is outdated, (None, False) for an unknown file"""
+        asset = self._by_path.get(path)
+        if asset is not None:
+            return asset, True
+        asset = self._by_name.get(FINGERPRINT.sub("", path, count=1))
+        if asset is None:
+            self.counters["missing"] += 1
+            return None, False
+        self.counters["outdated"] += 1
+        return asset, False
+
+    def record(self, encoding, not_modified):
+        self.counters["not_modified" if not_modified else "hits"] += 1
+        if encoding and not not_modified:
+            self.counters[encoding] += 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            "files": len(self._by_name),
+            "bytes": sum(asset.size for asset in self._by_name.values()),
+            "brotli": brotli is not None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the static files")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("static_dir", nargs="?", default=DEFAULT_STATIC)
+    parser.add_argument("out_dir", nargs="?", default=DEFAULT_OUT)
+    args = parser.parse_args()
+
+    files = build(args.static_dir, args.out_dir)
+    for name, entry in files.items():
+        sizes = ", ".join(f"{encoding} {size}" for encoding, size in entry["encodings"].items())
+        print(f"{name} -> {entry['path']} ({entry['size']} bytes{', ' + sizes if sizes else ''})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Throughput of sync (Flask) versus async (ASGI) serving under slow Gemini calls.
+
+    python benchmarks/bench_concurrency.py [--requests 64] [--latency 2.0]
+
+Starts a Gemini stub that takes --latency seconds per reply, then runs
+gunicorn with the repo's gunicorn.conf.py in each SERVER_MODE and fires
+--requests concurrent /ask calls (distinct prompts, so the response cache
+never answers). /health is probed while the burst is in flight.
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests  # noqa: E402
+
+from stubs import GeminiStub  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, workers, gemini_base, **extra_env):
+    port = free_port()
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WEB_CONCURRENCY=str(workers),
+               GEMINI_API_BASE=gemini_base, NEWS_PREFETCH="0", ASK_CACHE_DB="",
+               RATE_LIMIT_PER_MINUTE="0")
+    env.update(extra_env)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+         "--timeout", "300", "--bind", f"127.0.0.1:{port}"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base + "/health", timeout=1)
+            return proc, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"gunicorn ({mode}) did not come up")
+
+
+def ask(base, n):
+    start = time.perf_counter()
+    r = requests.post(base + "/ask", json={"command": f"explain topic number {n}"}, timeout=600)
+    r.raise_for_status()
+    return time.perf_counter() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(mode, workers, args, gemini_base):
+    proc, base = start_server(mode, workers, gemini_base)
+    try:
+        with ThreadPoolExecutor(max_workers=args.requests) as pool:
+            start = time.perf_counter()
+            futures = [pool.submit(ask, base, n) for n in range(args.requests)]
+            time.sleep(args.latency / 2)
+            probe = time.perf_counter()
+            requests.get(base + "/health", timeout=600)
+            health = time.perf_counter() - probe
+            latencies = [f.result() for f in futures]
+            elapsed = time.perf_counter() - start
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+
+    print(f"{mode:<6} workers={workers}  {args.requests / elapsed:7.2f} req/s   "
+          f"p50 {statistics.median(latencies) * 1000:8.0f} ms   "
+          f"p95 {percentile(latencies, 95) * 1000:8.0f} ms   "
+          f"/health under load {health * 1000:7.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds per Gemini reply")
+    args = parser.parse_args()
+
+    stub = GeminiStub(latency=args.latency, chunk_delay=0)
+    gemini_base = stub.start()
+    try:
+        run("sync", 2, args, gemini_base)
+        run("async", 1, args, gemini_base)
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
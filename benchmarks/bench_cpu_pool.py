@@ -0,0 +1,73 @@
+"""How much Markdown rendering stalls other threads: inline versus CpuPool.
+
+    python benchmarks/bench_cpu_pool.py [--threads 4] [--seconds 3] [--workers 2]
+
+Render threads convert long code replies back to back (HTML cache off) while
+a probe thread, standing in for a request that only waits on I/O, sleeps
+5 ms at a time and records how late it wakes up. Inline, the renders hold
+the GIL and the probe queues behind them; pooled, they run in other
+processes and the probe only pays for pickling.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_markdown import EXTENSIONS, long_code_reply  # noqa: E402
+from cpu_pool import CpuPool  # noqa: E402
+from cpu_tasks import render_markdown  # noqa: E402
+
+
+def run(workers, threads, seconds):
+    pool = CpuPool(workers=workers, max_pending=threads)
+    text = long_code_reply()
+    pool.run("markdown", render_markdown, text, EXTENSIONS, size=len(text))  # start the workers
+    stop = threading.Event()
+    renders = [0]
+
+    def render():
+        while not stop.is_set():
+            pool.run("markdown", render_markdown, text, EXTENSIONS, size=len(text))
+            renders[0] += 1
+
+    lateness = []
+
+    def probe():
+        while not stop.is_set():
+            start = time.perf_counter()
+            time.sleep(0.005)
+            lateness.append((time.perf_counter() - start - 0.005) * 1000)
+
+    started = [threading.Thread(target=render) for _ in range(threads)] + [threading.Thread(target=probe)]
+    for t in started:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in started:
+        t.join()
+    pool.shutdown()
+
+    lateness.sort()
+    p99 = lateness[int(len(lateness) * 0.99) - 1]
+    return renders[0] / seconds, statistics.median(lateness), p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'renders/s':>10} {'probe p50':>10} {'probe p99':>10}")
+    for mode, workers in (("inline", 0), (f"pool x{args.workers}", args.workers)):
+        rate, p50, p99 = run(workers, args.threads, args.seconds)
+        print(f"{mode:<10} {rate:>10.1f} {p50:>7.2f} ms {p99:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Place lookups for weather queries: microseconds per find() / closest().
+
+    python benchmarks/bench_gazetteer.py [--places 25000] [--loops 2000]
+
+Times the index built from data/gazetteer.tsv, then one built from a
+synthetic GeoNames-sized file (--places made-up towns with alternate names
+on top of the seed), to show lookups stay fast as the data grows.
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gazetteer import DEFAULT_SOURCE, Gazetteer, build  # noqa: E402
+
+QUERIES = {
+    "find, one word": ("find", "what's the weather in bogra today"),
+    "find, two words": ("find", "weather of chapai nawabganj"),
+    "find, no place": ("find", "how is the weather looking"),
+    "closest, one typo": ("closest", "chittagnog"),
+    "closest, no match": ("closest", "atlantis"),
+}
+
+
+def synthetic_source(path, places, seed=1):
+    """The seed file plus ``places`` random towns, in the same layout"""
+    rng = random.Random(seed)
+    with open(DEFAULT_SOURCE, encoding="utf-8") as f:
+        lines = [line for line in f if not line.startswith("#")]
+
+    def word():
+        return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))).title()
+
+    for n in range(places):
+        name = word() if rng.random() < 0.8 else f"{word()} {word()}"
+        alternates = ",".join(word() for _ in range(rng.randint(0, 4)))
+        lines.append("\t".join([str(10 ** 6 + n), name, name, alternates, f"{rng.uniform(-60, 70):.4f}",
+                                f"{rng.uniform(-180, 180):.4f}", "P", "PPL", "XX", "", "", "", "", "",
+                                str(rng.randint(1000, 500000)), "", "", "", ""]) + "\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def time_lookups(places, loops):
+    for label, (method, text) in QUERIES.items():
+        lookup = getattr(places, method)
+        start = time.perf_counter()
+        for _ in range(loops):
+            found = lookup(text)
+        per_call = (time.perf_counter() - start) / loops * 1e6
+        print(f"  {label:<20} {per_call:8.1f} us   -> {found.name if found else None}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--places", type=int, default=25000)
+    parser.add_argument("--loops", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, source in (("seed", DEFAULT_SOURCE), (f"+{args.places} places", os.path.join(tmp, "big.tsv"))):
+            if source != DEFAULT_SOURCE:
+                synthetic_source(source, args.places)
+            index = os.path.join(tmp, "gazetteer.idx")
+            start = time.perf_counter()
+            build(source, index)
+            built = time.perf_counter() - start
+            places = Gazetteer(index)
+            stats = places.stats()
+            print(f"{label}: {stats['places']} places, {stats['names']} names, "
+                  f"{stats['bytes'] / 1024:.0f} KiB, built in {built * 1000:.0f} ms")
+            time_lookups(places, args.loops)
+            places.close()
+
+
+if __name__ == "__main__":
+    main()
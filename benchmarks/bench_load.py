@@ -0,0 +1,190 @@
+"""Mixed-traffic load test against local stand-ins for every upstream API.
+
+    python benchmarks/bench_load.py [--requests 400] [--concurrency 32] [--modes sync,async]
+        [--mix chat=5,code=2,weather=2,news=1,image=1] [--error-rate 0.01]
+        [--gemini-latency lognormal:0.8,4] [--save load.json]
+
+Starts the Gemini, OpenWeatherMap and NewsAPI stubs from stubs.py with the
+given latency distributions and error rate, then runs gunicorn with the
+repo's gunicorn.conf.py in each SERVER_MODE and has --concurrency clients
+send --requests requests, drawn from --mix:
+
+- chat: /ask with a distinct question (the response cache never answers)
+- code: /ask asking for code
+- weather: /ask for the weather in one of a few cities
+- news: /ask for headlines in one of a few categories
+- image: /ask/image with a small JPEG upload
+
+and reports throughput and p50/p95/p99 per kind of request and server mode.
+Weather and news go through the app's caches as they would in production;
+export WEATHER_CACHE_TTL=0 or NEWS_REFRESH_INTERVAL to change that. Per-client
+rate limiting is off, since every request comes from the same address.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from bench_concurrency import percentile, start_server  # noqa: E402
+from stubs import GeminiStub, NewsStub, WeatherStub  # noqa: E402
+
+KINDS = ("chat", "code", "weather", "news", "image")
+CITIES = ("dhaka", "london", "new york", "tokyo", "paris", "delhi")
+NEWS_TOPICS = ("latest news", "technology news", "sports news", "health news")
+
+
+def parse_mix(spec):
+    """{"chat": 5, ...} from "chat=5,code=2"; unknown kinds are an error"""
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def sample_jpeg():
+    buf = io.BytesIO()
+    Image.linear_gradient("L").resize((640, 480)).convert("RGB").save(buf, "JPEG", quality=80)
+    return buf.getvalue()
+
+
+def send(base, kind, n, image):
+    """(kind, HTTP status or "error", seconds) for one request"""
+    if kind == "image":
+        call = lambda: requests.post(base + "/ask/image", timeout=600,
+                                     files={"image": ("photo.jpg", image, "image/jpeg")},
+                                     data={"command": f"what is in this picture, take {n}"})
+    else:
+        command = {
+            "chat": f"explain topic number {n} in simple words",
+            "code": f"write python code for binary search, variant {n}",
+            "weather": f"weather in {CITIES[n % len(CITIES)]}",
+            "news": NEWS_TOPICS[n % len(NEWS_TOPICS)],
+        }[kind]
+        call = lambda: requests.post(base + "/ask", json={"command": command}, timeout=600)
+    start = time.perf_counter()
+    try:
+        status = call().status_code
+    except requests.RequestException:
+        status = "error"
+    return kind, status, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    """Per-kind (and "all") count, errors, req/s and latency percentiles in ms"""
+    rows = {}
+    for kind in (*KINDS, "all"):
+        picked = [r for r in results if kind in (r[0], "all")]
+        if not picked:
+            continue
+        ok = [seconds * 1000 for _, status, seconds in picked if status == 200]
+        rows[kind] = {
+            "count": len(picked),
+            "errors": len(picked) - len(ok),
+            "rps": len(picked) / elapsed,
+            **{f"p{p}": percentile(ok, p) if ok else None for p in (50, 95, 99)},
+        }
+    return rows
+
+
+def print_rows(rows):
+    def ms(value):
+        return f"{value:>7.0f} ms" if value is not None else f"{'-':>10}"
+
+    print(f"  {'kind':<8} {'count':>6} {'errors':>7} {'req/s':>8} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for kind, row in rows.items():
+        print(f"  {kind:<8} {row['count']:>6} {row['errors']:>7} {row['rps']:>8.2f} "
+              f"{ms(row['p50'])} {ms(row['p95'])} {ms(row['p99'])}")
+
+
+def run(mode, workers, args, stubs, image):
+    plan_random = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    plan = [(kind, n) for n, kind in enumerate(plan_random.choices(kinds, weights, k=args.requests))]
+    before = {name: dict(stub.counters) for name, stub in stubs.items()}
+
+    proc, base = start_server(
+        mode, workers, stubs["gemini"].base_url,
+        WEATHER_API_BASE=stubs["weather"].base_url, WEATHER_API_KEY="bench",
+        NEWS_API_BASE=stubs["news"].base_url, NEWS_API_KEY="bench",
+        SESSION_DB="", ASK_COALESCE_DIR="",
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(lambda item: send(base, *item, image), plan))
+            elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    injected = ", ".join(
+        f"{name} {stub.counters['errors'] - before[name]['errors']}/"
+        f"{stub.counters['requests'] - before[name]['requests']}"
+        for name, stub in stubs.items()
+    )
+    print(f"\n{mode} workers={workers}: {len(plan)} requests in {elapsed:.1f} s, "
+          f"{len(plan) / elapsed:.2f} req/s (upstream errors injected/calls: {injected})")
+    rows = summarize(results, elapsed)
+    print_rows(rows)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--workers", type=int, help="gunicorn workers (default: 2 sync, 1 async)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=5,code=2,weather=2,news=1,image=1"))
+    parser.add_argument("--gemini-latency", default="lognormal:0.8,4",
+                        help="seconds per Gemini reply: a number, uniform:a,b, normal:mean,sd or lognormal:median,p99")
+    parser.add_argument("--weather-latency", default="lognormal:0.15,0.8")
+    parser.add_argument("--news-latency", default="lognormal:0.2,1")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="share of upstream calls that fail")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    stubs = {
+        "gemini": GeminiStub(latency=args.gemini_latency, chunk_delay=0, error_rate=args.error_rate, seed=args.seed),
+        "weather": WeatherStub(latency=args.weather_latency, error_rate=args.error_rate, seed=args.seed),
+        "news": NewsStub(latency=args.news_latency, error_rate=args.error_rate, seed=args.seed),
+    }
+    for stub in stubs.values():
+        stub.start()
+    print("upstream latency: " + ", ".join(f"{name} {stub.latency}" for name, stub in stubs.items())
+          + f"; error rate {args.error_rate:g}; mix "
+          + ", ".join(f"{kind}={weight:g}" for kind, weight in args.mix.items()))
+
+    image = sample_jpeg()
+    results = {}
+    try:
+        for mode in args.modes.split(","):
+            workers = args.workers or (1 if mode == "async" else 2)
+            results[mode] = run(mode, workers, args, stubs, image)
+    finally:
+        for stub in stubs.values():
+            stub.stop()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key != "save"},
+                       "results": results}, f, indent=2)
+        print(f"\nSaved to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Markdown rendering cost per reply: markdown.markdown() versus MarkdownRenderer.
+
+    python benchmarks/bench_markdown.py [--rounds 50]
+
+Replies are shaped like real Gemini answers: long fenced code in a few
+languages, wide tables, and a mix of prose, lists and short snippets.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown  # noqa: E402
+import pygments.formatters  # noqa: E402
+import pygments.lexers  # noqa: E402
+from markdown.extensions import codehilite  # noqa: E402
+
+from markdown_renderer import MarkdownRenderer, cached_formatter_by_name, cached_lexer_by_name  # noqa: E402
+
+EXTENSIONS = ["fenced_code", "codehilite", "tables", "nl2br"]
+
+PYTHON_BLOCK = '''```python
+class LRUCache:
+    """Least-recently-used cache with O(1) get and put"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+```
+'''
+
+JS_BLOCK = '''```javascript
+async function fetchWithRetry(url, options = {}, retries = 3) {
+    for (let attempt = 0; attempt <= retries; attempt++) {
+        try {
+            const response = await fetch(url, options);
+            if (response.ok) return response.json();
+            if (response.status < 500) throw new Error(`HTTP ${response.status}`);
+        } catch (err) {
+            if (attempt === retries) throw err;
+        }
+        await new Promise(r => setTimeout(r, 2 ** attempt * 100));
+    }
+}
+```
+'''
+
+
+def long_code_reply():
+    parts = ["Here is a complete implementation, split into modules.\n"]
+    for n in range(6):
+        parts.append(f"### Part {n + 1}\n\nThe next piece builds on the previous one.\n")
+        parts.append(PYTHON_BLOCK if n % 2 == 0 else JS_BLOCK)
+    return "\n".join(parts)
+
+
+def table_reply():
+    rows = "\n".join(
+        f"| {name} | O(n log n) | O({'n' if n % 2 else '1'}) | {'Yes' if n % 3 else 'No'} | notes {n} |"
+        for n, name in enumerate(["Merge sort", "Quick sort", "Heap sort", "Tim sort", "Shell sort"] * 8)
+    )
+    return ("Comparison of sorting algorithms:\n\n"
+            "| Algorithm | Time | Space | Stable | Notes |\n|---|---|---|---|---|\n"
+            f"{rows}\n\nPick Tim sort for real-world data.\n")
+
+
+def mixed_reply():
+    return ("**Summary**\nThe service answers in three steps:\n\n"
+            "1. Parse the request\n2. Route the intent\n3. Render the reply\n\n"
+            "Use `ROUTER.route()` for text commands.\n\n" + PYTHON_BLOCK +
+            "\n> Note: cache keys include the generation config.\n\n" + table_reply()[:600])
+
+
+REPLIES = {"long code": long_code_reply(), "table": table_reply(), "mixed": mixed_reply()}
+
+
+def uncached_lookups(enabled):
+    """Point codehilite back at the plain Pygments lookups (the baseline) or not"""
+    codehilite.get_lexer_by_name = pygments.lexers.get_lexer_by_name if enabled else cached_lexer_by_name
+    codehilite.get_formatter_by_name = (pygments.formatters.get_formatter_by_name
+                                        if enabled else cached_formatter_by_name)
+
+
+def timeit(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    pooled = MarkdownRenderer(EXTENSIONS, cache_size=0)
+    cached = MarkdownRenderer(EXTENSIONS)
+    print(f"{'reply':<10} {'chars':>6} {'markdown()':>12} {'pooled':>10} {'cache hit':>10}")
+    for name, text in REPLIES.items():
+        assert pooled.render(text) == markdown.markdown(text, extensions=EXTENSIONS)
+        uncached_lookups(True)
+        fresh = timeit(lambda: markdown.markdown(text, extensions=EXTENSIONS), args.rounds)
+        uncached_lookups(False)
+        reused = timeit(lambda: pooled.render(text), args.rounds)
+        cached.render(text)
+        hit = timeit(lambda: cached.render(text), args.rounds)
+        print(f"{name:<10} {len(text):>6} {fresh:>9.2f} ms {reused:>7.2f} ms {hit:>7.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Micro-benchmark: cost of routing one command in perform_task_web.
+
+Compares the precompiled IntentRouter against the previous approach of
+looping over the personal-info patterns, the code triggers and the writing
+keywords one ``re.search`` at a time. Only classification is timed; no
+handler (and so no network call) is executed.
+
+    python benchmarks/bench_routing.py [--iterations 20000]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import CODE_TRIGGERS, ROUTER, WRITING_KEYWORDS  # noqa: E402
+
+COMMANDS = [
+    "write code for quicksort in python",
+    "what is your name",
+    "what's the weather in dhaka",
+    "tell me a joke",
+    "latest news please",
+    "open youtube",
+    "search for flask streaming responses",
+    "youtube search lofi beats",
+    "write an essay about climate change",
+    "implement a function to reverse a linked list",
+    "explain how transformers work in machine learning",
+    "where do you live",
+    "what is the capital of bangladesh and how big is its population",
+    "create a program that parses csv files and prints a summary table " * 3,
+]
+
+LEGACY_PERSONAL = [
+    "your name", "time", "date", "year", "birth date", "birthday",
+    "where.*live", "father.*name", "mother.*name", "religion", "joke", "news",
+]
+
+
+def legacy_classify(cmd):
+    """The pre-router matching order, minus the eager handler calls"""
+    if "weather" in cmd:
+        return "weather"
+    for pattern in LEGACY_PERSONAL:
+        if re.search(pattern, cmd):
+            return pattern
+    if cmd.startswith("open "):
+        return "open"
+    if "search for" in cmd:
+        return "search"
+    if "youtube" in cmd and "search" in cmd:
+        return "youtube_search"
+    is_writing = any(keyword in cmd for keyword in WRITING_KEYWORDS)
+    if any(re.search(p, cmd) for p in CODE_TRIGGERS) and not is_writing:
+        return "code"
+    return None
+
+
+def timeit(fn, commands, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for cmd in commands:
+            fn(cmd)
+    elapsed = time.perf_counter() - start
+    return elapsed / (iterations * len(commands)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    commands = [c.lower() for c in COMMANDS]
+    print(f"{'command':<60} {'intent':<15} {'router µs':>10} {'legacy µs':>10}")
+    for cmd in commands:
+        n = max(args.iterations // 10, 1)
+        router_us = timeit(ROUTER.match, [cmd], n)
+        legacy_us = timeit(legacy_classify, [cmd], n)
+        print(f"{cmd[:58]:<60} {str(ROUTER.match(cmd)):<15} {router_us:>10.2f} {legacy_us:>10.2f}")
+
+    router_us = timeit(ROUTER.match, commands, args.iterations)
+    legacy_us = timeit(legacy_classify, commands, args.iterations)
+    print(f"\nmean per command: router {router_us:.2f} µs, legacy loop {legacy_us:.2f} µs "
+          f"(legacy also ran news/joke/time handlers on every call)")
+
+
+if __name__ == "__main__":
+    main()
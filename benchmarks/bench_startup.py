@@ -0,0 +1,147 @@
+"""Cold start: time from a fresh interpreter to the first responses, and import costs.
+
+    python benchmarks/bench_startup.py [--runs 5] [--save startup.json | --compare startup.json]
+
+Each run is a new interpreter, like a machine Fly has just started: it
+imports app, then serves GET / and a Gemini-backed /ask (answered by a local
+stub, reply with a code block) through the Flask test client. "cold" runs
+take the requests straight away; "warmed" runs call app.warm_up() first, as
+the gunicorn post_worker_init hook does while the worker takes traffic.
+
+The import cost of each module app.py pulls in comes from ``python -X
+importtime``. --save writes the medians to a JSON file; --compare reads one
+back, prints the differences and exits with status 1 if the total or any
+module got slower by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import GeminiStub  # noqa: E402
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, ".")
+import app
+phases = {"import": time.perf_counter() - started}
+if sys.argv[1] == "warmed":
+    mark = time.perf_counter()
+    app.warm_up()
+    phases["warm_up"] = time.perf_counter() - mark
+client = app.app.test_client()
+mark = time.perf_counter()
+assert client.get("/").status_code == 200
+phases["first_page"] = time.perf_counter() - mark
+mark = time.perf_counter()
+reply = client.post("/ask", json={"command": "write python code for quicksort"}).get_json()
+assert "codehilite" in reply["response"], reply
+phases["first_ask"] = time.perf_counter() - mark
+app.CPU_POOL.shutdown()
+print(json.dumps({name: seconds * 1000 for name, seconds in phases.items()}))
+"""
+
+
+def child_env(gemini_base):
+    return dict(os.environ, GEMINI_API_BASE=gemini_base, API_KEY="bench", NEWS_PREFETCH="0",
+                ASK_CACHE_DB="", SESSION_DB="", ASK_COALESCE_DIR="", PYTHONWARNINGS="ignore")
+
+
+def run_child(mode, env):
+    out = subprocess.run([sys.executable, "-c", CHILD, mode], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def import_costs(env):
+    """Milliseconds per module imported while importing app (cumulative, self included)"""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stderr
+    entries = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, name.strip(), int(cumulative) / 1000))
+    # Children are listed before their parent: app's direct imports are the
+    # depth-1 entries in the block just above the depth-0 "app" line
+    end = next(i for i, entry in enumerate(entries) if entry[:2] == (0, "app"))
+    start = end
+    while start > 0 and entries[start - 1][0] >= 1:
+        start -= 1
+    costs = {name: ms for depth, name, ms in entries[start:end] if depth == 1}
+    costs["(total)"] = entries[end][2]
+    return costs
+
+
+def median_of(samples):
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def compare(baseline, current, tolerance):
+    """Print what changed; return the keys that regressed beyond ``tolerance`` (0.2 = 20 %)"""
+    regressed = []
+    print(f"\n{'module':<28} {'baseline':>10} {'now':>10} {'change':>10}")
+    for name in sorted(set(baseline) | set(current), key=lambda n: -current.get(n, 0)):
+        before, now = baseline.get(name), current.get(name)
+        if before is None or now is None:
+            print(f"{name:<28} {before or 0:>7.1f} ms {now or 0:>7.1f} ms {'new' if before is None else 'gone':>10}")
+            continue
+        # Small modules jitter by a millisecond or two; don't flag that
+        worse = now - before > max(2.0, before * tolerance)
+        if worse:
+            regressed.append(name)
+        if worse or abs(now - before) > 1.0:
+            print(f"{name:<28} {before:>7.1f} ms {now:>7.1f} ms {now - before:>+7.1f} ms{'  !' if worse else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="write the medians to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    stub = GeminiStub(chunk_delay=0)
+    env = child_env(stub.start())
+    results = {}
+    try:
+        print(f"{'mode':<8} {'import':>10} {'warm-up':>10} {'GET /':>10} {'first /ask':>11} {'to reply':>10}")
+        for mode in ("cold", "warmed"):
+            phases = median_of([run_child(mode, env) for _ in range(args.runs)])
+            results[mode] = phases
+            to_reply = phases["import"] + phases["first_page"] + phases["first_ask"]
+            print(f"{mode:<8} {phases['import']:>7.1f} ms {phases.get('warm_up', 0):>7.1f} ms "
+                  f"{phases['first_page']:>7.1f} ms {phases['first_ask']:>8.1f} ms {to_reply:>7.1f} ms")
+        modules = median_of([import_costs(env) for _ in range(args.runs)])
+    finally:
+        stub.stop()
+
+    print(f"\n{'imported by app':<28} {'cumulative':>10}")
+    for name, ms in sorted(modules.items(), key=lambda item: -item[1])[:15]:
+        print(f"{name:<28} {ms:>7.1f} ms")
+
+    current = {**modules, "(first /ask, cold)": results["cold"]["first_ask"]}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"\nSaved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), current, args.tolerance)
+        if regressed:
+            print(f"\nSlower than the baseline: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Page loads: requests and bytes for a first and a repeat visit, and time per GET /.
+
+    python benchmarks/bench_static.py [--visits 3] [--loops 2000]
+
+Loads / and every /static/ or /assets/ URL in it through the Flask test
+client, with a simulated browser cache: a response with max-age is reused
+without a request while fresh, anything else is revalidated with
+If-None-Match / If-Modified-Since. Each mode runs in a fresh interpreter:
+
+- assets: fingerprinted, precompressed files from assets.py, cached index page
+- plain: the same app with no built assets (STATIC_DIR / ASSETS_DIR pointed
+  at nothing), so pages link to static/ and Flask's static handler serves it
+
+A GET / is also timed in each mode, with the browser sending
+Accept-Encoding: gzip, br.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHILD = """
+import gzip, json, re, sys, time
+sys.path.insert(0, ".")
+import app
+visits, loops = int(sys.argv[1]), int(sys.argv[2])
+client = app.app.test_client()
+ACCEPT = {"Accept-Encoding": "gzip, br"}
+cache = {}  # url -> (response headers, body, fetched at)
+
+
+def decoded(response):
+    data = response.get_data()
+    encoding = response.headers.get("Content-Encoding")
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(data)
+    return gzip.decompress(data) if encoding == "gzip" else data
+
+
+def get(url, now):
+    cached = cache.get(url)
+    if cached:
+        headers, body, fetched = cached
+        control = headers.get("Cache-Control", "")
+        max_age = re.search(r"max-age=(\\d+)", control)
+        if max_age and "no-cache" not in control and now - fetched < int(max_age.group(1)):
+            return body, None
+        conditional = {"If-None-Match": headers.get("ETag"), "If-Modified-Since": headers.get("Last-Modified")}
+        response = client.get(url, headers={**ACCEPT, **{k: v for k, v in conditional.items() if v}})
+    else:
+        response = client.get(url, headers=ACCEPT)
+    if response.status_code == 304:
+        cache[url] = (cached[0], cached[1], now)
+        return cached[1], response
+    body = decoded(response)
+    cache[url] = (dict(response.headers), body, now)
+    return body, response
+
+
+results = []
+for visit in range(visits):
+    now = visit * 3600  # an hour apart
+    page, response = get("/", now)
+    sent = [response]
+    for url in re.findall(r'(?:href|src)="(/(?:static|assets)/[^"]+)"', page.decode()):
+        sent.append(get(url, now)[1])
+    sent = [r for r in sent if r is not None]
+    results.append({
+        "requests": len(sent),
+        "not_modified": sum(r.status_code == 304 for r in sent),
+        "bytes": sum(len(r.get_data()) for r in sent),
+    })
+
+start = time.perf_counter()
+for _ in range(loops):
+    client.get("/", headers=ACCEPT)
+per_index = (time.perf_counter() - start) / loops * 1e6
+app.CPU_POOL.shutdown()
+print(json.dumps({"visits": results, "index_us": per_index}))
+"""
+
+
+def run_child(mode, args, tmp):
+    env = dict(os.environ, API_KEY="bench", NEWS_PREFETCH="0", CPU_POOL_WORKERS="0",
+               ASK_CACHE_DB="", SESSION_DB="", ASK_COALESCE_DIR="", PYTHONWARNINGS="ignore")
+    if mode == "assets":
+        env["ASSETS_DIR"] = os.path.join(tmp, "dist")
+    else:
+        env["STATIC_DIR"] = env["ASSETS_DIR"] = os.path.join(tmp, "none")
+    out = subprocess.run([sys.executable, "-c", CHILD, str(args.visits), str(args.loops)], cwd=ROOT,
+                         env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--visits", type=int, default=3)
+    parser.add_argument("--loops", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'mode':<8} {'visit':>5} {'requests':>9} {'304s':>5} {'bytes':>9}")
+        for mode in ("plain", "assets"):
+            result = run_child(mode, args, tmp)
+            for n, visit in enumerate(result["visits"], 1):
+                print(f"{mode:<8} {n:>5} {visit['requests']:>9} {visit['not_modified']:>5} {visit['bytes']:>9}")
+            print(f"{mode:<8} GET /: {result['index_us']:.0f} us\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Time to first content of /ask versus /ask/stream against a local Gemini stub.
+
+    python benchmarks/bench_stream.py [--requests 5] [--chunk-delay 0.05]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from stubs import GeminiStub  # noqa: E402
+
+PROMPT = "write code for quicksort in python"
+
+
+def measure(url, stream):
+    start = time.perf_counter()
+    with requests.post(url, json={"command": PROMPT, "no_cache": True}, stream=True, timeout=60) as r:
+        first = None
+        fragments = 0
+        for chunk in r.iter_content(chunk_size=None):
+            if first is None and (not stream or b"event: chunk" in chunk):
+                first = time.perf_counter() - start
+            if stream:
+                fragments += chunk.count(b"event: chunk")
+        total = time.perf_counter() - start
+    return first, total, fragments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    stub = GeminiStub(chunk_delay=args.chunk_delay)
+    os.environ["GEMINI_API_BASE"] = stub.start()
+    os.environ["RATE_LIMIT_PER_MINUTE"] = "0"
+
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    for path, stream in (("/ask", False), ("/ask/stream", True)):
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            runs = [measure(base + path, stream) for _ in range(args.requests)]
+        ttfb = statistics.median(r[0] for r in runs) * 1000
+        total = statistics.median(r[1] for r in runs) * 1000
+        print(f"{path:<12} first content {ttfb:8.1f} ms   total {total:8.1f} ms   fragments {runs[0][2]}")
+
+    server.shutdown()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
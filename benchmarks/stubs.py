@@ -0,0 +1,425 @@
+"""Local stand-ins for the upstream APIs, for benchmarks and offline runs.
+
+Run the stubs on their own and point the app at them:
+
+    python benchmarks/stubs.py --port 9100 --latency lognormal:0.8,4 --error-rate 0.02
+    GEMINI_API_BASE=http://127.0.0.1:9100/v1beta \
+    WEATHER_API_BASE=http://127.0.0.1:9101/data/2.5 WEATHER_API_KEY=stub \
+    NEWS_API_BASE=http://127.0.0.1:9102/v2 NEWS_API_KEY=stub python app.py
+
+or start them in-process with ``GeminiStub(...).start()``, ``WeatherStub``
+and ``NewsStub``. Latencies are a number of seconds or a distribution (see
+Latency); ``error_rate`` is the share of requests answered with the
+service's usual server error.
+"""
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = """Here is a quicksort implementation in Python.
+
+```python
+def quicksort(items):
+    \"\"\"Sort a list with the quicksort algorithm\"\"\"
+    if len(items) <= 1:
+        return items
+
+    pivot = items[len(items) // 2]
+    left = [x for x in items if x < pivot]
+    middle = [x for x in items if x == pivot]
+    right = [x for x in items if x > pivot]
+    return quicksort(left) + middle + quicksort(right)
+```
+
+| Case | Complexity |
+|------|------------|
+| Best | O(n log n) |
+| Worst | O(n^2) |
+
+The pivot choice matters: picking the middle element avoids the worst case
+on already sorted input.
+"""
+
+MODEL_PATH = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):(?P<method>\w+)")
+CACHE_PATH = re.compile(r"^/v1beta/(?P<name>cachedContents(?:/[\w-]+)?)(?:\?|$)")
+# Bodies up to this size are parsed (and kept in GeminiStub.requests); larger
+# ones, i.e. images, are only drained
+PARSE_LIMIT = 1024 * 1024
+
+
+class Latency:
+    """Seconds to wait before answering, drawn from a distribution
+
+    Written as "0.2" (always 0.2 s), "uniform:0.1,0.5", "normal:mean,stddev"
+    or "lognormal:median,p99", the long-tailed shape real APIs have.
+    """
+
+    # z-score of the 99th percentile of a normal distribution
+    _Z99 = 2.326
+
+    def __init__(self, kind="fixed", *params, seed=None):
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        self.kind = kind
+        self.params = tuple(float(p) for p in params) or (0.0,)
+        self._random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls("fixed", spec, seed=seed)
+        kind, _, params = str(spec).partition(":")
+        if not params:
+            return cls("fixed", kind, seed=seed)
+        return cls(kind, *params.split(","), seed=seed)
+
+    def sample(self):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self._random.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, self._random.gauss(*self.params))
+        median, p99 = self.params
+        if median <= 0:
+            return 0.0
+        sigma = math.log(max(p99, median) / median) / self._Z99
+        return self._random.lognormvariate(math.log(median), sigma)
+
+    def __str__(self):
+        if self.kind == "fixed":
+            return f"{self.params[0]:g}"
+        return f"{self.kind}:{','.join(f'{p:g}' for p in self.params)}"
+
+
+def _candidate(text, finish=None, usage=None):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finish:
+        candidate["finishReason"] = finish
+    event = {"candidates": [candidate]}
+    if usage:
+        event["usageMetadata"] = usage
+    return event
+
+
+def _tokens(value):
+    # The same rough four-bytes-per-token rule the app estimates with
+    return (len(json.dumps(value, ensure_ascii=False).encode("utf-8")) + 3) // 4
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _GeminiHandler(_Handler):
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= PARSE_LIMIT:
+            raw = self.rfile.read(length)
+            try:
+                return json.loads(raw) if raw else {}
+            except ValueError:
+                return {}
+        # Drained in pieces so large uploads don't skew memory measurements
+        while length > 0:
+            chunk = self.rfile.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            length -= len(chunk)
+        return None
+
+    def _send_error(self, code, message, status):
+        self._send_json(code, {"error": {"code": code, "message": message, "status": status}})
+
+    def do_GET(self):
+        match = CACHE_PATH.match(self.path)
+        cached = self.server.stub.cached_content(match.group("name")) if match else None
+        if cached is None:
+            self._send_error(404, "Not found", "NOT_FOUND")
+        else:
+            self._send_json(200, {key: value for key, value in cached.items() if key != "_expires"})
+
+    def do_DELETE(self):
+        match = CACHE_PATH.match(self.path)
+        with self.server.stub.lock:
+            found = match and self.server.stub.caches.pop(match.group("name"), None)
+        if found:
+            self._send_json(200, {})
+        else:
+            self._send_error(404, "Not found", "NOT_FOUND")
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self._read_body()
+        with stub.lock:
+            stub.requests.append((self.path.split("?")[0], body))
+
+        if CACHE_PATH.match(self.path):
+            self._send_json(200, stub.create_cached_content(body or {}))
+            return
+
+        match = MODEL_PATH.match(self.path)
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found"}})
+            return
+
+        usage = None
+        if body is not None:
+            prompt_tokens = _tokens(body.get("contents", [])) + _tokens(body.get("systemInstruction", ""))
+            usage = {"promptTokenCount": prompt_tokens}
+            if body.get("cachedContent"):
+                cached = stub.cached_content(body["cachedContent"])
+                if cached is None:
+                    # What Gemini answers for an expired or deleted cache
+                    self._send_error(403, "CachedContent not found (or permission denied)", "PERMISSION_DENIED")
+                    return
+                usage["cachedContentTokenCount"] = cached["usageMetadata"]["totalTokenCount"]
+                usage["promptTokenCount"] += usage["cachedContentTokenCount"]
+            usage["candidatesTokenCount"] = (len(stub.reply) + 3) // 4
+
+        time.sleep(stub.delay())
+        if stub.failing():
+            # What Gemini answers when the model is overloaded
+            self._send_error(503, "The model is overloaded. Please try again later.", "UNAVAILABLE")
+            return
+        if match.group("method") == "generateContent":
+            # The full reply takes as long to generate as the whole stream
+            time.sleep(stub.chunk_delay * len(list(stub.chunks())))
+            self._send_json(200, _candidate(stub.reply, "STOP", usage))
+        elif match.group("method") == "streamGenerateContent":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for text, finish in stub.chunks():
+                event = json.dumps(_candidate(text, finish, usage if finish else None))
+                self.wfile.write(f"data: {event}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(stub.chunk_delay)
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "Unknown method"}})
+
+
+class _Stub:
+    """A threaded HTTP server answering with ``handler``, after a delay drawn
+    from ``latency`` and with an ``error_rate`` share of failures"""
+
+    handler = None
+    path = ""
+
+    def __init__(self, latency=0.0, error_rate=0.0, host="127.0.0.1", port=0, seed=None):
+        self.latency = Latency.parse(latency, seed=seed)
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.server = ThreadingHTTPServer((host, port), self.handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = None
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0}
+
+    def delay(self):
+        with self.lock:
+            self.counters["requests"] += 1
+        return self.latency.sample()
+
+    def failing(self):
+        if self.error_rate <= 0 or self._random.random() >= self.error_rate:
+            return False
+        with self.lock:
+            self.counters["errors"] += 1
+        return True
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GeminiStub(_Stub):
+    """Canned Gemini generateContent / streamGenerateContent server, with
+    cachedContents (create, get, delete; honoured by cachedContent in requests)"""
+
+    handler = _GeminiHandler
+    path = "/v1beta"
+
+    def __init__(self, reply=DEFAULT_REPLY, chunk_size=40, chunk_delay=0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        # (path, parsed JSON body or None) of recent POSTs, for inspection
+        self.requests = collections.deque(maxlen=1000)
+        # name -> cachedContents resource
+        self.caches = {}
+        self._cache_ids = itertools.count(1)
+
+    def create_cached_content(self, body):
+        expires = time.time() + float(str(body.get("ttl", "3600s")).rstrip("s"))
+        name = f"cachedContents/stub-{next(self._cache_ids)}"
+        resource = {
+            "name": name,
+            "model": body.get("model"),
+            "contents": body.get("contents", []),
+            "systemInstruction": body.get("systemInstruction"),
+            "expireTime": datetime.datetime.fromtimestamp(expires, datetime.timezone.utc).isoformat(),
+            "_expires": expires,
+            "usageMetadata": {"totalTokenCount": _tokens(body.get("contents", []))
+                              + _tokens(body.get("systemInstruction", ""))},
+        }
+        with self.lock:
+            self.caches[name] = resource
+        return {key: value for key, value in resource.items() if key not in ("contents", "_expires")}
+
+    def cached_content(self, name):
+        with self.lock:
+            resource = self.caches.get(name)
+            if resource is not None and resource["_expires"] <= time.time():
+                del self.caches[name]
+                resource = None
+        return resource
+
+    def chunks(self):
+        pieces = [self.reply[i:i + self.chunk_size]
+                  for i in range(0, len(self.reply), self.chunk_size)]
+        for n, piece in enumerate(pieces):
+            yield piece, "STOP" if n == len(pieces) - 1 else None
+
+
+class _WeatherHandler(_Handler):
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(stub.delay())
+        if not url.path.endswith("/weather"):
+            self._send_json(404, {"cod": "404", "message": "Internal error"})
+        elif not query.get("appid"):
+            self._send_json(401, {"cod": 401, "message": "Invalid API key."})
+        elif stub.failing():
+            self._send_json(500, {"cod": "500", "message": "Internal error"})
+        else:
+            self._send_json(200, stub.report(float(query.get("lat", 0)), float(query.get("lon", 0))))
+
+
+class WeatherStub(_Stub):
+    """OpenWeatherMap /data/2.5/weather: a made-up but stable report per coordinate"""
+
+    handler = _WeatherHandler
+    path = "/data/2.5"
+    CONDITIONS = [("Clear", "clear sky", "01d"), ("Clouds", "scattered clouds", "03d"),
+                  ("Rain", "light rain", "10d"), ("Mist", "mist", "50d")]
+
+    def report(self, lat, lon):
+        seed = zlib.crc32(f"{lat:.2f},{lon:.2f}".encode())
+        main, description, icon = self.CONDITIONS[seed % len(self.CONDITIONS)]
+        temp = round(30 - abs(lat) / 3 + seed % 50 / 10, 1)
+        return {
+            "coord": {"lat": lat, "lon": lon},
+            "weather": [{"id": 800, "main": main, "description": description, "icon": icon}],
+            "main": {"temp": temp, "feels_like": round(temp + 1.5, 1), "humidity": 40 + seed % 50},
+            "name": "Stub City",
+            "cod": 200,
+        }
+
+
+class _NewsHandler(_Handler):
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        time.sleep(stub.delay())
+        if not url.path.endswith("/top-headlines"):
+            self._send_json(404, {"status": "error", "code": "routeNotFound", "message": "Not found"})
+        elif not query.get("apiKey"):
+            self._send_json(401, {"status": "error", "code": "apiKeyMissing", "message": "Your API key is missing."})
+        elif stub.failing():
+            self._send_json(500, {"status": "error", "code": "unexpectedError", "message": "Something went wrong."})
+        else:
+            count = min(int(query.get("pageSize") or 20), 100)
+            self._send_json(200, stub.headlines(query.get("country", "us"), query.get("category"), count))
+
+
+class NewsStub(_Stub):
+    """NewsAPI /v2/top-headlines: ``count`` numbered articles per country and category"""
+
+    handler = _NewsHandler
+    path = "/v2"
+
+    def headlines(self, country, category, count):
+        topic = category or "general"
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
+        articles = [{
+            "source": {"id": None, "name": "Stub Wire"},
+            "title": f"{topic.title()} headline {n} ({country.upper()})",
+            "description": f"Story {n} in {topic}.",
+            "url": f"https://news.example/{country}/{topic}/{n}",
+            "publishedAt": now,
+        } for n in range(1, count + 1)]
+        return {"status": "ok", "totalResults": count, "articles": articles}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local Gemini, OpenWeatherMap and NewsAPI stubs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100,
+                        help="Gemini port; weather and news listen on the next two")
+    parser.add_argument("--latency", default="0", help="Gemini seconds before the first byte, or a distribution")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="seconds between stream chunks")
+    parser.add_argument("--weather-latency", default="0")
+    parser.add_argument("--news-latency", default="0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail, e.g. 0.02")
+    args = parser.parse_args()
+
+    stubs = [
+        ("GEMINI_API_BASE", GeminiStub(latency=args.latency, chunk_delay=args.chunk_delay,
+                                       error_rate=args.error_rate, host=args.host, port=args.port)),
+        ("WEATHER_API_BASE", WeatherStub(latency=args.weather_latency, error_rate=args.error_rate,
+                                         host=args.host, port=args.port + 1)),
+        ("NEWS_API_BASE", NewsStub(latency=args.news_latency, error_rate=args.error_rate,
+                                   host=args.host, port=args.port + 2)),
+    ]
+    for name, stub in stubs:
+        stub.start()
+        print(f"{name}={stub.base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for _, stub in stubs:
+            stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Run CPU-bound request stages in a small pool of worker processes.
+
+Threads in a gunicorn worker share one GIL, so while one request spends 20 ms
+highlighting code or formatting a long analysis, every other request in that
+worker waits. CpuPool hands such work to separate processes. Small inputs are
+not worth pickling them across, so anything under the caller's threshold runs
+inline, and so does everything when the pool is disabled or its queue is full.
+
+The pool is opt-in (CPU_POOL_WORKERS, default 0): each gunicorn worker gets
+its own processes, each holding the preloaded modules, which a small VM may
+not have the memory for. They start with the first task above a threshold.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Modules the workers import up front, so the first task doesn't pay for them
+# (image_ingest leaves Pillow to its first use, so it is listed too)
+PRELOAD = ["cpu_tasks", "image_ingest", "PIL.Image"]
+
+
+def _call(fn, args):
+    # Wall-clock stamps: perf_counter values aren't comparable across processes
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time()
+
+
+class CpuPool:
+    def __init__(self, workers=0, max_pending=8, on_run=None, on_depth=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        # on_run(task, where, seconds, queued) and on_depth(pending), e.g. for metrics
+        self.on_run = on_run
+        self.on_depth = on_depth
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self.counters = {"inline": 0, "pooled": 0, "queue_full": 0, "failures": 0, "restarts": 0}
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        workers = int(os.environ.get("CPU_POOL_WORKERS", 0))
+        return cls(
+            workers=workers,
+            max_pending=int(os.environ.get("CPU_POOL_QUEUE", workers * 4)),
+            **kwargs,
+        )
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _pool(self):
+        # Created on first use, i.e. inside the gunicorn worker, never in the master
+        if self._executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            # Not fork: a forked child inherits locks other request threads are holding
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if context.get_start_method() == "forkserver":
+                context.set_forkserver_preload(PRELOAD)
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+        return self._executor
+
+    def _report(self, task, where, seconds, queued=0.0):
+        if self.on_run:
+            self.on_run(task, where, seconds, queued)
+
+    def _run_inline(self, task, fn, args):
+        self.counters["inline"] += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._report(task, "inline", time.perf_counter() - start)
+
+    def _released(self, _future):
+        with self._lock:
+            self.pending -= 1
+            depth = self.pending
+        if self.on_depth:
+            self.on_depth(depth)
+
+    def run(self, task, fn, *args, size=0, threshold=0, inline=None):
+        """``fn(*args)``, in a worker process when ``size`` reaches ``threshold``
+
+        ``fn`` must be a module-level function and ``args`` picklable.
+        ``inline(*args)``, if given, runs instead of ``fn`` whenever the work
+        stays in this process (e.g. with the caller's own warm state).
+        Exceptions raised by ``fn`` reach the caller either way.
+        """
+        local = inline or fn
+        if not self.enabled or size < threshold:
+            return self._run_inline(task, local, args)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                full = True
+            else:
+                full = False
+                self.pending += 1
+                depth = self.pending
+        if full:
+            # Waiting behind a long queue would be slower than doing it here
+            self.counters["queue_full"] += 1
+            return self._run_inline(task, local, args)
+        if self.on_depth:
+            self.on_depth(depth)
+
+        submitted = time.time()
+        try:
+            with self._lock:
+                executor = self._pool()
+            future = executor.submit(_call, fn, args)
+        except Exception as e:
+            self._released(None)
+            log.warning("CPU pool unavailable, running %s inline: %s", task, e)
+            self.counters["failures"] += 1
+            return self._run_inline(task, local, args)
+        future.add_done_callback(self._released)
+
+        try:
+            result, started, finished = future.result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # A worker died (OOM, segfault in a C extension): start a fresh pool next time
+            log.warning("CPU pool worker died during %s, retrying inline: %s", task, e)
+            self.counters["failures"] += 1
+            self._restart(executor)
+            return self._run_inline(task, local, args)
+        self.counters["pooled"] += 1
+        self._report(task, "pool", finished - started, max(0.0, started - submitted))
+        return result
+
+    def _restart(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                return  # another thread already replaced it
+            self._executor = None
+        self.counters["restarts"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def start(self):
+        """Bring the worker processes up now rather than on the first offloaded task"""
+        if not self.enabled:
+            return
+        with self._lock:
+            executor = self._pool()
+        # Processes are spawned as tasks arrive: one no-op each starts them all
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "started": self._executor is not None,
+        }
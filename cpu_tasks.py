@@ -0,0 +1,86 @@
+"""Functions CpuPool runs in worker processes.
+
+Workers import this module, not app.py, so they start without Flask, the
+caches or the background threads; keep it free of app imports.
+"""
+from markdown_renderer import MarkdownRenderer
+
+_renderers = {}
+
+
+def render_markdown(text, extensions):
+    """Markdown → HTML in a worker; the caller keeps the HTML cache"""
+    key = tuple(extensions)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        renderer = _renderers[key] = MarkdownRenderer(extensions, cache_size=0)
+    return renderer.convert(text)
+
+
+def format_image_analysis_with_info(text, image_type, image_size):
+    """Format analysis with image information"""
+    if not text:
+        return ""
+    
+    # Clean and format the text
+   
+    
+    # Add image info header
+    file_size_kb = image_size / 1024
+    format_name = image_type.split('/')[-1].upper()
+    
+    info_html = f"""
+    <div class="image-info-card">
+        <div class="image-info-header">
+            <i class="fas fa-file-image"></i>
+            <h4>Image Details</h4>
+        </div>
+        <div class="image-info-details">
+            <div><strong>Format:</strong> {format_name}</div>
+            <div><strong>Size:</strong> {file_size_kb:.1f} KB</div>
+            <div><strong>Type:</strong> {image_type}</div>
+        </div>
+    </div>
+    """
+    
+    # Format the analysis text
+    lines = text.split('\n')
+    formatted_lines = []
+    in_list = False
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if in_list:
+                formatted_lines.append('</ul>')
+                in_list = False
+            continue
+            
+        # Check for numbered or bullet points
+        if line.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.', '- ', '* ', '• ')):
+            if not in_list:
+                formatted_lines.append('<ul class="analysis-list">')
+                in_list = True
+            
+            # Remove the number/bullet
+            if line.startswith(tuple(str(i) + '.' for i in range(1, 10))):
+                line = line[line.find('.')+1:].strip()
+            else:
+                line = line[2:].strip() if len(line) > 2 else line
+            
+            formatted_lines.append(f'<li>{line}</li>')
+        else:
+            if in_list:
+                formatted_lines.append('</ul>')
+                in_list = False
+            
+            # Check if it's a heading
+            if line.endswith(':') and len(line) < 50:
+                formatted_lines.append(f'<h4 class="analysis-heading">{line}</h4>')
+            else:
+                formatted_lines.append(f'<p class="analysis-paragraph">{line}</p>')
+    
+    if in_list:
+        formatted_lines.append('</ul>')
+    
+    return info_html + '<div class="analysis-content">' + ''.join(formatted_lines) + '</div>'
@@ -0,0 +1,77 @@
+"""Per-request deadlines.
+
+A request gets a deadline when it arrives (REQUEST_DEADLINE seconds, or
+less if the client sends X-Request-Timeout). It lives in a context
+variable, so it follows the request through routing, worker threads that
+copy the context and the upstream client, which shortens every timeout and
+skips retries to fit in what is left. Code running outside a request
+(background refreshes, summaries) has no deadline and keeps its own
+timeouts.
+"""
+import contextlib
+import contextvars
+import os
+import time
+
+# Seconds a request may take end to end, and the most a client may ask for
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 90))
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time; answered with 504"""
+
+    def __init__(self, message="The request took too long, please try again."):
+        super().__init__(message)
+
+
+def requested(headers):
+    """Seconds this request may take: X-Request-Timeout if shorter than REQUEST_DEADLINE"""
+    try:
+        asked = float(headers.get("X-Request-Timeout") or 0)
+    except ValueError:
+        asked = 0
+    return min(asked, REQUEST_DEADLINE) if asked > 0 else REQUEST_DEADLINE
+
+
+def start(seconds):
+    """Give the current context a deadline ``seconds`` from now (never a later
+    one than it has); returns the token for finish()"""
+    current = _deadline.get()
+    at = time.monotonic() + seconds
+    return _deadline.set(at if current is None else min(current, at))
+
+
+def finish(token):
+    _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def within(seconds):
+    token = start(seconds)
+    try:
+        yield
+    finally:
+        finish(token)
+
+
+def remaining():
+    """Seconds left, or None without a deadline"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def clamp(seconds):
+    """``seconds`` cut down to the time left; DeadlineExceeded when none is"""
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if seconds is None else min(seconds, left)
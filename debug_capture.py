@@ -0,0 +1,98 @@
+"""Sampled in-memory capture of raw Gemini exchanges, for debugging.
+
+Replaces the raw_gemini_response.json / raw_reply.txt dumps that every call
+used to write. A sampled exchange is handed to a background thread, which
+serializes it into a bounded ring; the request thread only pays for a random
+draw and a queue put. Captures are read back through a token-guarded
+endpoint. Sampling is off unless DEBUG_CAPTURE_RATE is set.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class DebugCapture:
+    def __init__(self, capacity=50, sample_rate=0.0, max_pending=100):
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self._ring = collections.deque(maxlen=capacity)
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.counters = {"seen": 0, "sampled": 0, "dropped": 0, "serialize_errors": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            capacity=int(os.environ.get("DEBUG_CAPTURE_SIZE", 50)),
+            sample_rate=float(os.environ.get("DEBUG_CAPTURE_RATE", 0)),
+        )
+
+    @property
+    def enabled(self):
+        return self.capacity > 0 and self.sample_rate > 0
+
+    def capture(self, kind, **fields):
+        """Maybe record an exchange; ``fields`` must not be mutated afterwards"""
+        if not self.enabled:
+            return
+        self.counters["seen"] += 1
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self._start()
+        captured_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds")
+        try:
+            self._pending.put_nowait((kind, captured_at, fields))
+            self.counters["sampled"] += 1
+        except queue.Full:
+            # The writer is behind; debugging data is not worth blocking a request for
+            self.counters["dropped"] += 1
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="debug-capture", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            kind, captured_at, fields = self._pending.get()
+            try:
+                # Serialize now so later reads see a snapshot, not live objects
+                body = json.dumps(fields, ensure_ascii=False, default=str)
+            except (TypeError, ValueError) as e:
+                self.counters["serialize_errors"] += 1
+                log.warning("Debug capture failed: %s", e)
+                continue
+            self._seq += 1
+            self._ring.append({"id": self._seq, "kind": kind, "captured_at": captured_at, "body": body})
+
+    def recent(self, limit=None, kind=None):
+        """Newest first"""
+        entries = [e for e in reversed(list(self._ring)) if kind is None or e["kind"] == kind]
+        if limit is not None:
+            entries = entries[:limit]
+        return [{**{k: v for k, v in e.items() if k != "body"}, **json.loads(e["body"])} for e in entries]
+
+    def clear(self):
+        self._ring.clear()
+
+    def stats(self):
+        return {
+            **self.counters,
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "entries": len(self._ring),
+            "capacity": self.capacity,
+            "pending": self._pending.qsize(),
+        }
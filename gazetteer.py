@@ -0,0 +1,318 @@
+"""Offline place-name index for weather queries.
+
+`python gazetteer.py build [source.tsv] [index]` turns a GeoNames-style
+dump (the tab-separated cities*.txt layout; data/gazetteer.tsv is a small
+seed in that layout) into one binary file:
+
+- places: fixed-size records (coordinates, population, country, name)
+- names: every normalized name and alternate name, sorted, each pointing
+  at its place; the most populous place comes first among equal names
+- fuzzy: every one-letter deletion of each place's main name, sorted
+
+Places are stored most populous first, so a smaller index wins a tie.
+
+Gazetteer memory-maps that file, so the index is never parsed (only a
+sample of keys is read when it opens) and every worker on a machine shares
+the same pages through the page cache. Lookups are binary searches over
+the sorted tables: find() walks a query word by
+word like a trie, extending a phrase while some name starts with it, to
+pick out multi-word names ("cox's bazar", "new york"); closest() matches a
+name with one typo (insertion, deletion, substitution or swap) through the
+deletion table.
+"""
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import unicodedata
+from collections import namedtuple
+
+Place = namedtuple("Place", "name lat lon country population")
+
+MAGIC = b"GAZ1"
+# magic, places (count, offset), names (count, offset), fuzzy (count, offset), strings offset
+HEADER = struct.Struct("<4sIIIIIII")
+# lat, lon, population, name offset, name length, country
+PLACE = struct.Struct("<ddIIH2s")
+# key offset, key length, place index
+ENTRY = struct.Struct("<IHI")
+
+# Words a place name is never looked up from; they start no match, but
+# can appear inside one
+STOPWORDS = frozenset(
+    "a an and at city for forecast how in is it like me now of please right show "
+    "tell temperature the today todays tomorrow tonight weather what whats will".split()
+)
+# Shorter names are left out, they match too many words; alternate names
+# need one letter more, which leaves out codes like "DAC"
+MIN_NAME_LENGTH = 3
+MIN_FUZZY_LENGTH = 4
+# Longest name, in words, find() tries to extend a phrase to
+MAX_WORDS = 5
+# Every SAMPLE_STRIDE-th key of each table is kept in memory, so a search
+# bisects that list and only probes the mapped file within one stride
+SAMPLE_STRIDE = 16
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCE = os.path.join(HERE, "data", "gazetteer.tsv")
+DEFAULT_INDEX = os.path.join(HERE, "data", "gazetteer.idx")
+
+
+def _word_char(c):
+    # Letters, digits and the vowel signs of scripts like Bengali
+    return c.isalnum() or unicodedata.category(c).startswith("M")
+
+
+def normalize(text):
+    """Lowercase, accents folded, apostrophes dropped, anything else that
+    isn't part of a word turned into single spaces"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c) and c not in "'’")
+    return " ".join("".join(c if _word_char(c) else " " for c in text).split())
+
+
+def deletions(key):
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+def one_edit_apart(a, b):
+    """True if ``b`` is ``a`` with at most one letter added, dropped or
+    changed, or two neighbouring letters swapped"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) > len(b):
+        return a[i + 1:] == b[i:]
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    # Same length: one letter changed, or this one and the next swapped
+    return a[i + 1:] == b[i + 1:] or (a[i:i + 1] == b[i + 1:i + 2] and a[i + 1:i + 2] == b[i:i + 1]
+                                      and a[i + 2:] == b[i + 2:])
+
+
+# =========== BUILD ===========
+def read_geonames(path, min_population=0):
+    """(name, ascii name, alternate names, lat, lon, country, population) of
+    each populated place in a GeoNames cities*.txt / allCountries.txt file"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 15 or fields[6] not in ("P", ""):
+                continue
+            population = int(fields[14] or 0)
+            if population < min_population:
+                continue
+            alternates = [name for name in fields[3].split(",") if name]
+            yield (fields[1], fields[2] or fields[1], alternates,
+                   float(fields[4]), float(fields[5]), fields[8][:2], population)
+
+
+def build(source=DEFAULT_SOURCE, out=DEFAULT_INDEX, min_population=0):
+    """Write the index for ``source`` to ``out`` (atomically); returns the place count"""
+    places = sorted(read_geonames(source, min_population), key=lambda place: -place[6])
+    strings = bytearray()
+
+    def intern(text):
+        data = text.encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    records, names, fuzzy = [], {}, set()
+    for index, (name, ascii_name, alternates, lat, lon, country, population) in enumerate(places):
+        records.append((lat, lon, population, *intern(name), country.encode("ascii", "ignore").ljust(2)))
+        keys = {normalize(name), normalize(ascii_name)}
+        keys.update(key for key in map(normalize, alternates) if len(key) > MIN_NAME_LENGTH)
+        for key in keys:
+            if len(key) >= MIN_NAME_LENGTH:
+                # Places are in population order, so the first one stays first
+                names.setdefault(key, []).append(index)
+        main = normalize(name)
+        if len(main) >= MIN_FUZZY_LENGTH:
+            fuzzy.update((variant, index) for variant in deletions(main))
+
+    def table(pairs):
+        # Sorted by UTF-8 bytes, the order the reader's binary search compares in
+        pairs = sorted(((key.encode("utf-8"), index) for key, index in pairs), key=lambda p: (p[0], p[1]))
+        packed = bytearray()
+        for key, index in pairs:
+            offset = len(strings)
+            strings.extend(key)
+            packed += ENTRY.pack(offset, len(key), index)
+        return len(pairs), packed
+
+    name_count, name_table = table((key, index) for key, indexes in names.items() for index in indexes)
+    fuzzy_count, fuzzy_table = table(fuzzy)
+    place_table = b"".join(PLACE.pack(*record) for record in records)
+
+    places_offset = HEADER.size
+    names_offset = places_offset + len(place_table)
+    fuzzy_offset = names_offset + len(name_table)
+    strings_offset = fuzzy_offset + len(fuzzy_table)
+    tmp = f"{out}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), places_offset, name_count, names_offset,
+                            fuzzy_count, fuzzy_offset, strings_offset))
+        f.write(place_table)
+        f.write(name_table)
+        f.write(fuzzy_table)
+        f.write(strings)
+    os.replace(tmp, out)
+    return len(records)
+
+
+# =========== LOOKUP ===========
+class Gazetteer:
+    """Read-only view of an index file built by build()"""
+
+    def __init__(self, path=DEFAULT_INDEX):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.places, self._places, names, names_offset, fuzzy, fuzzy_offset, self._strings = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gazetteer index")
+        self._names = self._table(names, names_offset)
+        self._fuzzy = self._table(fuzzy, fuzzy_offset)
+        self.path = path
+
+    def _table(self, count, offset):
+        table = (count, offset, [])
+        table[2].extend(self._entry(table, i)[0] for i in range(0, count, SAMPLE_STRIDE))
+        return table
+
+    @classmethod
+    def open(cls, path=DEFAULT_INDEX, source=DEFAULT_SOURCE):
+        """The index at ``path``, built from ``source`` first if it is missing or older"""
+        if os.path.exists(source) and (not os.path.exists(path)
+                                       or os.path.getmtime(path) < os.path.getmtime(source)):
+            build(source, path)
+        return cls(path)
+
+    @classmethod
+    def from_env(cls):
+        return cls.open(os.environ.get("GAZETTEER_INDEX", DEFAULT_INDEX),
+                        os.environ.get("GAZETTEER_SOURCE", DEFAULT_SOURCE))
+
+    def close(self):
+        self._map.close()
+
+    def place(self, index):
+        lat, lon, population, offset, length, country = \
+            PLACE.unpack_from(self._map, self._places + index * PLACE.size)
+        start = self._strings + offset
+        name = self._map[start:start + length].decode("utf-8")
+        return Place(name, lat, lon, country.decode("ascii").strip(), population)
+
+    def _entry(self, table, i):
+        """(key bytes, place index) of entry ``i``"""
+        offset, length, index = ENTRY.unpack_from(self._map, table[1] + i * ENTRY.size)
+        start = self._strings + offset
+        return self._map[start:start + length], index
+
+    def _lower_bound(self, table, key):
+        # The sample before ``block`` sorts below ``key`` and the one at it
+        # doesn't: the answer is in between
+        block = bisect.bisect_left(table[2], key)
+        if block == 0:
+            return 0
+        lo, hi = (block - 1) * SAMPLE_STRIDE + 1, min(table[0], block * SAMPLE_STRIDE)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(table, mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matches(self, table, key):
+        """Place indexes of every entry equal to ``key``, in table order"""
+        i = self._lower_bound(table, key)
+        while i < table[0]:
+            found, index = self._entry(table, i)
+            if found != key:
+                break
+            yield index
+            i += 1
+
+    def lookup(self, name):
+        """The most populous place called exactly ``name`` (after normalize), or None"""
+        key = normalize(name)
+        if len(key) < MIN_NAME_LENGTH:
+            return None
+        index = next(self._matches(self._names, key.encode("utf-8")), None)
+        return None if index is None else self.place(index)
+
+    def find(self, text):
+        """The place named in free text: the longest name found, the most
+        populous one on a tie; None if no name occurs"""
+        words = normalize(text).split()
+        best = None  # (words, -index): places are stored most populous first
+        for start, word in enumerate(words):
+            if word in STOPWORDS:
+                continue
+            phrase = word
+            for end in range(start + 1, min(len(words), start + MAX_WORDS) + 1):
+                if end > start + 1:
+                    phrase = f"{phrase} {words[end - 1]}"
+                key = phrase.encode("utf-8")
+                i = self._lower_bound(self._names, key)
+                if i == self._names[0]:
+                    break
+                found, index = self._entry(self._names, i)
+                if found == key and len(phrase) >= MIN_NAME_LENGTH:
+                    candidate = (end - start, -index)
+                    best = max(best, candidate) if best else candidate
+                elif not found.startswith(key):
+                    break  # no name goes on from here
+        return None if best is None else self.place(-best[1])
+
+    def closest(self, text):
+        """The place whose name is ``text`` give or take one typo; the exact
+        name, then the most populous place, wins. None if nothing is that close"""
+        key = " ".join(word for word in normalize(text).split() if word not in STOPWORDS)
+        if len(key) < MIN_NAME_LENGTH:
+            return None
+        exact = self.lookup(key)
+        if exact is not None or len(key) < MIN_FUZZY_LENGTH:
+            return exact
+        variants = [variant.encode("utf-8") for variant in deletions(key)]
+        # A letter too many: one of the text's deletions is a name
+        candidates = {index for variant in variants for index in self._matches(self._names, variant)}
+        # A letter missing: the text is one of a name's deletions
+        candidates.update(self._matches(self._fuzzy, key.encode("utf-8")))
+        # A letter changed or two swapped: the text and the name share a
+        # deletion (so do some names two edits away, hence the check)
+        for variant in variants:
+            for index in self._matches(self._fuzzy, variant):
+                if index not in candidates and one_edit_apart(key, normalize(self.place(index).name)):
+                    candidates.add(index)
+        # Places are stored most populous first
+        return self.place(min(candidates)) if candidates else None
+
+    def stats(self):
+        return {"places": self.places, "names": self._names[0], "fuzzy_keys": self._fuzzy[0],
+                "bytes": len(self._map), "path": self.path}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the gazetteer index from a GeoNames-style file")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("source", nargs="?", default=DEFAULT_SOURCE)
+    parser.add_argument("index", nargs="?", default=DEFAULT_INDEX)
+    parser.add_argument("--min-population", type=int, default=0)
+    args = parser.parse_args()
+
+    count = build(args.source, args.index, args.min_population)
+    print(f"Indexed {count} places from {args.source} into {args.index} ({os.path.getsize(args.index)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Generation profiles: the model, generationConfig and prompt budget per kind of request.
+
+The intent router picks a profile for every Gemini call: chat (questions
+that fall through to the AI), code, writing (essays, stories, letters),
+image (vision) and summary (session summaries). Each caps its own output
+tokens, so a one-line answer isn't generated with the budget of a full
+program, and sets its temperature, model and thinking budget (0 turns
+thinking off, None leaves the model's default).
+
+Prompts are sized locally with sessions.estimate_tokens; one over
+max_prompt_tokens is cut down, keeping its beginning and end.
+
+Defaults are in DEFAULTS; any field can be changed without code changes:
+
+- GENERATION_PROFILES: JSON, or the path of a JSON file, such as
+  {"chat": {"max_output_tokens": 1024}, "code": {"model": "gemini-2.5-pro"}}
+- GENERATION_<PROFILE>_<FIELD>, e.g. GENERATION_CHAT_TEMPERATURE=0.5,
+  which wins over GENERATION_PROFILES
+"""
+import json
+import os
+
+from sessions import estimate_tokens
+
+# Field -> parser for values from the environment
+FIELDS = {
+    "model": str,
+    "temperature": float,
+    "top_p": float,
+    "top_k": int,
+    "max_output_tokens": int,
+    "max_prompt_tokens": int,
+    "thinking_budget": int,
+}
+
+DEFAULTS = {
+    "chat": {"temperature": 0.7, "max_output_tokens": 2048, "max_prompt_tokens": 8000, "thinking_budget": 0},
+    # Thinking tokens count against maxOutputTokens, so code keeps room for both
+    "code": {"temperature": 0.3, "max_output_tokens": 16384, "max_prompt_tokens": 32000},
+    "writing": {"temperature": 0.9, "max_output_tokens": 4096, "max_prompt_tokens": 8000, "thinking_budget": 0},
+    "image": {"temperature": 0.4, "max_output_tokens": 4000, "max_prompt_tokens": 2000},
+    "summary": {"temperature": 0.3, "max_output_tokens": 1024, "max_prompt_tokens": 32000, "thinking_budget": 0},
+}
+
+TRIM_MARKER = "\n\n[... {omitted} characters left out ...]\n\n"
+
+
+class GenerationProfile:
+    def __init__(self, name, model, temperature=0.7, top_p=0.95, top_k=40,
+                 max_output_tokens=None, max_prompt_tokens=None, thinking_budget=None):
+        self.name = name
+        self.model = model
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.max_output_tokens = max_output_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.thinking_budget = thinking_budget
+
+    def generation_config(self):
+        """The request's generationConfig"""
+        config = {"temperature": self.temperature, "topP": self.top_p, "topK": self.top_k}
+        if self.max_output_tokens:
+            config["maxOutputTokens"] = self.max_output_tokens
+        if self.thinking_budget is not None:
+            config["thinkingConfig"] = {"thinkingBudget": self.thinking_budget}
+        return config
+
+    def fit(self, prompt):
+        """(prompt, trimmed): ``prompt`` cut to about max_prompt_tokens, keeping
+        its first two thirds and last third, so instructions at either end survive"""
+        if not self.max_prompt_tokens or estimate_tokens(prompt) <= self.max_prompt_tokens:
+            return prompt, False
+        # estimate_tokens counts four bytes of UTF-8 per token
+        data = prompt.encode("utf-8")
+        keep = self.max_prompt_tokens * 4 - len(TRIM_MARKER) - 8
+        head = data[:keep * 2 // 3].decode("utf-8", "ignore")
+        tail = data[len(data) - keep // 3:].decode("utf-8", "ignore")
+        omitted = len(prompt) - len(head) - len(tail)
+        return head + TRIM_MARKER.format(omitted=omitted) + tail, True
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+
+def _parse(field, value):
+    if field == "thinking_budget" and (value is None or str(value).strip().lower() in ("", "none", "null")):
+        return None
+    return FIELDS[field](value)
+
+
+class GenerationProfiles:
+    def __init__(self, profiles):
+        self._profiles = profiles
+
+    @classmethod
+    def from_env(cls, default_model):
+        """DEFAULTS with GENERATION_PROFILES and GENERATION_<PROFILE>_<FIELD> applied"""
+        overrides = os.environ.get("GENERATION_PROFILES", "").strip()
+        if overrides and not overrides.startswith("{"):
+            with open(overrides, encoding="utf-8") as f:
+                overrides = f.read()
+        overrides = json.loads(overrides) if overrides else {}
+        unknown = set(overrides) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"GENERATION_PROFILES: unknown profiles {sorted(unknown)}, expected {sorted(DEFAULTS)}")
+
+        profiles = {}
+        for name, defaults in DEFAULTS.items():
+            settings = {"model": default_model, **defaults}
+            for field, value in overrides.get(name, {}).items():
+                if field not in FIELDS:
+                    raise ValueError(f"GENERATION_PROFILES: unknown field {name}.{field}, expected {sorted(FIELDS)}")
+                settings[field] = _parse(field, value)
+            for field in FIELDS:
+                value = os.environ.get(f"GENERATION_{name.upper()}_{field.upper()}")
+                if value is not None:
+                    settings[field] = _parse(field, value)
+            profiles[name] = GenerationProfile(name, **settings)
+        return cls(profiles)
+
+    def __getitem__(self, name):
+        return self._profiles[name]
+
+    def stats(self):
+        return {name: profile.as_dict() for name, profile in self._profiles.items()}
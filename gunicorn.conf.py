@@ -0,0 +1,39 @@
+"""Gunicorn settings: `gunicorn --config gunicorn.conf.py`
+
+SERVER_MODE=sync (default) serves the Flask app with sync workers.
+SERVER_MODE=async serves asgi:app with uvicorn workers, so slow Gemini calls
+wait on the event loop instead of holding a worker each.
+"""
+import os
+import tempfile
+
+SERVER_MODE = os.environ.get("SERVER_MODE", "sync").lower()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# The client sends the same session_id with every message, and any worker
+# may get the next one: with more than one, sessions have to be shared
+if workers > 1:
+    os.environ.setdefault("SESSION_DB", os.path.join(tempfile.gettempdir(), "sessions.sqlite3"))
+
+if SERVER_MODE == "async":
+    worker_class = "uvicorn_worker.UvicornWorker"
+    wsgi_app = "asgi:app"
+else:
+    wsgi_app = "app:app"
+
+# A sync worker busy on one request longer than this is killed; leave room
+# past REQUEST_DEADLINE (deadline.py) so the app answers with its own 504 first
+timeout = int(float(os.environ.get("REQUEST_DEADLINE", 90))) + 30
+
+
+def post_worker_init(worker):
+    """Warm the worker up (app.warm_up) in the background; set WARMUP=0 to skip"""
+    if os.environ.get("WARMUP", "1") == "0":
+        return
+    import threading
+
+    import app
+
+    threading.Thread(target=app.warm_up, name="warmup", daemon=True).start()
@@ -0,0 +1,164 @@
+"""Cache of image analyses, keyed on what the image looks like plus the prompt.
+
+Two ways to hit: the SHA-256 of the uploaded bytes (checked before the image
+is even decoded) and, when that misses and IMAGE_CACHE_PERCEPTUAL is on, a
+64-bit perceptual hash within a small Hamming distance, so the same
+screenshot re-saved, re-compressed or resized still matches. Entries hold
+the finished /ask result (formatted analysis HTML included) and are evicted
+least-recently-used once their total size passes a byte budget.
+
+Identical bytes are the same image whoever sends them, but two different
+screenshots can look alike: a perceptual match only comes from uploads
+made in the same scope (the client, see scoped()), never another user's.
+"""
+import contextlib
+import contextvars
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from response_cache import normalize_prompt
+
+# Set per request: whose earlier uploads a perceptual match may come from
+_scope = contextvars.ContextVar("image_cache_scope", default=None)
+
+
+def _result_size(result):
+    return sum(len(v) for v in result.values() if isinstance(v, str)) + 64
+
+
+class ImageAnalysisCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=86400.0, max_distance=2, perceptual=False):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.perceptual = perceptual
+        self.bytes = 0
+        # (prompt, digest) -> [result, dhash, size, expires_at, scope]
+        self._entries = OrderedDict()
+        # (scope, prompt) -> {digest: dhash}, for the perceptual scan
+        self._by_prompt = {}
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "perceptual_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.environ.get("IMAGE_CACHE_BYTES", 16 * 1024 * 1024)),
+            ttl=float(os.environ.get("IMAGE_CACHE_TTL", 86400)),
+            max_distance=int(os.environ.get("IMAGE_CACHE_DISTANCE", 2)),
+            perceptual=os.environ.get("IMAGE_CACHE_PERCEPTUAL", "0") == "1",
+        )
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 and self.ttl > 0
+
+    @contextlib.contextmanager
+    def scoped(self, scope):
+        """Let perceptual matches inside the block come from ``scope``'s uploads only"""
+        token = _scope.set(scope)
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+
+    @staticmethod
+    def digest(source):
+        """SHA-256 of image bytes, a binary file (rewound afterwards) or a base64 str"""
+        if isinstance(source, str):
+            source = source.encode("ascii", "replace")
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return hashlib.sha256(source).hexdigest()
+        h = hashlib.sha256()
+        source.seek(0)
+        for chunk in iter(lambda: source.read(64 * 1024), b""):
+            h.update(chunk)
+        source.seek(0, io.SEEK_SET)
+        return h.hexdigest()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+        prompt, digest = key
+        index = (entry[4], prompt)
+        digests = self._by_prompt.get(index)
+        if digests is not None:
+            digests.pop(digest, None)
+            if not digests:
+                del self._by_prompt[index]
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] <= now:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, prompt, digest):
+        """Result stored for exactly these bytes and prompt; checked before decoding"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            result = self._live((normalize_prompt(prompt or ""), digest), time.time())
+            if result is not None:
+                self.counters["exact_hits"] += 1
+            return result
+
+    def get_similar(self, prompt, dhash):
+        """Result stored for a perceptually near-identical image, the same prompt
+        and the same scope; None with perceptual matching off or no scope set"""
+        if not self.enabled:
+            return None
+        prompt = normalize_prompt(prompt or "")
+        scope = _scope.get()
+        now = time.time()
+        with self._lock:
+            if dhash is not None and self.perceptual and scope is not None:
+                for digest, other in list(self._by_prompt.get((scope, prompt), {}).items()):
+                    if other is not None and (dhash ^ other).bit_count() <= self.max_distance:
+                        result = self._live((prompt, digest), now)
+                        if result is not None:
+                            self.counters["perceptual_hits"] += 1
+                            return result
+            self.counters["misses"] += 1
+        return None
+
+    def set(self, prompt, digest, dhash, result):
+        if not self.enabled:
+            return
+        prompt = normalize_prompt(prompt or "")
+        key = (prompt, digest)
+        size = _result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            scope = _scope.get()
+            self._entries[key] = [result, dhash, size, time.time() + self.ttl, scope]
+            if self.perceptual and scope is not None:
+                self._by_prompt.setdefault((scope, prompt), {})[digest] = dhash
+            self.bytes += size
+            self.counters["stores"] += 1
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        lookups = self.counters["exact_hits"] + self.counters["perceptual_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "perceptual": self.perceptual,
+        }
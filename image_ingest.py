@@ -0,0 +1,161 @@
+"""Downsize uploaded images before they are sent to Gemini.
+
+Gemini's vision models work on tiles of a few hundred pixels, so a 12 MP
+phone photo costs upload time and tokens for detail the model never sees.
+prepare_image() reads only the header to decide, lets the JPEG decoder scale
+down while decoding (draft mode) instead of decoding full resolution,
+applies the EXIF orientation, drops all metadata (EXIF, GPS, XMP, comments)
+and re-encodes under a byte budget.
+
+Pillow is imported on the first image, not with this module: most requests
+never carry one, and the app imports this module at startup.
+"""
+import io
+import tempfile
+import time
+
+# What Gemini accepts; anything else is converted
+UPLOAD_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+_METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment", "icc_profile", "photoshop")
+
+
+class ImageRejected(ValueError):
+    """The upload is not an image we can safely decode"""
+
+
+class UploadTooLarge(ValueError):
+    """The request body is over the upload limit"""
+
+
+def spool_upload(stream, limit, memory_size=512 * 1024, chunk_size=64 * 1024):
+    """Copy a request body into a temp file that moves to disk past ``memory_size``
+
+    Stops with UploadTooLarge as soon as more than ``limit`` bytes arrive, so a
+    body without (or lying about) Content-Length can't be buffered unbounded.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=memory_size)
+    total = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            spool.close()
+            raise UploadTooLarge(f"Upload over {limit} bytes")
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+class PreparedImage:
+    __slots__ = ("data", "mime_type", "original_bytes", "original_size", "size", "changed", "seconds",
+                 "dhash")
+
+    def __init__(self, data, mime_type, original_bytes, original_size, size, changed, seconds,
+                 dhash=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+        self.size = size
+        self.changed = changed
+        self.seconds = seconds
+        self.dhash = dhash
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - len(self.data)
+
+
+def dhash(img, size=8):
+    """64-bit difference hash: survives re-encoding and resizing, unlike a byte hash"""
+    from PIL import Image
+
+    small = img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _has_metadata(img):
+    return any(key in img.info for key in _METADATA_KEYS) or bool(img.getexif())
+
+
+def _encode(img, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == "JPEG":
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "WEBP":
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_image(source, max_edge=1536, max_bytes=1024 * 1024, quality=85, min_quality=50,
+                  max_pixels=50_000_000):
+    """Return a PreparedImage no larger than ``max_edge`` px and, where possible, ``max_bytes``
+
+    ``source`` is the encoded image as bytes or a seekable binary file (an
+    upload spooled to disk is decoded from the file, never read whole).
+    """
+    from PIL import Image, ImageOps
+
+    started = time.perf_counter()
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    fp.seek(0, io.SEEK_END)
+    original_bytes = fp.tell()
+    fp.seek(0)
+    try:
+        img = Image.open(fp)  # parses the header only
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageRejected(f"Unreadable image: {e}") from e
+
+    original_size = img.size
+    if img.width * img.height > max_pixels:
+        raise ImageRejected(f"Image too large: {img.width}x{img.height}")
+
+    fits = max(img.size) <= max_edge and original_bytes <= max_bytes
+    if fits and img.format in UPLOAD_FORMATS and not _has_metadata(img):
+        try:
+            img.draft("RGB", (64, 64))
+            fingerprint = dhash(img)
+        except (OSError, ValueError):
+            fingerprint = None  # truncated data; Gemini may still make sense of it
+        fp.seek(0)
+        return PreparedImage(fp.read(), UPLOAD_FORMATS[img.format], original_bytes, original_size,
+                             original_size, False, time.perf_counter() - started, fingerprint)
+
+    try:
+        # JPEG only: decode at 1/2, 1/4 or 1/8 scale, never smaller than asked
+        img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageRejected(f"Undecodable image: {e}") from e
+
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        fmt = "WEBP"  # keeps alpha and, unlike PNG, has a quality knob
+    else:
+        img = img.convert("RGB")
+        fmt = "JPEG"
+    # A fresh image carries no info dict, so nothing of the original's metadata is written
+    img.info = {}
+    fingerprint = dhash(img)
+
+    out = _encode(img, fmt, quality)
+    while len(out) > max_bytes and quality > min_quality:
+        quality = max(min_quality, quality - 10)
+        out = _encode(img, fmt, quality)
+    while len(out) > max_bytes and max(img.size) > 256:
+        img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.Resampling.LANCZOS)
+        out = _encode(img, fmt, quality)
+
+    return PreparedImage(out, UPLOAD_FORMATS[fmt], original_bytes, original_size, img.size, True,
+                         time.perf_counter() - started, fingerprint)
@@ -0,0 +1,229 @@
+"""Precompiled intent router used by perform_task_web.
+
+Intents are declared once, in priority order, with one or more regex
+patterns. All patterns are folded into a single prefix-factored regex (a
+trie of their literal prefixes), so a command is scanned once by the C regex
+engine and only the handler of the winning intent is executed.
+"""
+import re
+import time
+
+_META = set(".^$*+?{}[]\\|()")
+
+
+def _has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+def _split_literal(pattern):
+    """Split a pattern into its leading literal text and the regex remainder"""
+    if _has_top_level_alternation(pattern):
+        return "", f"(?:{pattern})"
+    i = 0
+    while i < len(pattern) and pattern[i] not in _META:
+        i += 1
+    # A quantifier applies to the last literal char, so keep it in the remainder
+    if 0 < i < len(pattern) and pattern[i] in "*+?{":
+        i -= 1
+    return pattern[:i], pattern[i:]
+
+
+def _trie_regex(entries):
+    """Build a regex from (literal, remainder, marker) entries sharing prefixes.
+
+    Each alternative ends with an empty named group (the marker) so the
+    intent that matched can be read back from ``match.lastgroup``.
+    """
+    parts = []
+    branches = {}
+    for literal, rest, marker in entries:
+        if not literal:
+            parts.append(f"{rest}(?P<{marker}>)")
+        else:
+            branches.setdefault(literal[0], []).append((literal[1:], rest, marker))
+    for char, sub in branches.items():
+        parts.append(re.escape(char) + _trie_regex(sub))
+    if len(parts) == 1:
+        return parts[0]
+    return "(?:" + "|".join(parts) + ")"
+
+
+class Intent:
+    """A named intent: patterns, optional exclusions and its handler"""
+
+    def __init__(self, name, patterns, handler, unless=None, anchored=False):
+        self.name = name
+        self.patterns = list(patterns)
+        self.handler = handler
+        self.async_handler = None
+        self.anchored = anchored
+        self.regex = re.compile("(?:" + "|".join(self.patterns) + ")")
+        self.veto = re.compile("|".join(unless)) if unless else None
+
+    def matches(self, text):
+        if self.anchored:
+            return self.regex.match(text) is not None
+        return self.regex.search(text) is not None
+
+    def vetoed(self, text):
+        return self.veto is not None and self.veto.search(text) is not None
+
+
+class IntentRouter:
+    """Route commands to handlers with one precompiled, prefix-factored regex.
+
+    Intents keep "first declared wins" semantics, like a chain of
+    ``re.search`` calls, but are found in a single ``finditer`` pass: the
+    combined regex is zero-width at every position, so it reports an intent
+    for every place one starts. Only two intents whose literal prefixes
+    overlap can hide each other at the same position; those few (plus
+    anchored intents) are re-checked individually when they outrank the
+    best intent found by the scan.
+
+    A handler receives ``(orig, cmd)`` and may return ``None`` to decline,
+    in which case routing continues with the next matching intent and, last,
+    the fallback handler. Intents that wait on the network can also be given
+    a coroutine handler, used by aresolve() in the ASGI app; the others are
+    cheap and run inline there too.
+    """
+
+    def __init__(self, on_scan=None):
+        """``on_scan(seconds)`` is told how long each classification took"""
+        self.on_scan = on_scan
+        self._intents = []
+        self._fallback = None
+        self._async_fallback = None
+        self._combined = None
+        self._verify = ()
+
+    def add(self, name, patterns, handler, unless=None, anchored=False):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        if isinstance(unless, str):
+            unless = [unless]
+        self._intents.append(Intent(name, patterns, handler, unless, anchored))
+        self._combined = None
+        return handler
+
+    def intent(self, name, patterns, unless=None, anchored=False):
+        """Decorator form of add()"""
+        def decorator(handler):
+            return self.add(name, patterns, handler, unless, anchored)
+        return decorator
+
+    def fallback(self, handler):
+        """Register the handler used when no intent matches"""
+        self._fallback = handler
+        return handler
+
+    def async_handler(self, name):
+        """Decorator attaching a coroutine handler to a declared intent (or "fallback")"""
+        def decorator(handler):
+            if name == "fallback":
+                self._async_fallback = handler
+            else:
+                next(i for i in self._intents if i.name == name).async_handler = handler
+            return handler
+        return decorator
+
+    @property
+    def intents(self):
+        return [intent.name for intent in self._intents]
+
+    def compile(self):
+        entries = []
+        verify = set()
+        owners = []
+        for index, intent in enumerate(self._intents):
+            if intent.anchored:
+                verify.add(index)
+                continue
+            for n, pattern in enumerate(intent.patterns):
+                literal, rest = _split_literal(pattern)
+                entries.append((literal, rest, f"_i{index}_{n}"))
+                owners.append((literal, index))
+        # Intents whose literal prefixes are prefixes of one another can
+        # start at the same position, where the scan only reports one of them.
+        for literal, index in owners:
+            for other, other_index in owners:
+                if index != other_index and other.startswith(literal):
+                    verify.update((index, other_index))
+        self._combined = re.compile("(?=" + _trie_regex(entries) + ")")
+        self._verify = frozenset(verify)
+        return self._combined
+
+    def _scan(self, text):
+        combined = self._combined or self.compile()
+        return {int(m.lastgroup[2:].split("_", 1)[0]) for m in combined.finditer(text)}
+
+    def _candidates(self, text):
+        """Yield matching intents in priority order"""
+        if self.on_scan is None:
+            found = self._scan(text)
+        else:
+            start = time.perf_counter()
+            found = self._scan(text)
+            self.on_scan(time.perf_counter() - start)
+        for index in sorted(found | self._verify):
+            intent = self._intents[index]
+            if index not in found and not intent.matches(text):
+                continue
+            if intent.vetoed(text):
+                continue
+            yield intent
+
+    def match(self, text):
+        """Return the name of the first intent matching ``text`` (or None)"""
+        for intent in self._candidates(text):
+            return intent.name
+        return None
+
+    def resolve(self, orig, cmd=None):
+        """Run the matching handler and return ``(intent_name, response)``"""
+        if cmd is None:
+            cmd = orig.lower()
+        for intent in self._candidates(cmd):
+            response = intent.handler(orig, cmd)
+            if response is not None:
+                return intent.name, response
+        if self._fallback is None:
+            return None, None
+        return "fallback", self._fallback(orig, cmd)
+
+    def route(self, orig, cmd=None):
+        return self.resolve(orig, cmd)[1]
+
+    async def aresolve(self, orig, cmd=None):
+        """resolve() for an event loop: coroutine handlers are awaited"""
+        if cmd is None:
+            cmd = orig.lower()
+        for intent in self._candidates(cmd):
+            if intent.async_handler is not None:
+                response = await intent.async_handler(orig, cmd)
+            else:
+                response = intent.handler(orig, cmd)
+            if response is not None:
+                return intent.name, response
+        if self._async_fallback is not None:
+            return "fallback", await self._async_fallback(orig, cmd)
+        if self._fallback is None:
+            return None, None
+        return "fallback", self._fallback(orig, cmd)
@@ -0,0 +1,120 @@
+"""Markdown → HTML for Gemini replies, without per-call setup costs.
+
+markdown.markdown() builds a new Markdown instance and loads every extension
+on each call, and codehilite asks Pygments to look its lexer up again for
+every code block and builds a fresh HTML formatter. MarkdownRenderer keeps
+one Markdown instance per thread (reset between documents), reuses lexers and
+formatters, and remembers the HTML of recently rendered text by content hash.
+
+Markdown, its extensions and Pygments are imported by the first render (or
+warm-up), not with this module; together they take tens of milliseconds
+that a cold start shouldn't wait for.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+_instances = {}
+_instances_lock = threading.Lock()
+_markdown = None
+_load_lock = threading.Lock()
+
+
+def _reused(factory, name, options):
+    """``factory(name, **options)``, with the instance kept for the same arguments.
+
+    Pygments lexers and HTML formatters hold configuration, not per-call
+    state, so one instance can serve every code block that asks for it.
+    """
+    from pygments.util import ClassNotFound
+
+    key = (factory.__name__, name, tuple(sorted((k, repr(v)) for k, v in options.items())))
+    instance = _instances.get(key)
+    if instance is None:
+        try:
+            instance = factory(name, **options)
+        except ClassNotFound:
+            # Unknown names fall through to a scan of installed plugins; remember the miss too
+            instance = False
+        with _instances_lock:
+            if len(_instances) > 256:
+                _instances.clear()
+            _instances[key] = instance
+    if instance is False:
+        raise ClassNotFound(f"no {factory.__name__} match for {name!r}")
+    return instance
+
+
+def cached_lexer_by_name(alias, **options):
+    from pygments.lexers import get_lexer_by_name
+
+    return _reused(get_lexer_by_name, alias, options)
+
+
+def cached_formatter_by_name(alias, **options):
+    from pygments.formatters import get_formatter_by_name
+
+    # Building an HtmlFormatter compiles its style sheet every time
+    return _reused(get_formatter_by_name, alias, options)
+
+
+def _load_markdown():
+    """The markdown module, imported on first use with codehilite patched"""
+    global _markdown
+    if _markdown is None:
+        with _load_lock:
+            if _markdown is None:
+                import markdown
+                from markdown.extensions import codehilite
+
+                # codehilite (and fenced_code through it) looks both up via its module globals
+                codehilite.get_lexer_by_name = cached_lexer_by_name
+                codehilite.get_formatter_by_name = cached_formatter_by_name
+                _markdown = markdown
+    return _markdown
+
+
+class MarkdownRenderer:
+    def __init__(self, extensions, cache_size=512):
+        self.extensions = list(extensions)
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._html = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"renders": 0, "cache_hits": 0, "instances": 0}
+
+    def _markdown(self):
+        md = getattr(self._local, "md", None)
+        if md is None:
+            md = self._local.md = _load_markdown().Markdown(extensions=self.extensions)
+            self.counters["instances"] += 1
+        return md
+
+    def convert(self, text):
+        # reset() clears the HTML stash, references and per-document extension state
+        html = self._markdown().reset().convert(text)
+        self.counters["renders"] += 1
+        return html
+
+    def render(self, text, convert=None):
+        """HTML for ``text``, from the cache or ``convert(text)`` (default: this thread's instance)"""
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        if self.cache_size:
+            with self._lock:
+                html = self._html.get(key)
+                if html is not None:
+                    self._html.move_to_end(key)
+                    self.counters["cache_hits"] += 1
+                    return html
+
+        html = (convert or self.convert)(text)
+
+        if self.cache_size:
+            with self._lock:
+                self._html[key] = html
+                while len(self._html) > self.cache_size:
+                    self._html.popitem(last=False)
+        return html
+
+    def stats(self):
+        return {**self.counters, "cached": len(self._html), "lexers_and_formatters": len(_instances)}
@@ -0,0 +1,144 @@
+"""In-memory headline feeds served stale-while-revalidate.
+
+Each distinct set of NewsAPI parameters (country, category, page size) is a
+feed holding its last rendered HTML. Requests always get the stored HTML
+straight away; when it is older than the refresh interval a background
+refresh is started and the next request sees the new headlines. A daemon
+thread also refreshes every feed that has been used recently, so popular
+feeds rarely go stale at all. Only the very first request for a feed waits
+on NewsAPI.
+"""
+import logging
+import threading
+import time
+
+from singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
+
+
+class _Feed:
+    __slots__ = ("html", "fetched_at", "last_used", "refreshing", "pinned")
+
+    def __init__(self, html, pinned=False):
+        self.html = html
+        self.fetched_at = time.monotonic()
+        self.last_used = self.fetched_at
+        self.refreshing = False
+        self.pinned = pinned
+
+
+class NewsFeed:
+    def __init__(self, load, refresh_interval=600.0, idle_ttl=3600.0, max_feeds=32):
+        """``load(params)`` returns rendered HTML for a feed or raises on failure"""
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.idle_ttl = idle_ttl
+        self.max_feeds = max_feeds
+        self._feeds = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._thread = None
+        self._stop = threading.Event()
+        self.counters = {"hits": 0, "stale_hits": 0, "cold_loads": 0, "refreshes": 0, "refresh_errors": 0}
+
+    @staticmethod
+    def key(params):
+        return tuple(sorted((k, v) for k, v in params.items() if v is not None))
+
+    def _fetch(self, key, pinned=False):
+        html = self.load(dict(key))
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                if len(self._feeds) >= self.max_feeds:
+                    self._evict_one()
+                self._feeds[key] = _Feed(html, pinned)
+            else:
+                feed.html = html
+                feed.fetched_at = time.monotonic()
+                feed.pinned = feed.pinned or pinned
+        return html
+
+    def _evict_one(self):
+        victims = [k for k, f in self._feeds.items() if not f.pinned] or list(self._feeds)
+        oldest = min(victims, key=lambda k: self._feeds[k].last_used)
+        del self._feeds[oldest]
+
+    def _refresh(self, key):
+        try:
+            self._flight.do(key, lambda: self._fetch(key))
+            self.counters["refreshes"] += 1
+        except Exception as e:
+            # Keep serving the previous headlines until a refresh succeeds
+            self.counters["refresh_errors"] += 1
+            log.warning("News refresh failed: %s", e)
+        finally:
+            feed = self._feeds.get(key)
+            if feed is not None:
+                feed.refreshing = False
+
+    def get(self, **params):
+        key = self.key(params)
+        feed = self._feeds.get(key)
+        if feed is None:
+            self.counters["cold_loads"] += 1
+            self.start()
+            return self._flight.do(key, lambda: self._fetch(key))
+
+        feed.last_used = time.monotonic()
+        if feed.last_used - feed.fetched_at < self.refresh_interval:
+            self.counters["hits"] += 1
+            return feed.html
+
+        self.counters["stale_hits"] += 1
+        with self._lock:
+            start_refresh = not feed.refreshing
+            feed.refreshing = True
+        if start_refresh:
+            threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+        return feed.html
+
+    def prefetch(self, **params):
+        """Load a feed now and keep it refreshed even while nobody asks for it"""
+        key = self.key(params)
+        try:
+            self._flight.do(key, lambda: self._fetch(key, pinned=True))
+        except Exception as e:
+            log.warning("News prefetch failed: %s", e)
+
+    def _run(self, prefetch):
+        for params in prefetch:
+            self.prefetch(**params)
+        tick = max(1.0, min(30.0, self.refresh_interval / 2))
+        while not self._stop.wait(tick):
+            now = time.monotonic()
+            for key, feed in list(self._feeds.items()):
+                if not feed.pinned and now - feed.last_used > self.idle_ttl:
+                    with self._lock:
+                        self._feeds.pop(key, None)
+                elif now - feed.fetched_at >= self.refresh_interval and not feed.refreshing:
+                    feed.refreshing = True
+                    self._refresh(key)
+
+    def start(self, prefetch=()):
+        """Start the background refresher (once per process)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(list(prefetch),),
+                                            name="news-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            **self.counters,
+            "feeds": [
+                {"params": dict(key), "age": round(now - feed.fetched_at, 1), "pinned": feed.pinned}
+                for key, feed in list(self._feeds.items())
+            ],
+        }
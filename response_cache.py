@@ -0,0 +1,176 @@
+"""Cache of rendered Gemini replies, in front of ask_ai.
+
+Entries are keyed on the normalized prompt plus the generationConfig and
+hold the final HTML, so a hit skips both the API call and Markdown
+rendering, next to the Markdown it came from, which a session records as
+the model's turn when it is answered from the cache. The first tier is an in-process LRU with a TTL; an optional
+SQLite file adds a second tier shared by every gunicorn worker on the
+machine.
+"""
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Set per request: skip lookups (the fresh reply is still stored)
+_bypass = contextvars.ContextVar("response_cache_bypass", default=False)
+
+
+def normalize_prompt(prompt):
+    return _WHITESPACE.sub(" ", prompt).strip().casefold()
+
+
+class ResponseCache:
+    """Two-tier (memory LRU + optional SQLite) TTL cache of rendered HTML (and its source)"""
+
+    def __init__(self, max_entries=256, ttl=3600.0, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path or None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+        if self.db_path:
+            db = self._db()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, html TEXT NOT NULL, expires_at REAL NOT NULL, reply TEXT)"
+            )
+            try:
+                db.execute("ALTER TABLE responses ADD COLUMN reply TEXT")
+            except sqlite3.OperationalError:
+                pass  # created with it
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.environ.get("ASK_CACHE_SIZE", 256)),
+            ttl=float(os.environ.get("ASK_CACHE_TTL", 3600)),
+            db_path=os.environ.get("ASK_CACHE_DB"),
+        )
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(prompt, generation_config=None):
+        material = json.dumps(
+            [normalize_prompt(prompt), generation_config or {}],
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def bypassing(self, bypass=True):
+        """Skip lookups for everything run inside the block"""
+        token = _bypass.set(bool(bypass))
+        try:
+            yield
+        finally:
+            _bypass.reset(token)
+
+    @property
+    def bypassed(self):
+        return _bypass.get()
+
+    def _remember(self, key, html, reply, expires_at):
+        with self._lock:
+            self._entries[key] = (html, reply, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key, with_reply=False):
+        """The cached HTML, or (html, reply) with ``with_reply``; reply is None
+        for entries stored without one"""
+        if not self.enabled:
+            return None
+        if self.bypassed:
+            self.counters["bypassed"] += 1
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return entry[:2] if with_reply else entry[0]
+                del self._entries[key]
+
+        if self.db_path:
+            try:
+                row = self._db().execute(
+                    "SELECT html, reply, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+            except sqlite3.Error as e:
+                log.warning("Response cache read failed: %s", e)
+                row = None
+            if row is not None:
+                self._remember(key, *row)
+                self.counters["disk_hits"] += 1
+                return row[:2] if with_reply else row[0]
+
+        self.counters["misses"] += 1
+        return None
+
+    def set(self, key, html, reply=None):
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, html, reply, expires_at)
+        self.counters["stores"] += 1
+        if not self.db_path:
+            return
+        try:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, html, reply, expires_at) VALUES (?, ?, ?, ?)",
+                (key, html, reply, expires_at),
+            )
+            # Expired rows are swept now and then rather than on every write
+            if self.counters["stores"] % 100 == 0:
+                db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            log.warning("Response cache write failed: %s", e)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_path:
+            self._db().execute("DELETE FROM responses")
+
+    def stats(self):
+        lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "shared_db": self.db_path,
+        }
@@ -0,0 +1,399 @@
+"""Multi-turn conversations with Gemini, kept on the server.
+
+A session keeps its latest turns verbatim and everything older as a running
+summary, so the history sent with each question stays under a token budget
+however long the conversation gets. Summaries are written by Gemini in the
+background once a session goes over budget. When the settled part of a
+session (summary plus earlier turns) is large enough, it is stored upstream
+as a cachedContents resource and later questions reference it by name
+instead of sending it again.
+
+Sessions live in process memory, or in a SQLite file (SESSION_DB) when
+several gunicorn workers have to see the same conversations; gunicorn.conf.py
+sets one up whenever it runs more than one worker.
+"""
+import concurrent.futures
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+# Set per request: the session ask_ai answers in, if any
+_active = contextvars.ContextVar("session_id", default=None)
+
+
+def estimate_tokens(text):
+    """Rough Gemini token count: about four bytes of UTF-8 per token"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def _content(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def _new_session(session_id, now):
+    return {"id": session_id, "summary": "", "turns": [], "cache": None,
+            "created_at": now, "updated_at": now, "usage": {}}
+
+
+class SessionStore:
+    """Per-session history with a token budget, summaries and upstream context caches
+
+    ``summarize(summary, turns)`` returns a new summary text,
+    ``create_cache(body)`` creates a cachedContents resource from
+    ``{"contents", "systemInstruction", "ttl"}`` and returns its name, and
+    ``delete_cache(name)`` removes one. All three call Gemini and only ever
+    run on the store's background thread.
+    """
+
+    def __init__(self, summarize=None, create_cache=None, delete_cache=None, max_sessions=1000,
+                 ttl=6 * 3600.0, token_budget=8000, keep_turns=6, cache_min_tokens=1024,
+                 cache_ttl=900, db_path=None):
+        self.summarize = summarize
+        self.create_cache = create_cache
+        self.delete_cache = delete_cache
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns + keep_turns % 2  # whole question/answer pairs
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_ttl = cache_ttl
+        self.db_path = db_path or None
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._scheduled = set()
+        self._background = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+        self.counters = {"created": 0, "turns": 0, "compactions": 0, "compaction_failures": 0,
+                         "caches_created": 0, "cache_failures": 0, "cached_requests": 0, "cache_misses": 0}
+        if self.db_path:
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    @classmethod
+    def from_env(cls, **callbacks):
+        return cls(
+            max_sessions=int(os.environ.get("SESSION_MAX", 1000)),
+            ttl=float(os.environ.get("SESSION_TTL", 6 * 3600)),
+            token_budget=int(os.environ.get("SESSION_TOKEN_BUDGET", 8000)),
+            keep_turns=int(os.environ.get("SESSION_KEEP_TURNS", 6)),
+            cache_min_tokens=int(os.environ.get("SESSION_CACHE_MIN_TOKENS", 1024)),
+            cache_ttl=int(os.environ.get("SESSION_CACHE_TTL", 900)),
+            db_path=os.environ.get("SESSION_DB"),
+            **callbacks,
+        )
+
+    @property
+    def enabled(self):
+        return self.max_sessions > 0 and self.ttl > 0
+
+    def _db(self):
+        # One connection per thread, as in ResponseCache
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --------- which session a request is in ---------
+    @staticmethod
+    def valid_id(session_id):
+        return isinstance(session_id, str) and bool(SESSION_ID.match(session_id))
+
+    @contextlib.contextmanager
+    def active(self, session_id):
+        """Answer ask_ai calls inside the block in ``session_id`` (None: stateless)"""
+        token = _active.set(session_id if self.enabled else None)
+        try:
+            yield
+        finally:
+            _active.reset(token)
+
+    @property
+    def current(self):
+        return _active.get()
+
+    # --------- storage ---------
+    def _load(self, session_id, now):
+        if self.db_path:
+            row = self._db().execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at > ?", (session_id, now)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        session = self._sessions.get(session_id)
+        if session is None or session["updated_at"] + self.ttl <= now:
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _save(self, session):
+        if self.db_path:
+            self._db().execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session["id"], json.dumps(session, ensure_ascii=False), session["updated_at"] + self.ttl),
+            )
+            if self.counters["turns"] % 100 == 0:
+                self._db().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+            return
+        self._sessions[session["id"]] = session
+        self._sessions.move_to_end(session["id"])
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def update(self, session_id, fn, create=True):
+        """Run ``fn(session)`` and store the session, atomically across threads and workers
+
+        Returns what ``fn`` returns, or None when the session doesn't exist
+        and ``create`` is false.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db() if self.db_path else None
+            if db is not None:
+                db.execute("BEGIN IMMEDIATE")
+            committed = False
+            try:
+                session = self._load(session_id, now)
+                if session is None:
+                    if not create:
+                        return None
+                    session = _new_session(session_id, now)
+                    self.counters["created"] += 1
+                result = fn(session)
+                self._save(session)
+                if db is not None:
+                    db.execute("COMMIT")
+                committed = True
+                return result
+            finally:
+                if db is not None and not committed:
+                    db.execute("ROLLBACK")
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._load(session_id, time.time())
+            return json.loads(json.dumps(session)) if session else None
+
+    def has_history(self, session_id):
+        """True once the session has a turn or a summary; before that a
+        question in it is sent exactly like one without a session"""
+        with self._lock:
+            session = self._load(session_id, time.time())
+            return bool(session and (session["turns"] or session["summary"]))
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self._load(session_id, time.time())
+            if self.db_path:
+                self._db().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            else:
+                self._sessions.pop(session_id, None)
+        if session and session["cache"]:
+            self._schedule(("delete_cache", session["cache"]["name"]), self._delete_cache,
+                           session["cache"]["name"])
+        return session is not None
+
+    # --------- building requests ---------
+    def _usable_cache(self, session, now):
+        cache = session["cache"]
+        # A little slack, so it doesn't expire between here and Gemini
+        if cache and cache["expires_at"] - 30 > now and cache["turns"] <= len(session["turns"]):
+            return cache
+        return None
+
+    def request_parts(self, session_id, prompt, token_budget=None, use_cache=True):
+        """The payload fields that put ``prompt`` in the session's context
+
+        ``{"contents", "systemInstruction" or "cachedContent"}`` for
+        build_ai_payload. Turns the cache doesn't cover are sent verbatim,
+        the oldest dropped first if they would go over the token budget
+        (``token_budget`` if lower than the store's). ``use_cache=False``
+        sends the summary and turns instead of the context cache, e.g. for
+        another model than the one the cache was made for.
+        """
+        now = time.time()
+        with self._lock:
+            session = self._load(session_id, now) or _new_session(session_id, now)
+            cache = self._usable_cache(session, now) if use_cache else None
+            summary = session["summary"]
+            turns = list(session["turns"][cache["turns"]:] if cache else session["turns"])
+
+        budget = min(self.token_budget, token_budget or self.token_budget) - estimate_tokens(prompt)
+        if not cache:
+            budget -= estimate_tokens(summary)
+        while turns and sum(turn["tokens"] for turn in turns) > budget:
+            turns = turns[2:]
+
+        parts = {"contents": [_content(t["role"], t["text"]) for t in turns] + [_content("user", prompt)]}
+        if cache:
+            parts["cachedContent"] = cache["name"]
+            self.counters["cached_requests"] += 1
+        elif summary:
+            parts["systemInstruction"] = {"parts": [{"text": self._summary_instruction(summary)}]}
+        return parts
+
+    @staticmethod
+    def _summary_instruction(summary):
+        return f"Summary of the earlier part of this conversation:\n{summary}"
+
+    def cache_missing(self, session_id, name):
+        """Gemini no longer knows ``name`` (expired or evicted early): stop referencing it"""
+        self.counters["cache_misses"] += 1
+
+        def forget(session):
+            if session["cache"] and session["cache"]["name"] == name:
+                session["cache"] = None
+
+        self.update(session_id, forget, create=False)
+
+    # --------- recording turns ---------
+    def record(self, session_id, prompt, reply, usage=None):
+        """Add a question and its answer, then compact or cache in the background if due"""
+        def append(session):
+            session["turns"].append({"role": "user", "text": prompt, "tokens": estimate_tokens(prompt)})
+            session["turns"].append({"role": "model", "text": reply, "tokens": estimate_tokens(reply)})
+            session["updated_at"] = time.time()
+            if usage:
+                session["usage"] = usage
+            self.counters["turns"] += 1
+            over_budget = self._tokens(session) > self.token_budget and len(session["turns"]) > self.keep_turns
+            return over_budget, self._uncached_tokens(session)
+
+        over_budget, uncached = self.update(session_id, append)
+        if over_budget:
+            self._schedule(("compact", session_id), self._compact, session_id)
+        elif self.create_cache and self.cache_min_tokens > 0 and uncached >= self.cache_min_tokens:
+            self._schedule(("cache", session_id), self._cache, session_id)
+
+    def _tokens(self, session):
+        return estimate_tokens(session["summary"]) + sum(turn["tokens"] for turn in session["turns"])
+
+    def _uncached_tokens(self, session):
+        cache = self._usable_cache(session, time.time())
+        if cache is None:
+            return self._tokens(session)
+        return sum(turn["tokens"] for turn in session["turns"][cache["turns"]:])
+
+    # --------- background work ---------
+    def _schedule(self, key, fn, *args):
+        with self._lock:
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                log.warning("Session %s failed: %s", key[0], e)
+            finally:
+                with self._lock:
+                    self._scheduled.discard(key)
+
+        self._background.submit(run)
+
+    def _compact(self, session_id):
+        """Fold all but the latest keep_turns turns into the summary"""
+        session = self.get(session_id)
+        if not session:
+            return
+        old = session["turns"][:max(0, len(session["turns"]) - self.keep_turns)]
+        if not old:
+            return
+        try:
+            summary = self.summarize(session["summary"], old) if self.summarize else None
+        except Exception as e:
+            log.warning("Session summary failed, dropping the oldest turns instead: %s", e)
+            summary = None
+        if not summary:
+            self.counters["compaction_failures"] += 1
+            summary = session["summary"]
+
+        def apply(current):
+            # Only if nobody compacted these turns in the meantime
+            if current["summary"] != session["summary"] or current["turns"][:len(old)] != old:
+                return None
+            current["summary"] = summary.strip()
+            current["turns"] = current["turns"][len(old):]
+            stale, current["cache"] = current["cache"], None
+            return stale
+
+        stale = self.update(session_id, apply, create=False)
+        self.counters["compactions"] += 1
+        if stale:
+            self._delete_cache(stale["name"])
+
+    def _cache(self, session_id):
+        """Store the session's settled context upstream as a cachedContents resource"""
+        session = self.get(session_id)
+        if not session or not session["turns"]:
+            return
+        turns = session["turns"]
+        body = {
+            "contents": [_content(t["role"], t["text"]) for t in turns],
+            "ttl": f"{self.cache_ttl}s",
+        }
+        if session["summary"]:
+            body["systemInstruction"] = {"parts": [{"text": self._summary_instruction(session["summary"])}]}
+        try:
+            name = self.create_cache(body)
+        except Exception as e:
+            self.counters["cache_failures"] += 1
+            log.warning("Session context cache not created: %s", e)
+            return
+        if not name:
+            self.counters["cache_failures"] += 1
+            return
+        self.counters["caches_created"] += 1
+        created = {"name": name, "turns": len(turns), "expires_at": time.time() + self.cache_ttl}
+
+        def apply(current):
+            # The prefix must still be what was cached (no compaction since)
+            if current["summary"] != session["summary"] or current["turns"][:len(turns)] != turns:
+                return name
+            stale, current["cache"] = current["cache"], created
+            return stale["name"] if stale else ""
+
+        unused = self.update(session_id, apply, create=False)
+        if unused is None:
+            unused = name  # the session is gone
+        if unused:
+            self._delete_cache(unused)
+
+    def _delete_cache(self, name):
+        if not self.delete_cache:
+            return
+        try:
+            self.delete_cache(name)
+        except Exception as e:
+            # It expires on its own after cache_ttl
+            log.warning("Context cache %s not deleted: %s", name, e)
+
+    def stats(self):
+        if self.db_path:
+            sessions = self._db().execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+        else:
+            sessions = len(self._sessions)
+        return {
+            **self.counters,
+            "sessions": sessions,
+            "pending_jobs": len(self._scheduled),
+            "token_budget": self.token_budget,
+            "shared_db": self.db_path,
+        }
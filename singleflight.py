@@ -0,0 +1,324 @@
+"""Coalesce concurrent calls for the same key into a single execution.
+
+The first caller for a key runs the function; callers arriving while it is
+in flight block until it finishes and share its result (or its exception).
+SingleFlight and AsyncSingleFlight do this within a process;
+FileSingleFlight extends it to every process on the machine through lock
+files, for results that serialize to JSON. Followers stop waiting when
+their own request's deadline passes.
+
+A leader that fails with DeadlineExceeded or Overloaded ran out of its own
+request's time or was shed by admission control; that says nothing about
+the call, so its followers don't get the error: they wake up and one of
+them runs the call again.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import deadline
+from admission import Overloaded
+from deadline import DeadlineExceeded
+
+try:
+    import fcntl
+except ImportError:  # Windows: FileSingleFlight is unavailable
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# Errors that belong to the caller that hit them, not to the call
+CALLER_ERRORS = (DeadlineExceeded, Overloaded)
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "abandoned", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        # Ended without a result to share: followers try again
+        self.abandoned = False
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, across=None):
+        # Optional FileSingleFlight the leader goes through, to coalesce with other processes too
+        self.across = across
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def _join(self, key):
+        """(call, leader): the call in flight for ``key``, or a new one the caller leads"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                return call, True
+            call.waiters += 1
+            return call, False
+
+    def _end(self, key, call):
+        with self._lock:
+            self._calls.pop(key, None)
+        call.event.set()
+
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        while not leader:
+            if not call.event.wait(deadline.remaining()):
+                raise DeadlineExceeded()
+            if not call.abandoned:
+                self.coalesced += 1
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            self.retried += 1
+            call, leader = self._join(key)
+
+        try:
+            call.result = self.across.do(key, fn) if self.across else fn()
+            return call.result
+        except CALLER_ERRORS:
+            call.abandoned = True
+            raise
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._end(key, call)
+
+    def begin(self, key):
+        """Lead the call for ``key`` without a function, for a result produced
+        piece by piece (a stream): returns ``finish(result=None)``, which
+        shares ``result`` with the followers (None: they try again), or None
+        if a call is already in flight. ``finish`` must always be called."""
+        call, leader = self._join(key)
+        if not leader:
+            with self._lock:
+                call.waiters -= 1
+            return None
+
+        def finish(result=None):
+            if result is None:
+                call.abandoned = True
+            call.result = result
+            self._end(key, call)
+
+        return finish
+
+    def stats(self):
+        stats = {
+            "in_flight": len(self._calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
+        if self.across:
+            stats["across_processes"] = self.across.stats()
+        return stats
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines sharing one event loop"""
+
+    def __init__(self, across=None):
+        self.across = across
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    async def do(self, key, fn):
+        """``fn`` is a zero-argument coroutine function"""
+        future = self._calls.get(key)
+        while future is not None:
+            # shield: one waiter being cancelled must not cancel the shared call
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded() from None
+            except CALLER_ERRORS:
+                # The leader's own deadline or admission, not ours: run it again
+                self._forget(key, future)
+                self.retried += 1
+                future = self._calls.get(key)
+                continue
+            self.coalesced += 1
+            return result
+
+        self.executed += 1
+        future = self._calls[key] = asyncio.ensure_future(self.across.ado(key, fn) if self.across else fn())
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._forget(key, future)
+            else:
+                future.add_done_callback(lambda _: self._forget(key, future))
+
+    def _forget(self, key, future):
+        # A follower may already have started the next call for ``key``
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def stats(self):
+        stats = {
+            "in_flight": len(self._calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
+        if self.across:
+            stats["across_processes"] = self.across.stats()
+        return stats
+
+
+class FileSingleFlight:
+    """Coalesce calls across processes (gunicorn workers) through lock files
+
+    The first process to lock ``<directory>/<key>.lock`` runs the function
+    and writes its result to ``<key>.json`` before unlocking. Processes that
+    were waiting on the lock then find a result written after they arrived
+    and return it; if there is none (the leader failed, whatever the error)
+    the next one runs the function itself. Waiting is capped at ``timeout`` seconds, after
+    which the caller runs the function without the lock.
+
+    Use it behind an in-process SingleFlight, so each process sends at most
+    one caller per key to the lock.
+    """
+
+    def __init__(self, directory, timeout=200.0, poll=0.05):
+        if fcntl is None:
+            raise RuntimeError("FileSingleFlight needs fcntl (not available on this platform)")
+        self.directory = directory
+        self.timeout = timeout
+        self.poll = poll
+        self.executed = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:40]
+        return os.path.join(self.directory, name + ".lock"), os.path.join(self.directory, name + ".json")
+
+    @staticmethod
+    def _try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @staticmethod
+    def _result_since(path, since):
+        """(True, value) if ``path`` holds a result written at or after ``since``"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+        if record.get("at", 0) < since:
+            return False, None
+        return True, record.get("value")
+
+    def _store(self, path, value):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"at": time.time(), "value": value}, f)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("Coalesced result not shared: %s", e)
+        if self.executed % 100 == 0:
+            self.sweep()
+
+    def sweep(self):
+        """Remove files no call can still be waiting on"""
+        cutoff = time.time() - 2 * self.timeout
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+        except OSError:
+            pass
+
+    def _open(self, key):
+        lock_path, result_path = self._paths(key)
+        return os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600), result_path
+
+    def do(self, key, fn):
+        since = time.time()
+        fd, result_path = self._open(key)
+        try:
+            waited = False
+            while not self._try_lock(fd):
+                waited = True
+                if deadline.expired():
+                    raise DeadlineExceeded()
+                if time.time() - since > self.timeout:
+                    self.timeouts += 1
+                    return fn()
+                time.sleep(self.poll)
+            try:
+                if waited:
+                    found, value = self._result_since(result_path, since)
+                    if found:
+                        self.coalesced += 1
+                        return value
+                self.executed += 1
+                value = fn()
+                self._store(result_path, value)
+                return value
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    async def ado(self, key, fn):
+        """do() for a zero-argument coroutine function; polls without blocking the loop"""
+        since = time.time()
+        fd, result_path = self._open(key)
+        try:
+            waited = False
+            while not self._try_lock(fd):
+                waited = True
+                if deadline.expired():
+                    raise DeadlineExceeded()
+                if time.time() - since > self.timeout:
+                    self.timeouts += 1
+                    return await fn()
+                await asyncio.sleep(self.poll)
+            try:
+                if waited:
+                    found, value = self._result_since(result_path, since)
+                    if found:
+                        self.coalesced += 1
+                        return value
+                self.executed += 1
+                value = await fn()
+                self._store(result_path, value)
+                return value
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "directory": self.directory,
+        }
@@ -41,6 +41,14 @@ let commandCount = 0;
 let startTime = Date.now();
 let selectedImage = null;
 let selectedImageBase64 = null;
+// The server keeps the conversation under this id, so follow-ups have context
+let sessionId = sessionStorage.getItem('sessionId') || newSessionId();
+
+function newSessionId() {
+    const id = (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+    sessionStorage.setItem('sessionId', id);
+    return id;
+}
 
 // ===== INITIALIZATION =====
 function initializeApp() {
@@ -524,44 +532,38 @@ async function sendMessage() {
         // Prepare request data
         const requestData = {
             command: text || '',
-            type: hasImage ? 'image' : 'text'
+            type: hasImage ? 'image' : 'text',
+            session_id: sessionId
         };
         
-        if (hasImage) {
-            // IMPROVED: Better regex to handle various image MIME types
-            const base64Regex = /^data:image\/(\w+);base64,/;
-            const matches = selectedImageBase64.match(base64Regex);
-            
-            if (matches) {
-                const mimeType = matches[1];
-                // Extract base64 data (everything after the comma)
-                const base64Data = selectedImageBase64.split(',')[1];
-                requestData.image = base64Data;
-                requestData.image_type = `image/${mimeType}`;
-                console.log(`Detected image type: image/${mimeType}`);
-            } else {
-                // Fallback
-                const base64Data = selectedImageBase64.replace(/^data:[^,]+,/, '');
-                requestData.image = base64Data;
-                requestData.image_type = 'image/jpeg';
-                console.warn('Could not extract MIME type, defaulting to JPEG');
-            }
-        }
-        
         console.log('Sending request:', { 
             hasImage, 
             commandLength: requestData.command.length,
-            imageSize: hasImage ? requestData.image.length : 0,
+            imageSize: hasImage ? selectedImage.size : 0,
             timestamp: new Date().toISOString()
         });
         
-        const response = await fetch('/ask', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(requestData)
-        });
+        // Text messages stream in as HTML fragments; images go to /ask/image
+        if (!hasImage && await streamMessage(requestData, thinkingId)) {
+            if (text.toLowerCase().includes('weather')) {
+                loadWeather();
+            }
+            return;
+        }
+        
+        // Images are uploaded as multipart form data: the raw file, no base64
+        const response = hasImage
+            ? await fetch('/ask/image', {
+                method: 'POST',
+                body: buildImageForm(requestData.command, selectedImage)
+            })
+            : await fetch('/ask', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify(requestData)
+            });
         
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
@@ -662,6 +664,101 @@ async function sendMessage() {
         updateStats();
     }
 }
+
+// ===== STREAMING RESPONSES =====
+// Reads /ask/stream (Server-Sent Events) and shows fragments in the thinking
+// bubble as they arrive. Returns false if streaming is unavailable so the
+// caller can fall back to /ask.
+async function streamMessage(requestData, thinkingId) {
+    let response;
+    try {
+        response = await fetch('/ask/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(requestData)
+        });
+    } catch (error) {
+        console.warn('Streaming unavailable, falling back to /ask:', error);
+        return false;
+    }
+    
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!response.ok || !response.body || !contentType.includes('text/event-stream')) {
+        return false;
+    }
+    
+    const thinkingElement = document.getElementById(thinkingId);
+    const thinkingBody = thinkingElement ? thinkingElement.querySelector('.message-body') : null;
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let html = '';
+    let streamError = null;
+    let finished = false;
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const event = parseSseEvent(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            
+            if (event.type === 'chunk') {
+                html += event.data.html;
+                if (thinkingBody) {
+                    thinkingBody.innerHTML = html;
+                    messages.scrollTop = messages.scrollHeight;
+                }
+            } else if (event.type === 'done') {
+                finished = true;
+            } else if (event.type === 'error') {
+                streamError = event.data.error;
+            }
+        }
+    }
+    
+    // Replace the live bubble with a regular message so code blocks,
+    // highlighting and expand/collapse are applied once to the full reply
+    removeThinkingMessage(thinkingId);
+    if (streamError && !html) {
+        addMessage(`❌ Error: ${streamError}`, false);
+    } else {
+        // Keep what arrived, but say the reply is incomplete
+        if (streamError || !finished) {
+            const reason = streamError || 'The connection closed before the reply was complete.';
+            html += `<p><strong>⚠️ ${escapeHtml(reason)}</strong></p>`;
+        }
+        addMessage(html, false);
+    }
+    return true;
+}
+
+function parseSseEvent(rawEvent) {
+    const event = { type: 'message', data: {} };
+    const dataLines = [];
+    
+    rawEvent.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+            event.type = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            dataLines.push(line.slice(5).trim());
+        }
+    });
+    
+    if (dataLines.length) {
+        try {
+            event.data = JSON.parse(dataLines.join('\n'));
+        } catch (e) {
+            console.warn('Could not parse stream event:', e);
+        }
+    }
+    return event;
+}
 // Add this to your global functions
 function debugLastResponse() {
     // Get all debug keys from localStorage
@@ -1120,7 +1217,7 @@ async function processVoiceCommand(transcript) {
         const response = await fetch('/ask', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ command: transcript })
+            body: JSON.stringify({ command: transcript, session_id: sessionId })
         });
         
         const data = await response.json();
@@ -1230,6 +1327,13 @@ function handleImageUpload(event) {
     reader.readAsDataURL(file);
 }
 
+function buildImageForm(command, file) {
+    const form = new FormData();
+    form.append('command', command);
+    form.append('image', file, file.name);
+    return form;
+}
+
 function formatFileSize(bytes) {
     if (bytes === 0) return '0 Bytes';
     const k = 1024;
@@ -1428,6 +1532,9 @@ function clearChat() {
         }
         messageCount = 0;
         updateStats();
+        // Start a new conversation; the old one is forgotten on the server too
+        fetch(`/sessions/${encodeURIComponent(sessionId)}`, { method: 'DELETE' }).catch(() => {});
+        sessionId = newSessionId();
     }
 }
 
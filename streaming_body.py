@@ -0,0 +1,107 @@
+"""JSON request bodies that stream one large base64 value.
+
+Gemini wants images inline as base64 inside the JSON request. Building that
+as a dict and letting requests/httpx serialize it holds the image two or
+three times over. StreamingJSONBody writes the JSON envelope around a
+placeholder once, then base64-encodes the image piece by piece while the
+body is being sent, so memory per request stays at one chunk regardless of
+image size.
+"""
+import base64
+import io
+import json
+
+# Stands in for the streamed value when the envelope is serialized
+PLACEHOLDER = "\x00streamed-value\x00"
+
+
+def base64_length(size):
+    """Length of ``size`` bytes once base64 encoded (with padding)"""
+    return 4 * ((size + 2) // 3)
+
+
+class StreamingJSONBody:
+    """Re-iterable body for ``requests`` (``data=``) and httpx (``content=``,
+    or ``content=body.async_content`` with an AsyncClient).
+
+    ``payload`` contains PLACEHOLDER exactly once, as a string value.
+    ``source`` is raw bytes, a seekable binary file (both base64-encoded on
+    the fly) or a str that is already base64. Each iteration starts from the
+    top of the source, so retries can resend the same object.
+    """
+
+    chunk_size = 3 * 16 * 1024  # a multiple of 3: chunks encode without padding
+
+    def __init__(self, payload, source):
+        envelope = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        prefix, found, suffix = envelope.partition(json.dumps(PLACEHOLDER).encode("utf-8"))
+        if not found:
+            raise ValueError("payload has no PLACEHOLDER value")
+        self.prefix = prefix + b'"'
+        self.suffix = b'"' + suffix
+        self.source = source
+
+    @property
+    def value_length(self):
+        """Length of the base64 value in the body"""
+        if isinstance(self.source, str):
+            return len(self.source)
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            size = len(self.source)
+        else:
+            size = self.source.seek(0, io.SEEK_END)
+        return base64_length(size)
+
+    def __len__(self):
+        return len(self.prefix) + self.value_length + len(self.suffix)
+
+    @property
+    def headers(self):
+        # An explicit length keeps both clients from falling back to chunked encoding
+        return {"Content-Type": "application/json", "Content-Length": str(len(self))}
+
+    def _chunks(self):
+        source = self.source
+        if isinstance(source, str):
+            for start in range(0, len(source), self.chunk_size):
+                yield source[start:start + self.chunk_size].encode("ascii")
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            view = memoryview(source)
+            for start in range(0, len(view), self.chunk_size):
+                yield base64.b64encode(view[start:start + self.chunk_size])
+        else:
+            source.seek(0)
+            pending = b""
+            while True:
+                chunk = source.read(self.chunk_size)
+                if not chunk:
+                    break
+                # A short read must not put padding in the middle of the value
+                chunk = pending + chunk
+                cut = len(chunk) - len(chunk) % 3
+                pending = chunk[cut:]
+                if cut:
+                    yield base64.b64encode(chunk[:cut])
+            if pending:
+                yield base64.b64encode(pending)
+
+    def __iter__(self):
+        yield self.prefix
+        yield from self._chunks()
+        yield self.suffix
+
+    @property
+    def async_content(self):
+        """The same body as an async iterable, for httpx.AsyncClient (``content=``)"""
+        return _AsyncChunks(self)
+
+
+class _AsyncChunks:
+    # Only __aiter__: httpx picks its sync path for anything that is also iterable
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        # Chunks come from memory or a local spool file; not worth a thread per read
+        for chunk in self.body:
+            yield chunk
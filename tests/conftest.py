@@ -0,0 +1,53 @@
+"""Shared setup: the app runs offline, against the Gemini stand-in in benchmarks/stubs.py
+
+The stub has to be listening before app is imported (app reads
+GEMINI_API_BASE at import), so it starts here rather than in a fixture.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from stubs import GeminiStub  # noqa: E402
+
+GEMINI = GeminiStub(chunk_delay=0)
+GEMINI.start()
+SCRATCH = tempfile.mkdtemp(prefix="assistant-tests-")
+
+os.environ.update(
+    API_KEY="test",
+    GEMINI_API_BASE=GEMINI.base_url,
+    NEWS_PREFETCH="0",
+    CPU_POOL_WORKERS="0",
+    WARMUP="0",
+    RATE_LIMIT_PER_MINUTE="0",
+    ASK_CACHE_DB="",
+    SESSION_DB="",
+    ASK_COALESCE_DIR="",
+    ASSETS_DIR=os.path.join(SCRATCH, "dist"),
+    GAZETTEER_INDEX=os.path.join(SCRATCH, "gazetteer.idx"),
+)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if "app" in sys.modules:
+        sys.modules["app"].CPU_POOL.shutdown()
+    GEMINI.stop()
+    shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+@pytest.fixture
+def gemini():
+    return GEMINI
+
+
+@pytest.fixture
+def client():
+    import app
+    return app.app.test_client()
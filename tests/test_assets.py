@@ -0,0 +1,85 @@
+"""Fingerprinted static files: lookup() by hash and conditional GETs of /assets/"""
+import os
+
+import pytest
+
+import app
+import assets
+
+
+@pytest.fixture
+def static(tmp_path):
+    static_dir = tmp_path / "static"
+    static_dir.mkdir()
+    (static_dir / "script.js").write_text("console.log('hello');\n" * 50)
+    (static_dir / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(64))
+    out_dir = str(tmp_path / "dist")
+    return assets.StaticAssets.open(str(static_dir), out_dir), static_dir, out_dir
+
+
+def test_lookup_current_outdated_and_missing(static):
+    served, _, _ = static
+    path = served.path("script.js")
+    assert assets.FINGERPRINT.search(path)
+
+    asset, current = served.lookup(path)
+    assert asset.name == "script.js" and current
+
+    outdated = assets.FINGERPRINT.sub(".0123456789ab", path, count=1)
+    asset, current = served.lookup(outdated)
+    assert asset.name == "script.js" and not current
+
+    assert served.lookup("nothing.0123456789ab.js") == (None, False)
+    assert served.lookup("script.js")[1] is False
+    assert served.stats()["outdated"] == 2
+    assert served.stats()["missing"] == 1
+
+
+def test_rebuild_changes_the_hash(static):
+    served, static_dir, out_dir = static
+    old = served.path("script.js")
+    (static_dir / "script.js").write_text("console.log('changed');\n")
+    os.utime(static_dir / "script.js", (1e10, 1e10))
+    rebuilt = assets.StaticAssets.open(str(static_dir), out_dir)
+    assert rebuilt.path("script.js") != old
+    assert rebuilt.lookup(old)[1] is False
+
+
+@pytest.fixture
+def served(static, monkeypatch):
+    monkeypatch.setattr(app, "_static_assets", static[0])
+    return static[0]
+
+
+def test_current_hash_is_immutable_and_revalidates_to_304(client, served):
+    url = f"/assets/{served.path('script.js')}"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    etag = response.headers["ETag"]
+    again = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == etag
+
+    # The identity variant has its own ETag
+    plain = client.get(url, headers={"If-None-Match": etag})
+    assert plain.status_code == 200
+    assert plain.headers["ETag"] != etag
+    assert served.stats()["not_modified"] == 1
+
+
+def test_outdated_hash_gets_the_current_file_uncached(client, served):
+    path = assets.FINGERPRINT.sub(".0123456789ab", served.path("logo.png"), count=1)
+    response = client.get(f"/assets/{path}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.get_data().startswith(b"\x89PNG")
+    assert client.get(f"/assets/{path}", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_unknown_asset_is_404(client, served):
+    assert client.get("/assets/missing.0123456789ab.css").status_code == 404
@@ -0,0 +1,66 @@
+"""Gazetteer.find() and closest() over an index of the seed data"""
+import pytest
+
+import gazetteer
+
+
+@pytest.fixture(scope="module")
+def places(tmp_path_factory):
+    index = tmp_path_factory.mktemp("gazetteer") / "gazetteer.idx"
+    gazetteer.build(gazetteer.DEFAULT_SOURCE, str(index))
+    places = gazetteer.Gazetteer(str(index))
+    yield places
+    places.close()
+
+
+def name(place):
+    return place and place.name
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("weather in dhaka", "Dhaka"),
+    ("What's the weather like in DHAKA today?", "Dhaka"),
+    ("how hot is it in cox's bazar right now", "Cox's Bazar"),
+    ("coxs bazar forecast", "Cox's Bazar"),
+    ("weather new york tomorrow", "New York"),
+    ("temperature in new york city", "New York"),
+    # The longest name wins over a shorter one inside it
+    ("weather in chapai nawabganj", "Chapai Nawabganj"),
+    ("weather in kuala lumpur", "Kuala Lumpur"),
+    # Alternate names
+    ("weather in chattogram", "Chittagong"),
+    ("bombay weather", "Mumbai"),
+    ("weather in são paulo", "Sao Paulo"),
+    ("ঢাকা weather", "Dhaka"),
+])
+def test_find(places, text, expected):
+    assert name(places.find(text)) == expected
+
+
+@pytest.mark.parametrize("text", ["what's the weather", "weather in atlantis", "", "in the city"])
+def test_find_nothing(places, text):
+    assert places.find(text) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("dhaka", "Dhaka"),
+    ("dhka", "Dhaka"),            # a letter missing
+    ("dhakka", "Dhaka"),          # a letter too many
+    ("dhoka", "Dhaka"),           # a letter changed
+    ("dahka", "Dhaka"),           # two letters swapped
+    ("weather in sylht", "Sylhet"),
+    ("chitagong", "Chittagong"),
+    ("londn", "London"),
+])
+def test_closest(places, text, expected):
+    assert name(places.closest(text)) == expected
+
+
+@pytest.mark.parametrize("text", ["dk", "xyzzy", "dhxxa", "weather"])
+def test_closest_nothing(places, text):
+    assert places.closest(text) is None
+
+
+def test_closest_prefers_exact_name(places):
+    # "Feni" is itself a name, though one edit from others
+    assert name(places.closest("feni")) == "Feni"
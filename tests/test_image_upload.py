@@ -0,0 +1,104 @@
+"""Malformed image uploads are answered 4xx before anything reaches Gemini"""
+import base64
+import io
+
+import pytest
+from starlette.testclient import TestClient
+
+import app
+import asgi
+
+PNG = base64.b64encode(b"not really a png").decode()
+
+
+@pytest.fixture
+def upstream_calls(gemini):
+    before = gemini.counters["requests"]
+    return lambda: gemini.counters["requests"] - before
+
+
+@pytest.mark.parametrize("body, error", [
+    ({"command": "what is this", "image": 123}, "image must be a base64 string."),
+    ({"command": "what is this", "image": ["aGk="]}, "image must be a base64 string."),
+    ({"command": "what is this", "image": {"data": "aGk="}}, "image must be a base64 string."),
+    ({"command": "what is this", "image": PNG, "image_type": 5}, "image_type must be a string such as image/png."),
+])
+def test_ask_rejects_malformed_image_fields(client, upstream_calls, body, error):
+    response = client.post("/ask", json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {"error": error, "type": "image"}
+
+    with TestClient(asgi.app) as async_client:
+        response = async_client.post("/ask", json=body)
+    assert response.status_code == 400
+    assert response.json() == {"error": error, "type": "image"}
+    assert upstream_calls() == 0
+
+
+def test_batch_rejects_a_malformed_item(client, upstream_calls):
+    body = {"items": [{"command": "tell me a joke"}, {"command": "what is this", "image": 5}]}
+    response = client.post("/ask/batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Item 1: image must be a base64 string."
+
+    with TestClient(asgi.app) as async_client:
+        assert async_client.post("/ask/batch", json=body).status_code == 400
+    assert upstream_calls() == 0
+
+
+@pytest.mark.parametrize("kwargs, status", [
+    ({"data": b"", "content_type": "image/png"}, 400),
+    ({"data": {"command": "what is this"}, "content_type": "multipart/form-data"}, 400),
+    ({"data": {"image": (io.BytesIO(b""), "empty.png", "image/png")}, "content_type": "multipart/form-data"}, 400),
+    ({"data": b"hello", "content_type": "text/plain"}, 415),
+])
+def test_ask_image_rejections(client, upstream_calls, kwargs, status):
+    response = client.post("/ask/image", **kwargs)
+    assert response.status_code == status
+    assert response.get_json()["type"] == "image"
+    assert upstream_calls() == 0
+
+
+def test_ask_image_over_the_limit_is_413(client, upstream_calls, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_UPLOAD_MAX_BYTES", 1024)
+    response = client.post("/ask/image", data=b"\xff" * 4096, content_type="image/jpeg")
+    assert response.status_code == 413
+    assert upstream_calls() == 0
+
+
+def test_undecodable_image_is_still_sent_to_gemini(client, upstream_calls):
+    # Well-formed request, unreadable image: Gemini judges it, as it always has
+    response = client.post("/ask", json={"command": "what is this", "image": PNG, "image_type": "image/png"})
+    assert response.status_code == 200
+    assert response.get_json()["type"] == "image"
+    assert upstream_calls() == 1
+
+
+def test_real_image_is_analyzed(client, upstream_calls):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "teal").save(buffer, "PNG")
+    response = client.post("/ask/image?command=describe", data=buffer.getvalue(), content_type="image/png")
+    assert response.status_code == 200
+    assert response.get_json()["analysis"]
+    assert upstream_calls() == 1
+
+
+def test_upload_sizes_compare_in_base64_units(client, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    from metrics import Counter, Histogram
+    from streaming_body import base64_length
+
+    saved = Counter("saved", "", ["transport"])
+    sizes = Histogram("sizes", "", ["stage", "transport"], app.SIZE_BUCKETS)
+    monkeypatch.setattr(app, "IMAGE_BYTES_SAVED", saved)
+    monkeypatch.setattr(app, "IMAGE_UPLOAD_BYTES", sizes)
+    # Noise doesn't compress: the prepared image is no smaller than the upload
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (64, 64), bytes(range(256)) * 48).save(buffer, "PNG")
+    upload = buffer.getvalue()
+
+    assert client.post("/ask/image", data=upload, content_type="image/png").status_code == 200
+    assert sizes._values[("received", "raw")][1] == base64_length(len(upload))
+    assert sizes._values[("sent", "raw")][1] >= base64_length(len(upload)) * 0.5
+    assert saved._values[("raw",)] >= 0
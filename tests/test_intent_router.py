@@ -0,0 +1,81 @@
+"""IntentRouter picks the same intent as trying each one's patterns in order"""
+import random
+
+import pytest
+
+from intent_router import IntentRouter
+
+COMMANDS = [
+    "write code for quicksort in python",
+    "what is your name",
+    "what's the weather in dhaka",
+    "weather tomorrow in new york",
+    "tell me a joke",
+    "latest news please",
+    "news about the weather",
+    "open youtube",
+    "please open the pod bay doors",
+    "search for flask streaming responses",
+    "youtube search lofi beats",
+    "search youtube for lofi beats",
+    "write an essay about climate change",
+    "write a program that prints an essay outline",
+    "implement a function to reverse a linked list",
+    "explain how transformers work in machine learning",
+    "where do you live",
+    "what time is it",
+    "what is the date today",
+    "when is your birthday",
+    "what is your father's name",
+    "what is the capital of bangladesh and how big is its population",
+    "",
+    "   ",
+]
+
+
+def sequential(router, text):
+    """The first intent, in declaration order, that matches and isn't vetoed"""
+    for intent in router._intents:
+        if intent.matches(text) and not intent.vetoed(text):
+            return intent.name
+    return None
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_app_router_matches_sequential_order(command):
+    from app import ROUTER
+
+    text = command.lower()
+    assert ROUTER.match(text) == sequential(ROUTER, text)
+
+
+def overlapping_router():
+    """Intents whose literal prefixes overlap, anchored ones and vetoes"""
+    router = IntentRouter()
+    noop = lambda orig, cmd: None  # noqa: E731
+    router.add("ab", "ab", noop)
+    router.add("abc_anchored", "abc", noop, anchored=True)
+    router.add("abcd", ["abcd", "x+y"], noop)
+    router.add("a_then_d", "a.*d", noop, unless="dd")
+    router.add("alternation", "ba|cb", noop)
+    router.add("class", "[cd]a", noop)
+    router.add("b_plus", "b+c", noop)
+    return router
+
+
+def test_overlapping_prefixes_match_sequential_order():
+    router = overlapping_router()
+    rng = random.Random(7)
+    for _ in range(3000):
+        text = "".join(rng.choice("abcdxy ") for _ in range(rng.randint(0, 8)))
+        assert router.match(text) == sequential(router, text), text
+
+
+def test_declined_handler_falls_through_to_next_intent():
+    router = IntentRouter()
+    router.add("declines", "hello", lambda orig, cmd: None)
+    router.add("answers", "hello", lambda orig, cmd: f"hi {orig}")
+    router.fallback(lambda orig, cmd: "fallback")
+
+    assert router.resolve("Hello") == ("answers", "hi Hello")
+    assert router.resolve("bye") == ("fallback", "fallback")
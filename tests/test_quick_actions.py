@@ -0,0 +1,39 @@
+"""Quick actions take whatever options a client sends without a 500"""
+import pytest
+from starlette.testclient import TestClient
+
+import app
+import asgi
+
+
+@pytest.fixture
+def news_requests(monkeypatch):
+    requests = []
+
+    def get(**params):
+        requests.append(params)
+        return "headlines"
+
+    monkeypatch.setattr(app, "NEWS_API_KEY", "test")
+    monkeypatch.setattr(app.NEWS_FEED, "get", get)
+    return requests
+
+
+@pytest.mark.parametrize("options, expected", [
+    ({"country": "BD", "category": "sports", "page_size": "3"}, {"country": "bd", "category": "sports", "pageSize": 3}),
+    ({"country": 5}, {"country": "us", "category": None, "pageSize": 5}),
+    ({"country": ""}, {"country": "us", "category": None, "pageSize": 5}),
+    ({"page_size": "abc"}, {"country": "us", "category": None, "pageSize": 5}),
+    ({"page_size": [3], "category": ["sports"]}, {"country": "us", "category": None, "pageSize": 5}),
+    ({"page_size": 500}, {"country": "us", "category": None, "pageSize": 20}),
+    (["not", "an", "object"], {"country": "us", "category": None, "pageSize": 5}),
+])
+def test_news_options_are_coerced(client, news_requests, options, expected):
+    response = client.post("/quick-action/news", json=options)
+    assert response.status_code == 200
+    assert response.get_json() == {"response": "headlines", "type": "quick_action"}
+
+    with TestClient(asgi.app) as async_client:
+        response = async_client.post("/quick-action/news", json=options)
+    assert response.status_code == 200
+    assert news_requests == [expected, expected]
@@ -0,0 +1,53 @@
+"""Rate limiting charges /ask/batch one token per item"""
+import pytest
+
+import app
+from admission import RateLimiter
+
+
+def test_cost_is_taken_from_the_bucket():
+    limiter = RateLimiter(rate=1, burst=10)
+    assert limiter.check("client", cost=4) == 0
+    assert limiter.check("client", cost=4) == 0
+    # Two tokens left: a cost of 4 waits for the other two
+    assert limiter.check("client", cost=4) > 0
+    assert limiter.check("client", cost=2) == 0
+    assert limiter.check("other", cost=10) == 0
+
+
+def test_cost_above_burst_goes_ahead_on_a_full_bucket_and_leaves_debt():
+    limiter = RateLimiter(rate=60, burst=3)
+    assert limiter.check("client", cost=5) == 0
+    # Two tokens in debt: the next request waits for three to come back
+    assert limiter.check("client") == pytest.approx(3, abs=0.1)
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    limiter = RateLimiter(rate=1, burst=3)
+    monkeypatch.setattr(app, "RATE_LIMITER", limiter)
+    return limiter
+
+
+def batch(client, size):
+    return client.post("/ask/batch", json={"items": [{"command": "tell me a joke"}] * size})
+
+
+def test_batch_pays_per_item(client, limiter):
+    assert batch(client, 2).status_code == 200
+    assert batch(client, 1).status_code == 200
+    response = batch(client, 1)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert limiter.counters == {"allowed": 2, "limited": 1}
+
+
+def test_batch_over_burst_is_refused_until_the_bucket_refills(client, limiter):
+    assert client.post("/ask", json={"command": "tell me a joke"}).status_code == 200
+    assert batch(client, 3).status_code == 429
+    assert client.post("/ask", json={"command": "tell me a joke"}).status_code == 200
+
+
+def test_invalid_batch_is_not_charged(client, limiter):
+    assert client.post("/ask/batch", json={"items": []}).status_code == 400
+    assert limiter.counters == {"allowed": 0, "limited": 0}
@@ -0,0 +1,30 @@
+"""Sessions in SESSION_DB are seen by every worker"""
+import subprocess
+import sys
+
+from conftest import ROOT
+from sessions import SessionStore
+
+
+def test_workers_share_a_session_through_the_db(tmp_path):
+    db = str(tmp_path / "sessions.sqlite3")
+    first, second = SessionStore(db_path=db), SessionStore(db_path=db)
+    first.record("session-1", "What is the capital of France?", "Paris.")
+
+    assert second.has_history("session-1")
+    assert second.get("session-1")["turns"][-1]["text"] == "Paris."
+    assert not SessionStore().has_history("session-1")
+
+
+def test_gunicorn_config_shares_sessions_between_workers(tmp_path):
+    script = ("import os, runpy; runpy.run_path('gunicorn.conf.py'); "
+              "print(os.environ.get('SESSION_DB', ''))")
+
+    def session_db(**env):
+        env = {"PATH": "", "TMPDIR": str(tmp_path), **env}
+        return subprocess.run([sys.executable, "-c", script], cwd=ROOT, env=env,
+                              capture_output=True, text=True, check=True).stdout.strip()
+
+    assert session_db() == str(tmp_path / "sessions.sqlite3")
+    assert session_db(SESSION_DB="/data/s.db") == "/data/s.db"
+    assert session_db(WEB_CONCURRENCY="1") == ""
@@ -0,0 +1,180 @@
+"""SingleFlight shares a call's result and errors, but not a leader's own
+deadline or admission failure"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import deadline
+from admission import Overloaded
+from deadline import DeadlineExceeded
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def wait_until(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.005)
+
+
+def run_with_follower(flight, leader_fn, follower_fn):
+    """Start a leader, let one follower join it, release the leader; returns
+    {"leader": (result, error), "follower": (result, error)}"""
+    release = threading.Event()
+    outcomes = {}
+
+    def call(name, fn):
+        try:
+            outcomes[name] = (flight.do("key", fn), None)
+        except Exception as e:
+            outcomes[name] = (None, e)
+
+    def leader():
+        release.wait(5)
+        return leader_fn()
+
+    threads = [threading.Thread(target=call, args=("leader", leader))]
+    threads[0].start()
+    wait_until(lambda: "key" in flight._calls)
+    threads.append(threading.Thread(target=call, args=("follower", follower_fn)))
+    threads[1].start()
+    wait_until(lambda: flight._calls["key"].waiters == 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+def test_followers_share_the_result():
+    flight = SingleFlight()
+    outcomes = run_with_follower(flight, lambda: "shared", lambda: "own")
+    assert outcomes == {"leader": ("shared", None), "follower": ("shared", None)}
+    assert flight.stats()["executed"] == 1
+    assert flight.stats()["coalesced"] == 1
+
+
+def test_followers_share_an_ordinary_error():
+    flight = SingleFlight()
+    error = ValueError("upstream said no")
+
+    def fail():
+        raise error
+
+    outcomes = run_with_follower(flight, fail, lambda: "own")
+    assert outcomes["leader"][1] is error
+    assert outcomes["follower"][1] is error
+    assert flight.stats()["executed"] == 1
+
+
+@pytest.mark.parametrize("error", [DeadlineExceeded(), Overloaded("queue_full", 2)])
+def test_caller_errors_stay_with_the_leader(error):
+    flight = SingleFlight()
+
+    def fail():
+        raise error
+
+    outcomes = run_with_follower(flight, fail, lambda: "retried")
+    assert outcomes["leader"][1] is error
+    assert outcomes["follower"] == ("retried", None)
+    assert flight.stats()["executed"] == 2
+    assert flight.stats()["retried"] == 1
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_follower_stops_waiting_at_its_own_deadline():
+    flight = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flight.do, args=("key", lambda: release.wait(5)))
+    leader.start()
+    wait_until(lambda: "key" in flight._calls)
+    try:
+        with deadline.within(0.05), pytest.raises(DeadlineExceeded):
+            flight.do("key", lambda: "never run")
+    finally:
+        release.set()
+        leader.join(5)
+
+
+def test_begin_shares_a_streamed_result():
+    flight = SingleFlight()
+    finish = flight.begin("key")
+    assert finish is not None
+    assert flight.begin("key") is None
+
+    follower = {}
+    thread = threading.Thread(target=lambda: follower.update(result=flight.do("key", lambda: "own")))
+    thread.start()
+    wait_until(lambda: flight._calls["key"].waiters == 1)
+    finish("streamed")
+    thread.join(5)
+    assert follower["result"] == "streamed"
+
+
+def test_begin_finished_without_a_result_lets_followers_retry():
+    flight = SingleFlight()
+    finish = flight.begin("key")
+    follower = {}
+    thread = threading.Thread(target=lambda: follower.update(result=flight.do("key", lambda: "own")))
+    thread.start()
+    wait_until(lambda: flight._calls["key"].waiters == 1)
+    finish(None)
+    thread.join(5)
+    assert follower["result"] == "own"
+    assert flight.stats()["retried"] == 1
+
+
+def run_async_with_follower(leader_fn, follower_fn):
+    flight = AsyncSingleFlight()
+
+    async def main():
+        release = asyncio.Event()
+
+        async def leader():
+            await release.wait()
+            return await leader_fn()
+
+        leading = asyncio.ensure_future(flight.do("key", leader))
+        await asyncio.sleep(0)
+        following = asyncio.ensure_future(flight.do("key", follower_fn))
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(leading, following, return_exceptions=True)
+
+    return flight, asyncio.run(main())
+
+
+def test_async_followers_share_result_and_ordinary_errors():
+    async def shared():
+        return "shared"
+
+    async def own():
+        return "own"
+
+    flight, results = run_async_with_follower(shared, own)
+    assert results == ["shared", "shared"]
+    assert flight.stats()["executed"] == 1
+
+    error = ValueError("upstream said no")
+
+    async def fail():
+        raise error
+
+    flight, results = run_async_with_follower(fail, own)
+    assert results == [error, error]
+
+
+@pytest.mark.parametrize("error", [DeadlineExceeded(), Overloaded("queue_timeout", 1)])
+def test_async_caller_errors_stay_with_the_leader(error):
+    async def fail():
+        raise error
+
+    async def retried():
+        return "retried"
+
+    flight, results = run_async_with_follower(fail, retried)
+    assert results == [error, "retried"]
+    assert flight.stats()["executed"] == 2
+    assert flight.stats()["retried"] == 1
+    assert flight.stats()["in_flight"] == 0
@@ -0,0 +1,101 @@
+"""Small TTL cache that coalesces misses and can fall back to stale values.
+
+Used for upstream data that changes slowly (weather). A miss for a key is
+loaded once no matter how many threads ask for it at the same time, and if
+the load fails an expired value younger than ``stale_ttl`` is returned
+instead of the error.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+class TTLCache:
+    def __init__(self, ttl, stale_ttl=0.0, max_entries=1024):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.flight = SingleFlight()
+        self.async_flight = AsyncSingleFlight()
+        self.counters = {"hits": 0, "misses": 0, "loads": 0, "stale_served": 0, "load_errors": 0}
+
+    def _entry(self, key):
+        """Return (value, age) for a stored key, however old, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], time.monotonic() - entry[1]
+
+    def get(self, key):
+        entry = self._entry(key)
+        if entry is not None and entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load(self, key, loader):
+        # Another flight may have filled the key while this one was queued
+        fresh = self.get(key)
+        if fresh is not None:
+            return fresh
+        self.counters["loads"] += 1
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def get_or_load(self, key, loader):
+        entry = self._entry(key)
+        if entry is not None and entry[1] < self.ttl:
+            self.counters["hits"] += 1
+            return entry[0]
+
+        self.counters["misses"] += 1
+        try:
+            return self.flight.do(key, lambda: self._load(key, loader))
+        except Exception:
+            self.counters["load_errors"] += 1
+            if entry is not None and entry[1] < self.ttl + self.stale_ttl:
+                self.counters["stale_served"] += 1
+                return entry[0]
+            raise
+
+    async def aget_or_load(self, key, loader):
+        """get_or_load() for the ASGI app; ``loader`` is a coroutine function"""
+        entry = self._entry(key)
+        if entry is not None and entry[1] < self.ttl:
+            self.counters["hits"] += 1
+            return entry[0]
+
+        async def load():
+            fresh = self.get(key)
+            if fresh is not None:
+                return fresh
+            self.counters["loads"] += 1
+            value = await loader()
+            self.set(key, value)
+            return value
+
+        self.counters["misses"] += 1
+        try:
+            return await self.async_flight.do(key, load)
+        except Exception:
+            self.counters["load_errors"] += 1
+            if entry is not None and entry[1] < self.ttl + self.stale_ttl:
+                self.counters["stale_served"] += 1
+                return entry[0]
+            raise
+
+    def stats(self):
+        return {**self.counters, "entries": len(self._entries), **self.flight.stats()}
@@ -0,0 +1,561 @@
+"""Shared HTTP client for upstream APIs (Gemini, OpenWeatherMap, NewsAPI).
+
+One keep-alive connection pool per host, so repeat calls skip the TCP/TLS
+handshake, plus jittered retries on 429/5xx that honor Retry-After and a
+per-host circuit breaker that fails fast while a provider is down.
+UpstreamClient wraps requests for the Flask app; AsyncUpstreamClient applies
+the same policy over httpx for the ASGI app. Both keep every attempt,
+retry pause included, inside the current request's deadline.
+
+Hedger sends a second copy of a request that is slower than usual and
+keeps whichever answer arrives first.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import email.utils
+import math
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import deadline
+from deadline import DeadlineExceeded
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling a host whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Closed → open after N consecutive failures → half-open after a cool-down.
+
+    While open every call fails immediately. Once the cool-down has passed a
+    single trial call is let through; its outcome closes or re-opens the
+    circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = 0.0
+            if self.state == "open":
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "trips": self.trips,
+                "retry_in": round(retry_in, 1),
+            }
+
+
+class _Host:
+    """Breaker and counters for one scheme://host:port"""
+
+    def __init__(self, client):
+        self.breaker = CircuitBreaker(client.failure_threshold, client.reset_timeout)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def pool_stats(self):
+        return []
+
+
+class _SessionHost(_Host):
+    """A keep-alive requests.Session with its own connection pool"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=client.pool_size, max_retries=0)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def pool_stats(self):
+        pools = []
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                # The queue is pre-filled with None placeholders; count real sockets
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+            })
+        return pools
+
+
+class _AsyncHost(_Host):
+    """An httpx.AsyncClient with its own connection pool"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        import httpx
+
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=client.pool_size,
+                                max_keepalive_connections=client.pool_size),
+        )
+        self.max_connections = client.pool_size
+
+    def pool_stats(self):
+        try:
+            # httpcore does not expose pool state publicly
+            connections = self.client._transport._pool.connections
+        except AttributeError:
+            return []
+        return [{
+            "connections_open": len(connections),
+            "idle": sum(1 for conn in connections if conn.is_idle()),
+            "maxsize": self.max_connections,
+        }]
+
+
+def _retry_after(response):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class UpstreamClient:
+    """requests-compatible get()/post() over pooled, retried, breaker-guarded hosts"""
+
+    host_class = _SessionHost
+
+    def __init__(self, pool_size=10, retries=2, backoff=0.5, max_backoff=8.0,
+                 max_retry_after=10.0, connect_timeout=5.0, failure_threshold=5,
+                 reset_timeout=30.0):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.connect_timeout = connect_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, **overrides):
+        env = os.environ.get
+        settings = dict(
+            pool_size=int(env("UPSTREAM_POOL_SIZE", 10)),
+            retries=int(env("UPSTREAM_RETRIES", 2)),
+            backoff=float(env("UPSTREAM_BACKOFF", 0.5)),
+            max_backoff=float(env("UPSTREAM_MAX_BACKOFF", 8)),
+            max_retry_after=float(env("UPSTREAM_MAX_RETRY_AFTER", 10)),
+            connect_timeout=float(env("UPSTREAM_CONNECT_TIMEOUT", 5)),
+            failure_threshold=int(env("UPSTREAM_BREAKER_FAILURES", 5)),
+            reset_timeout=float(env("UPSTREAM_BREAKER_RESET", 30)),
+        )
+        settings.update(overrides)
+        return cls(**settings)
+
+    def _host(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}"
+        host = self._hosts.get(key)
+        if host is None:
+            with self._lock:
+                host = self._hosts.get(key)
+                if host is None:
+                    host = self._hosts[key] = self.host_class(self)
+        return key, host
+
+    def _timeout(self, timeout):
+        # Cut to the time left before the deadline, at every attempt
+        if isinstance(timeout, tuple):
+            return tuple(deadline.clamp(part) for part in timeout)
+        timeout = deadline.clamp(timeout)
+        if timeout is None:
+            return None
+        # A bare number is the read timeout; connecting should never take that long
+        return (min(self.connect_timeout, timeout), timeout)
+
+    @staticmethod
+    def _fits(delay):
+        """Whether pausing ``delay`` seconds still leaves time for another attempt"""
+        left = deadline.remaining()
+        return left is None or delay < left
+
+    def _delay(self, attempt, response=None):
+        if response is not None:
+            wait = _retry_after(response)
+            if wait is not None:
+                return wait
+        # Full jitter: spread retries out so clients don't hammer in lock-step
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _admit(self, name, host):
+        if not host.breaker.allow():
+            host.rejected += 1
+            raise CircuitOpenError(f"Circuit open for {name}")
+        host.requests += 1
+
+    def _after_error(self, host, attempt, retries):
+        """Record a transport error; return the delay before retrying, or None to give up"""
+        host.failures += 1
+        host.breaker.record_failure()
+        if attempt == retries:
+            return None
+        delay = self._delay(attempt)
+        if not self._fits(delay):
+            return None
+        host.retries += 1
+        return delay
+
+    def _after_response(self, host, response, attempt, retries):
+        """Record a response; return the delay before retrying, or None to hand it back"""
+        if response.status_code >= 500:
+            host.failures += 1
+            host.breaker.record_failure()
+        else:
+            host.breaker.record_success()
+
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return None
+        delay = self._delay(attempt, response)
+        if delay > self.max_retry_after or not self._fits(delay):
+            # The provider asked for a longer pause than we are willing to hold the request
+            return None
+        host.retries += 1
+        return delay
+
+    def request(self, method, url, timeout=None, retries=None, **kwargs):
+        name, host = self._host(url)
+        retries = self.retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            attempt_timeout = self._timeout(timeout)
+            self._admit(name, host)
+            try:
+                response = host.session.request(method, url, timeout=attempt_timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                delay = self._after_error(host, attempt, retries)
+                if delay is None:
+                    if deadline.expired():
+                        raise DeadlineExceeded() from e
+                    raise
+                time.sleep(delay)
+                continue
+
+            delay = self._after_response(host, response, attempt, retries)
+            if delay is None:
+                return response
+            response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        return {
+            name: {
+                "requests": host.requests,
+                "retries": host.retries,
+                "failures": host.failures,
+                "rejected_by_breaker": host.rejected,
+                "breaker": host.breaker.snapshot(),
+                "pools": host.pool_stats(),
+            }
+            for name, host in list(self._hosts.items())
+        }
+
+
+class AsyncUpstreamClient(UpstreamClient):
+    """The same pooling, retry and breaker policy over httpx, for the ASGI app.
+
+    Methods are coroutines returning ``httpx.Response``; ``timeout`` takes
+    the same seconds-or-(connect, read) values as the sync client.
+    """
+
+    host_class = _AsyncHost
+
+    def _httpx_timeout(self, timeout):
+        import httpx
+
+        timeout = self._timeout(timeout)
+        if timeout is None:
+            return httpx.Timeout(None)
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+
+    async def request(self, method, url, timeout=None, retries=None, **kwargs):
+        import httpx
+
+        name, host = self._host(url)
+        retries = self.retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            attempt_timeout = self._httpx_timeout(timeout)
+            self._admit(name, host)
+            try:
+                response = await host.client.request(method, url, timeout=attempt_timeout, **kwargs)
+            except httpx.TransportError as e:
+                delay = self._after_error(host, attempt, retries)
+                if delay is None:
+                    if deadline.expired():
+                        raise DeadlineExceeded() from e
+                    raise
+                await asyncio.sleep(delay)
+                continue
+
+            delay = self._after_response(host, response, attempt, retries)
+            if delay is None:
+                return response
+            await response.aclose()
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        for host in list(self._hosts.values()):
+            await host.client.aclose()
+
+
+class Hedger:
+    """Send a backup copy of a slow request and keep the first answer.
+
+    Once a call has taken longer than the ``percentile`` of recent
+    latencies (never less than ``min_delay``), a second attempt starts; the
+    caller gets whichever finishes first. Only idempotent calls belong
+    here. ``max_ratio`` caps backups as a share of calls, so a provider
+    that is slow across the board doesn't get twice the traffic.
+
+    call() runs attempts on a thread pool; a losing attempt can't be
+    interrupted and finishes in the background. acall() cancels the loser.
+    """
+
+    def __init__(self, percentile=0, min_delay=1.0, max_ratio=0.1, window=200, min_samples=20,
+                 workers=32, on_hedge=None):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.workers = workers
+        # on_hedge(outcome): "sent" for each backup, then "won" or "lost" for it
+        self.on_hedge = on_hedge
+        self._latencies = collections.deque(maxlen=window)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "hedged": 0, "won": 0, "skipped": 0}
+
+    @classmethod
+    def from_env(cls, prefix, **kwargs):
+        return cls(
+            percentile=float(os.environ.get(f"{prefix}_HEDGE_PERCENTILE", 0)),
+            min_delay=float(os.environ.get(f"{prefix}_HEDGE_MIN_DELAY", 1.0)),
+            max_ratio=float(os.environ.get(f"{prefix}_HEDGE_MAX_RATIO", 0.1)),
+            **kwargs,
+        )
+
+    @property
+    def enabled(self):
+        return 0 < self.percentile < 100
+
+    def delay(self):
+        """Seconds before hedging, or None while there are too few samples"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, math.ceil(len(ordered) * self.percentile / 100) - 1)
+        return max(self.min_delay, ordered[index])
+
+    def _timed(self, fn):
+        started = time.monotonic()
+        result = fn()
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    async def _atimed(self, fn):
+        started = time.monotonic()
+        result = await fn()
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def _hedge_after(self):
+        """Seconds to wait before the backup, or None when this call won't get one"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.counters["calls"] += 1
+        wait = self.delay()
+        left = deadline.remaining()
+        if wait is None or (left is not None and wait >= left):
+            return None
+        return wait
+
+    def _may_hedge(self, admit):
+        with self._lock:
+            if self.counters["hedged"] + 1 > self.max_ratio * self.counters["calls"]:
+                self.counters["skipped"] += 1
+                return False
+        if admit is not None and not admit():
+            with self._lock:
+                self.counters["skipped"] += 1
+            return False
+        with self._lock:
+            self.counters["hedged"] += 1
+        self._report("sent")
+        return True
+
+    def _report(self, outcome):
+        if outcome == "won":
+            with self._lock:
+                self.counters["won"] += 1
+        if self.on_hedge:
+            self.on_hedge(outcome)
+
+    def _release_when_done(self, attempts, release):
+        # The backup's slot covers whichever attempt is still running, so it
+        # goes back once both have finished, not when the winner returns
+        left = [len(attempts)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last and release is not None:
+                release()
+
+        for attempt in attempts:
+            attempt.add_done_callback(finished)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="hedge"
+                )
+            return self._executor
+
+    def call(self, fn, admit=None, release=None):
+        """``fn()``, hedged. ``admit()`` may veto a backup (e.g. no free
+        concurrency slot); ``release()`` is called once a vetted backup is over."""
+        wait = self._hedge_after()
+        if wait is None:
+            return self._timed(fn) if self.enabled else fn()
+        pool = self._pool()
+        # Attempts see this context: the deadline, the active session...
+        primary = pool.submit(contextvars.copy_context().run, self._timed, fn)
+        try:
+            return primary.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self._may_hedge(admit):
+            return primary.result()
+        backup = pool.submit(contextvars.copy_context().run, self._timed, fn)
+        self._release_when_done([primary, backup], release)
+        pending = {primary, backup}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            # A success beats a failure that finished at the same moment
+            for attempt in sorted(done, key=lambda attempt: attempt.exception() is not None):
+                if attempt.exception() is None or not pending:
+                    self._report("won" if attempt is backup else "lost")
+                    return attempt.result()
+
+    async def acall(self, fn, admit=None, release=None):
+        """call() for a coroutine function ``fn``; the losing attempt is cancelled"""
+        wait = self._hedge_after()
+        if wait is None:
+            return await (self._atimed(fn) if self.enabled else fn())
+        # Tasks copy the current context, deadline included
+        primary = asyncio.ensure_future(self._atimed(fn))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=wait)
+            if done or not self._may_hedge(admit):
+                return await primary
+            backup = asyncio.ensure_future(self._atimed(fn))
+            self._release_when_done([primary, backup], release)
+            pending.add(backup)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in sorted(done, key=lambda attempt: attempt.exception() is not None):
+                    if attempt.exception() is None or not pending:
+                        self._report("won" if attempt is backup else "lost")
+                        return attempt.result()
+        finally:
+            for attempt in pending:
+                attempt.cancel()
+
+    def stats(self):
+        wait = self.delay() if self.enabled else None
+        return {
+            **self.counters,
+            "percentile": self.percentile,
+            "delay": None if wait is None else round(wait, 3),
+            "samples": len(self._latencies),
+        }